@@ -0,0 +1,181 @@
+"""
+Admission control for the inference endpoints.
+
+* RateLimiter: one token bucket per (client, endpoint). A client that posts frames
+  in a tight loop gets 429 responses instead of starving the cameras.
+  Configured with RATE_LIMIT_<ENDPOINT>=<requests per second>:<burst>.
+* InferenceScheduler: every model call goes through a priority queue served by
+  dedicated worker threads. Camera frames always go before API requests, and an
+  API request that cannot start within its queue-time budget is rejected (503)
+  rather than served late.
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# default (rate, burst) per endpoint
+DEFAULT_LIMITS = {
+    'detect': (10.0, 20),
+    'detect_stream': (2.0, 4),
+}
+
+
+class Overloaded(Exception):
+    """Raised when a request cannot be served in time."""
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, with bursts of up to `burst` requests."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'lock')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, cost=1.0):
+        """Take `cost` tokens. Returns 0 on success, else the number of seconds to wait."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return 0.0
+            return (cost - self.tokens) / self.rate
+
+
+def limit_config(endpoint):
+    """Read the (rate, burst) of an endpoint from RATE_LIMIT_<ENDPOINT>, or use the default."""
+    rate, burst = DEFAULT_LIMITS[endpoint]
+    value = os.environ.get(f'RATE_LIMIT_{endpoint.upper()}')
+    if value:
+        try:
+            rate, burst = value.split(':')
+            rate, burst = float(rate), int(burst)
+        except ValueError:
+            logger.warning(f"Invalid RATE_LIMIT_{endpoint.upper()}={value}, expected <rate>:<burst>")
+            rate, burst = DEFAULT_LIMITS[endpoint]
+    return rate, burst
+
+
+class RateLimiter:
+    """Token buckets per client and per endpoint. The least recently seen clients are forgotten first."""
+
+    def __init__(self, max_clients=10000):
+        self.limits = {endpoint: limit_config(endpoint) for endpoint in DEFAULT_LIMITS}
+        self.buckets = OrderedDict()
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+
+    def check(self, client, endpoint, cost=1.0):
+        """Returns 0 if the request is admitted, else the number of seconds before retrying."""
+        key = (client, endpoint)
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(*self.limits[endpoint])
+                if len(self.buckets) > self.max_clients:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+        wait = bucket.take(cost)
+        if wait:
+            metrics.QUEUE_DROPPED.labels(f'rate_limit_{endpoint}', 'reject').inc()
+        return wait
+
+
+class _Job:
+    __slots__ = ('function', 'args', 'state', 'result', 'error', 'done', 'queued')
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.state = 'queued'
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.queued = time.perf_counter()
+
+
+class InferenceScheduler:
+    """Runs model calls on worker threads, highest priority (lowest number) first."""
+
+    CAMERA = 0
+    API = 1
+    NAMES = {CAMERA: 'camera', API: 'api'}
+
+    def __init__(self, workers=1):
+        self.heap = []
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        self.workers = workers
+        self.threads = []
+        self.wait_seconds = {p: metrics.STAGE_SECONDS.labels(name, 'scheduler_wait') for p, name in self.NAMES.items()}
+        self.expired = metrics.QUEUE_DROPPED.labels('inference_scheduler', 'deadline')
+        metrics.QUEUE_DEPTH.labels('inference_scheduler').set_function(lambda: len(self.heap))
+
+    def _start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'inference-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self, function, *args, priority=API, budget=None):
+        """
+        Call `function(*args)` on a worker thread and return its result.
+
+        :param priority: InferenceScheduler.CAMERA or InferenceScheduler.API.
+        :param budget: maximum number of seconds the call may wait before starting, or None.
+        :raises Overloaded: if the call did not start within `budget`.
+        """
+        job = _Job(function, args)
+        with self.condition:
+            if not self.threads:
+                self._start()
+            heapq.heappush(self.heap, (priority, next(self.order), job))
+            self.condition.notify()
+
+        if not job.done.wait(budget):
+            with self.condition:
+                if job.state == 'queued':
+                    job.state = 'cancelled'
+                    self.expired.inc()
+                    raise Overloaded(f'Inference did not start within {budget:.2f}s')
+            # already running: wait for the result
+            job.done.wait()
+
+        self.wait_seconds[priority].observe(job.queued)
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.heap:
+                    self.condition.wait()
+                _, _, job = heapq.heappop(self.heap)
+                if job.state == 'cancelled':
+                    continue
+                job.state = 'running'
+                # the time spent in the queue, read by `run()` once the job is done
+                job.queued = time.perf_counter() - job.queued
+            try:
+                job.result = job.function(*job.args)
+            except Exception as e:
+                job.error = e
+            job.state = 'done'
+            job.done.set()
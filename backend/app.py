@@ -11,57 +11,121 @@ import time
 from datetime import datetime
 from io import BytesIO
 from PIL import Image
+import itertools
 import logging
+import os
+import platform
+import uuid
+
+import metrics
+import profiler
+from admission import InferenceScheduler, Overloaded, RateLimiter
+from broker import FRAMES, RESULTS, connect as connect_broker
+from cluster import ClientCounter, socketio_options
+from pipeline import CameraPipeline, Emitter, Gate
+from regions import CameraRegions, merge_boxes
+from registry import PROBE_INTERVAL, PROBE_MAX_INTERVAL, CameraRegistry, configured_cameras
+from renditions import CameraSettings
+from sources import VideoSource, camera_source, describe
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
-# More permissive CORS for development
-CORS(app, origins="*")  # Allow all origins for development
+# Origins allowed to call the API and open Socket.IO connections, comma separated ("*" allows all)
+CORS_ORIGINS = [o.strip() for o in os.environ.get('CORS_ORIGINS', 'http://localhost:3000,http://127.0.0.1:3000').split(',')]
+if '*' in CORS_ORIGINS:
+    CORS_ORIGINS = '*'
+CORS(app, origins=CORS_ORIGINS)
+# With SOCKETIO_MESSAGE_QUEUE set, events reach the clients of every API process, see cluster.py
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
 socketio = SocketIO(app, 
-                   cors_allowed_origins="*",  # Allow all origins for Socket.IO
+                   cors_allowed_origins=CORS_ORIGINS,
                    async_mode='threading',
                    ping_timeout=20,
                    ping_interval=25,
                    logger=False,
-                   engineio_logger=False)
+                   engineio_logger=False,
+                   **socketio_options())
 
-# Configure logging - enable debug level to see detection info
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging - set LOG_LEVEL=DEBUG to see detection info
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 logger = logging.getLogger(__name__)
 
+# Per-frame logs in the streaming loop are only written for one frame every LOG_SAMPLE_EVERY
+LOG_SAMPLE_EVERY = int(os.environ.get('LOG_SAMPLE_EVERY', 100))
+
 # Global variables for camera management and detection history
-cameras = {}  # Will store camera objects
-detection_history = []  # Store detection history
-connected_clients = 0
-camera_lock = threading.Lock()
+cameras = {}  # camera index -> VideoSource
+detection_history = []  # Store detection history (kept by the broker in distributed mode)
+HISTORY_SIZE = 50
+camera_lock = threading.RLock()  # guards `cameras` only, sources are opened by their decode thread
+
+# One shared pipeline per streamed camera, see pipeline.py
+pipelines = {}
+pipelines_lock = threading.Lock()
+classified_counts = {}
+STREAM_FPS = float(os.environ.get('STREAM_FPS', 15))
+
+# Socket.IO events are sent from a bounded queue, inference endpoints are limited by a gate
+emitter = Emitter(lambda event, data: socketio.emit(event, data))
+api_gate = Gate('api_inference')
+MAX_STREAM_FRAMES = int(os.environ.get('MAX_STREAM_FRAMES', 16))
+
+# Every model call goes through the scheduler: camera frames first, then API requests,
+# which are rejected if they cannot start within API_QUEUE_BUDGET seconds. See admission.py
+scheduler = InferenceScheduler(workers=int(os.environ.get('INFERENCE_WORKERS', 1)))
+rate_limiter = RateLimiter()
+API_QUEUE_BUDGET = float(os.environ.get('API_QUEUE_BUDGET', 0.5))
+
+# Distributed mode, enabled by BROKER_URL (see broker.py). ROLE selects the part run by this process:
+#   capture  cameras and MJPEG streams, frames are sent to the broker
+#   worker   stateless inference worker, no server
+#   api      REST API and Socket.IO, aggregates the results of all the workers
+#   all      everything in one process (the default)
+BROKER_URL = os.environ.get('BROKER_URL')
+ROLE = os.environ.get('ROLE', 'all')
+NODE_NAME = os.environ.get('NODE_NAME', platform.node())
+broker = connect_broker(BROKER_URL, int(os.environ.get('BROKER_QUEUE_SIZE', 256))) if BROKER_URL else None
+
+# Socket.IO clients of this process, and of all the API processes sharing the broker
+clients = ClientCounter(broker, NODE_NAME)
+
+metrics.CONNECTED_CLIENTS.set_function(clients.local)
+metrics.QUEUE_DEPTH.labels('detection_history').set_function(
+    lambda: broker.length('history') if broker is not None else len(detection_history))
 
 
 # Load the TensorFlow/Keras weapon detection model
 
-try:
-    model_path = 'weapon_detection_model.h5'
-    logger.info(f"Loading weapon detection model from: {model_path}")
+if broker is not None and ROLE == 'capture':
+    # Capture nodes send their frames to the inference workers
+    logger.info("Capture node: the model is not loaded")
+    model = None
+    class_names = []
+else:
+    try:
+        model_path = 'weapon_detection_model.h5'
+        logger.info(f"Loading weapon detection model from: {model_path}")
     
-    model = tf.keras.models.load_model(model_path)
+        model = tf.keras.models.load_model(model_path)
     
-    # Test the model with a dummy inference to ensure compatibility
-    dummy_img = np.zeros((1, 224, 224, 3), dtype=np.float32)
-    test_results = model.predict(dummy_img, verbose=0)
+        # Test the model with a dummy inference to ensure compatibility
+        dummy_img = np.zeros((1, 224, 224, 3), dtype=np.float32)
+        test_results = model.predict(dummy_img, verbose=0)
     
-    logger.info(f"Successfully loaded and tested model from: {model_path}")
-    logger.info(f"Model input shape: {model.input_shape}")
-    logger.info(f"Model output shape: {model.output_shape}")
-    logger.info(f"Number of classes: {model.output_shape[-1]}")
+        logger.info(f"Successfully loaded and tested model from: {model_path}")
+        logger.info(f"Model input shape: {model.input_shape}")
+        logger.info(f"Model output shape: {model.output_shape}")
+        logger.info(f"Number of classes: {model.output_shape[-1]}")
     
-    # Define class names (assuming 3-class weapon detection)
-    # You may need to adjust these based on your specific model training
-    class_names = ['No Weapon', 'Knife', 'Gun']  # Adjust as needed
-    logger.info(f"Model classes: {class_names}")
+        # Define class names (assuming 3-class weapon detection)
+        # You may need to adjust these based on your specific model training
+        class_names = ['No Weapon', 'Knife', 'Gun']  # Adjust as needed
+        logger.info(f"Model classes: {class_names}")
         
-except Exception as e:
-    logger.error(f"Critical error loading model: {e}")
-    model = None
-    class_names = []
+    except Exception as e:
+        logger.error(f"Critical error loading model: {e}")
+        model = None
+        class_names = []
 
 def decode_base64_image(base64_string):
     """Decode base64 image string to OpenCV image"""
@@ -84,11 +148,17 @@ def decode_base64_image(base64_string):
         logger.error(f"Error decoding base64 image: {e}")
         return None
 
+# (width, height) of the classification model input
+MODEL_INPUT_SIZE = (224, 224)
+
 def preprocess_image_for_classification(frame):
     """Preprocess image for the classification model"""
     try:
-        # Resize to model input size (224x224)
-        resized = cv2.resize(frame, (224, 224))
+        # Resize to model input size, unless the frame was already resized for inference
+        if (frame.shape[1], frame.shape[0]) != MODEL_INPUT_SIZE:
+            resized = cv2.resize(frame, MODEL_INPUT_SIZE)
+        else:
+            resized = frame
         
         # Convert BGR to RGB
         rgb_image = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
@@ -105,8 +175,56 @@ def preprocess_image_for_classification(frame):
         logger.error(f"Error preprocessing image: {e}")
         return None
 
-def classify_image(frame, confidence_threshold=0.5):
-    """Classify the entire image for weapon detection and return results"""
+# Stage timers of the inference endpoints, resolved once
+def stage_timers(camera_index, stages=('capture', 'preprocess', 'inference', 'encode', 'emit', 'end_to_end')):
+    """Resolve the stage histograms of a camera once, before entering its streaming loop"""
+    return {stage: profiler.TracedTimer(metrics.STAGE_SECONDS.labels(camera_index, stage), camera_index, stage)
+            for stage in stages}
+
+def run_model(processed_image):
+    """Called on the scheduler's inference threads"""
+    return model.predict(processed_image, verbose=0)
+
+API_TIMERS = stage_timers('api', stages=('preprocess', 'inference'))
+
+def class_name_of(class_id):
+    return class_names[class_id] if class_id < len(class_names) else f"class_{class_id}"
+
+def interpret_predictions(probabilities, bbox, confidence_threshold, classification_type='full_image'):
+    """Turn the class probabilities of an image into a detection covering `bbox`, and the list of all probabilities"""
+    # Get the predicted class and confidence
+    predicted_class_id = int(np.argmax(probabilities))
+    confidence = float(probabilities[predicted_class_id])
+    
+    detections = []
+    
+    # Only return detection if confidence is above threshold
+    if confidence >= confidence_threshold:
+        detections.append({
+            'bbox': bbox,
+            'confidence': round(confidence, 3),
+            'class_name': class_name_of(predicted_class_id),
+            'class_id': predicted_class_id,
+            'classification_type': classification_type  # Indicate this is image classification
+        })
+    
+    # Also return all class probabilities for reference
+    all_predictions = []
+    for i, prob in enumerate(probabilities):
+        all_predictions.append({
+            'class_name': class_name_of(i),
+            'class_id': i,
+            'probability': round(float(prob), 3)
+        })
+    
+    return detections, all_predictions
+
+def classify_image(frame, confidence_threshold=0.5, timers=API_TIMERS,
+                   priority=InferenceScheduler.API, budget=API_QUEUE_BUDGET):
+    """
+    Classify the entire image for weapon detection and return results.
+    Raises Overloaded if the inference could not start within `budget` seconds.
+    """
     if model is None:
         logger.warning("Model is not loaded, skipping classification")
         return [], []
@@ -118,74 +236,124 @@ def classify_image(frame, confidence_threshold=0.5):
             return [], []
         
         # Preprocess the image
+        start = time.perf_counter()
         processed_image = preprocess_image_for_classification(frame)
         if processed_image is None:
             return [], []
+        preprocessed = time.perf_counter()
+        timers['preprocess'].observe(preprocessed - start)
         
-        # Run inference
-        predictions = model.predict(processed_image, verbose=0)
+        # Run inference, after the requests of higher priority
+        predictions = scheduler.run(run_model, processed_image, priority=priority, budget=budget)
+        timers['inference'].observe(time.perf_counter() - preprocessed)
         
-        # Get the predicted class and confidence
-        predicted_class_id = np.argmax(predictions[0])
-        confidence = float(predictions[0][predicted_class_id])
+        # For classification, we consider the entire image as the "detection area"
+        height, width = frame.shape[:2]
+        detections, all_predictions = interpret_predictions(predictions[0], [0, 0, width, height],
+                                                            confidence_threshold)
         
-        detections = []
+        return detections, all_predictions
+    
+    except Overloaded:
+        raise
+    except Exception as e:
+        logger.error(f"Error during classification: {type(e).__name__}: {e}")
+        return [], []
+
+def classify_regions(frame, regions, confidence_threshold, timers, priority=InferenceScheduler.CAMERA, budget=None):
+    """
+    Classify crops of the frame in one batch (see regions.py) and merge their results:
+    every crop classified as a weapon is a detection at its own box, and the frame is
+    'No Weapon' only if all the crops are.
+    """
+    if model is None:
+        logger.warning("Model is not loaded, skipping classification")
+        return [], []
+    
+    try:
+        # Validate input frame
+        if frame is None or frame.size == 0:
+            logger.warning("Invalid frame provided for classification")
+            return [], []
         
-        # Only return detection if confidence is above threshold
-        if confidence >= confidence_threshold:
-            class_name = class_names[predicted_class_id] if predicted_class_id < len(class_names) else f"class_{predicted_class_id}"
-            
-            # For classification, we consider the entire image as the "detection area"
-            height, width = frame.shape[:2]
-            
-            detections.append({
-                'bbox': [0, 0, width, height],  # Full image as bounding box
-                'confidence': round(confidence, 3),
-                'class_name': class_name,
-                'class_id': int(predicted_class_id),
-                'classification_type': 'full_image'  # Indicate this is image classification
-            })
+        # Preprocess the crops, skipping those that cannot be
+        start = time.perf_counter()
+        crops = [(region, preprocess_image_for_classification(region.crop(frame))) for region in regions]
+        crops = [(region, image) for region, image in crops if image is not None]
+        if not crops:
+            return [], []
+        regions = [region for region, _ in crops]
+        batch = np.concatenate([image for _, image in crops])
+        preprocessed = time.perf_counter()
+        timers['preprocess'].observe(preprocessed - start)
         
-        # Also return all class probabilities for reference
-        all_predictions = []
-        for i, prob in enumerate(predictions[0]):
-            class_name = class_names[i] if i < len(class_names) else f"class_{i}"
-            all_predictions.append({
-                'class_name': class_name,
-                'class_id': i,
-                'probability': round(float(prob), 3)
-            })
+        predictions = scheduler.run(run_model, batch, priority=priority, budget=budget)
+        timers['inference'].observe(time.perf_counter() - preprocessed)
         
-        logger.debug(f"Classification result - Predicted: {class_names[predicted_class_id] if predicted_class_id < len(class_names) else 'Unknown'}, Confidence: {confidence:.3f}")
+        no_weapon_ids = [i for i in range(predictions.shape[1]) if class_name_of(i).lower() == 'no weapon']
+        detections = []
+        for region, probabilities in zip(regions, predictions):
+            region_detections, _ = interpret_predictions(probabilities, list(region.box), confidence_threshold,
+                                                         'region')
+            detections.extend(d for d in region_detections if d['class_id'] not in no_weapon_ids)
+        detections = merge_boxes(detections)
         
+        # Frame probabilities: weapons at their highest over the regions, no weapon at its lowest
+        probabilities = predictions.max(axis=0)
+        probabilities[no_weapon_ids] = predictions[:, no_weapon_ids].min(axis=0)
+        height, width = frame.shape[:2]
+        frame_detections, all_predictions = interpret_predictions(probabilities, [0, 0, width, height],
+                                                                  confidence_threshold, 'region')
+        if not detections:
+            detections = [d for d in frame_detections if d['class_id'] in no_weapon_ids]
         return detections, all_predictions
     
+    except Overloaded:
+        raise
     except Exception as e:
-        logger.error(f"Error during classification: {type(e).__name__}: {e}")
+        logger.error(f"Error during region classification: {type(e).__name__}: {e}")
         return [], []
 
+# Capture, inference and stream resolutions of each camera, see renditions.py,
+# and the regions classified, see regions.py
+settings = {}
+regions = {}
+
+def camera_settings(camera_index):
+    camera = settings.get(camera_index)
+    if camera is None:
+        camera = settings.setdefault(camera_index, CameraSettings(camera_index))
+    return camera
+
+def camera_regions(camera_index):
+    camera = regions.get(camera_index)
+    if camera is None:
+        camera = regions.setdefault(camera_index, CameraRegions(camera_index))
+    return camera
+
+def open_capture(source):
+    """Open the video capture of a source. Replaced by synthetic sources in benchmarks."""
+    return cv2.VideoCapture(source)
+
 def initialize_camera(camera_index):
-    """Initialize a camera by index"""
+    """
+    Initialize a camera by index, from its configured source (see sources.py).
+    The camera is registered at once and its decode thread opens the source, retrying with backoff,
+    so a source that is slow or fails to open never blocks the other cameras.
+    """
     try:
         with camera_lock:
             if camera_index in cameras:
                 # Camera already initialized
                 return True
-            
-            # Try to open the camera
-            cap = cv2.VideoCapture(camera_index)
-            if not cap.isOpened():
-                logger.warning(f"Could not open camera {camera_index}")
-                return False
-            
-            # Set camera properties for better performance
-            cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-            cap.set(cv2.CAP_PROP_FPS, 30)
-            
-            cameras[camera_index] = cap
-            logger.info(f"Camera {camera_index} initialized successfully")
-            return True
+            source = VideoSource(camera_index, camera_source(camera_index), open_capture,
+                                 size=camera_settings(camera_index).capture_size)
+            cameras[camera_index] = source
+        
+        source.start()
+        logger.info(f"Camera {camera_index} initialized ({describe(source.source)})")
+        camera_registry.refresh(camera_index)
+        return True
     except Exception as e:
         logger.error(f"Error initializing camera {camera_index}: {e}")
         return False
@@ -194,138 +362,387 @@ def release_camera(camera_index):
     """Release a camera by index"""
     try:
         with camera_lock:
-            if camera_index in cameras:
-                cameras[camera_index].release()
-                del cameras[camera_index]
-                logger.info(f"Camera {camera_index} released")
-                return True
+            source = cameras.pop(camera_index, None)
+        if source is None:
             return False
+        source.stop()
+        logger.info(f"Camera {camera_index} released")
+        camera_registry.refresh(camera_index)
+        return True
     except Exception as e:
         logger.error(f"Error releasing camera {camera_index}: {e}")
         return False
 
 def get_camera_frame(camera_index):
-    """Get a frame from the specified camera"""
+    """
+    Get a frame from the specified camera, or None while it is unavailable.
+    Connections and reconnections happen on the decode thread of the camera, not here.
+    """
     try:
-        with camera_lock:
-            if camera_index not in cameras:
-                # Try to initialize the camera if it doesn't exist
-                if not initialize_camera(camera_index):
-                    return None
-            
-            cap = cameras[camera_index]
-            ret, frame = cap.read()
-            
-            if not ret:
-                logger.warning(f"Failed to read from camera {camera_index}")
-                # Try to reinitialize the camera
-                release_camera(camera_index)
-                if initialize_camera(camera_index):
-                    cap = cameras[camera_index]
-                    ret, frame = cap.read()
-                    if not ret:
-                        return None
-                else:
-                    return None
-            
-            return frame
+        source = cameras.get(camera_index)
+        if source is None:
+            # Start the camera, its first frame is read by a later request
+            initialize_camera(camera_index)
+            return None
+        if not source.connected:
+            return None
+        
+        return source.read()
     except Exception as e:
         logger.error(f"Error getting frame from camera {camera_index}: {e}")
         return None
 
-def generate_frames(camera_index):
-    """Generate frames for streaming with better error handling"""
-    frame_count = 0
-    detection_interval = 5  # Run detection every 5 frames for better responsiveness
-    
+def probe_camera(camera_index):
+    """State of a camera for the registry, called from its monitor thread"""
+    source = cameras.get(camera_index)
+    if source is not None:
+        return 'connected' if source.connected else 'reconnecting'
+    cap = open_capture(camera_source(camera_index))
     try:
-        while True:
-            frame = get_camera_frame(camera_index)
-            if frame is None:
-                # Send a placeholder image instead of breaking
-                placeholder = np.zeros((480, 640, 3), dtype=np.uint8)
-                cv2.putText(placeholder, f'Camera {camera_index} not available', (50, 240), 
-                           cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-                frame = placeholder
-            else:
-                # Only perform detection every N frames to reduce processing load
-                if frame_count % detection_interval == 0 and model is not None:
-                    try:
-                        logger.debug(f"Running detection on frame {frame_count}")
-                        detections, all_predictions = classify_image(frame, confidence_threshold=0.3)  # Lower threshold for better detection
-                        
-                        # Draw detection results and log all predictions
-                        logger.debug(f"Detection results: {len(detections)} detections, {len(all_predictions)} predictions")
-                        if all_predictions:
-                            logger.info(f"All predictions: {all_predictions}")
-                        
-                        if detections:
-                            for detection in detections:
-                                # Show all detections including 'No Weapon' for debugging
-                                label = f"{detection['class_name']}: {detection['confidence']:.2f}"
-                                color = (0, 255, 0) if detection['class_name'].lower() == 'no weapon' else (0, 0, 255)
-                                cv2.putText(frame, label, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
-                                
-                                # Emit detection for frontend display (including No Weapon for debugging)
-                                detection_data = {
-                                    'bbox': detection['bbox'],
-                                    'confidence': detection['confidence'],
-                                    'class_name': detection['class_name'],
-                                    'class_id': detection['class_id'],
-                                    'is_weapon': detection['class_name'].lower() != 'no weapon',
-                                    'timestamp': datetime.now().isoformat(),
-                                    'camera_index': camera_index
-                                }
-                                
-                                # Always emit detection data for frontend overlay
-                                socketio.emit('detection_result', detection_data)
-                                
-                                # Only emit alerts for actual weapons
-                                if detection['class_name'].lower() != 'no weapon' and detection['confidence'] > 0.3:
-                                    alert_data = {
-                                        'message': f"Weapon detected: {detection['class_name']}",
-                                        'timestamp': datetime.now().isoformat(),
-                                        'weapon_type': detection['class_name'],
-                                        'confidence': detection['confidence'],
-                                        'camera_index': camera_index
-                                    }
-                                    socketio.emit('detection', alert_data)
-                                    
-                                    # Add to history
-                                    detection_history.insert(0, {
-                                        'id': len(detection_history) + 1,
-                                        'date': datetime.now().isoformat(),
-                                        'weapon_type': detection['class_name'],
-                                        'location': f'Camera {camera_index}',
-                                        'screenshot': '',
-                                        'confidence': detection['confidence']
-                                    })
-                                    
-                                    # Keep only last 50 detections
-                                    if len(detection_history) > 50:
-                                        detection_history.pop()
-                    except Exception as e:
-                        logger.error(f"Detection error: {e}")
-                        # Continue without detection on error
-                        pass
-            
-            # Encode frame as JPEG with compression
-            encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 80]
-            ret, buffer = cv2.imencode('.jpg', frame, encode_param)
-            if not ret:
-                continue
+        return 'available' if cap.isOpened() else 'unavailable'
+    finally:
+        cap.release()
+
+# Camera states are probed in the background and served from cache, see registry.py
+def notify_camera_change(status):
+    # with a message queue, the capture node probing the camera notifies the clients of all the API processes
+    if broker is not None and ROLE == 'api' and SOCKETIO_MESSAGE_QUEUE:
+        return
+    emitter.send('camera_status', status)
+
+camera_registry = CameraRegistry(probe_camera, on_change=notify_camera_change)
+
+def make_placeholder(camera_index):
+    """Image streamed while a camera is not available"""
+    placeholder = np.zeros((480, 640, 3), dtype=np.uint8)
+    cv2.putText(placeholder, f'Camera {camera_index} not available', (50, 240), 
+               cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+    return placeholder
+
+def inference_image(camera_index, frame):
+    """
+    The image classified for a captured renditions.Frame: at the inference resolution of the camera,
+    or at the captured resolution if the camera is classified by regions and has none.
+    """
+    inference_size = camera_settings(camera_index).inference_size
+    if camera_regions(camera_index).enabled:
+        return frame.resized(inference_size)
+    return frame.resized(inference_size or MODEL_INPUT_SIZE)
+
+def classify_frame(camera_index, image, frame_size, timers):
+    """
+    Classify the inference image of a camera, whole or by regions if the camera has some.
+    The boxes are returned in the coordinates of the captured frame, of `frame_size` (width, height).
+    """
+    camera = camera_regions(camera_index)
+    if camera.enabled:
+        detections, all_predictions = classify_regions(image, camera.regions(image.shape), confidence_threshold=0.3,
+                                                       timers=timers)
+    else:
+        detections, all_predictions = classify_image(image, confidence_threshold=0.3, timers=timers,
+                                                     priority=InferenceScheduler.CAMERA, budget=None)  # Lower threshold for better detection
+    
+    # Report the boxes in the coordinates of the captured frame
+    if tuple(frame_size) != (image.shape[1], image.shape[0]):
+        scale_x = frame_size[0] / image.shape[1]
+        scale_y = frame_size[1] / image.shape[0]
+        for detection in detections:
+            x1, y1, x2, y2 = detection['bbox']
+            detection['bbox'] = [int(x1 * scale_x), int(y1 * scale_y), int(x2 * scale_x), int(y2 * scale_y)]
+    
+    return detections, all_predictions
+
+def classify_camera_frame(camera_index, frame, timers):
+    """Inference stage of a camera pipeline: classify a frame, emit the results and record alerts"""
+    detections, all_predictions = classify_frame(camera_index, inference_image(camera_index, frame),
+                                                 (frame.shape[1], frame.shape[0]), timers)
+    report_detections(camera_index, detections, all_predictions, timers)
+    return detections
+
+def report_detections(camera_index, detections, all_predictions, timers):
+    """Emit the detections of a camera frame to the clients and record the alerts in the history"""
+    # Log a sample of the predictions, formatted only if the log is written
+    count = next(classified_counts.setdefault(camera_index, itertools.count()))
+    if count % LOG_SAMPLE_EVERY == 0 and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Camera %s frame %d: %d detections, all predictions: %s",
+                     camera_index, count, len(detections), all_predictions)
+    
+    emit_start = time.perf_counter()
+    for detection in detections:
+        # Emit detection for frontend display (including No Weapon for debugging)
+        detection_data = {
+            'bbox': detection['bbox'],
+            'confidence': detection['confidence'],
+            'class_name': detection['class_name'],
+            'class_id': detection['class_id'],
+            'is_weapon': detection['class_name'].lower() != 'no weapon',
+            'timestamp': datetime.now().isoformat(),
+            'camera_index': camera_index
+        }
+        
+        # Always emit detection data for frontend overlay
+        emitter.send('detection_result', detection_data)
+        metrics.DETECTIONS.labels(camera_index, detection['class_name']).inc()
+        
+        # Only emit alerts for actual weapons
+        if detection['class_name'].lower() != 'no weapon' and detection['confidence'] > 0.3:
+            alert_data = {
+                'message': f"Weapon detected: {detection['class_name']}",
+                'timestamp': datetime.now().isoformat(),
+                'weapon_type': detection['class_name'],
+                'confidence': detection['confidence'],
+                'camera_index': camera_index
+            }
+            emitter.send('detection', alert_data)
             
-            frame_bytes = buffer.tobytes()
+            # Add to history
+            record_detection({
+                # unique across the detections of a frame and the API processes sharing the history
+                'id': uuid.uuid4().hex,
+                'date': datetime.now().isoformat(),
+                'weapon_type': detection['class_name'],
+                'location': f'Camera {camera_index}',
+                'screenshot': '',
+                'confidence': detection['confidence']
+            })
+    timers['emit'].observe(time.perf_counter() - emit_start)
+
+def record_detection(entry):
+    """Add an alert to the detection history, keeping the last HISTORY_SIZE"""
+    if broker is not None:
+        broker.record('history', entry, HISTORY_SIZE)
+        return
+    detection_history.insert(0, entry)
+    if len(detection_history) > HISTORY_SIZE:
+        detection_history.pop()
+
+def recent_detections():
+    """The detection history, most recent first"""
+    if broker is not None:
+        return broker.recent('history')
+    return list(detection_history)
+
+def annotate_frame(frame, detections, frame_size=None):
+    """
+    Draw the box and label of the latest detections on a copy of the frame.
+    The boxes are in the coordinates of the captured frame, of `frame_size` (width, height),
+    and are scaled to the rendition drawn.
+    """
+    if not detections:
+        return frame
+    
+    # The frame may still be waiting for inference, so never draw on it directly
+    frame = frame.copy()
+    height, width = frame.shape[:2]
+    scale_x = width / frame_size[0] if frame_size else 1.0
+    scale_y = height / frame_size[1] if frame_size else 1.0
+    for detection in detections:
+        # Show all detections including 'No Weapon' for debugging
+        label = f"{detection['class_name']}: {detection['confidence']:.2f}"
+        color = (0, 255, 0) if detection['class_name'].lower() == 'no weapon' else (0, 0, 255)
+        x1, y1, x2, y2 = detection['bbox']
+        x1, y1 = int(x1 * scale_x), int(y1 * scale_y)
+        x2, y2 = int(x2 * scale_x) - 1, int(y2 * scale_y) - 1
+        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+        # Above the box, or inside it when the box starts at the top of the frame
+        cv2.putText(frame, label, (x1 + 5, y1 + 25) if y1 < 30 else (x1, y1 - 8),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
+    return frame
+
+def encode_frame(frame, quality=80):
+    """Encode frame as JPEG with compression"""
+    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+    ret, buffer = cv2.imencode('.jpg', frame, encode_param)
+    return buffer.tobytes() if ret else None
+
+def remove_pipeline(pipeline):
+    with pipelines_lock:
+        if pipelines.get(pipeline.camera_index) is pipeline:
+            del pipelines[pipeline.camera_index]
+
+def get_pipeline(camera_index):
+    """Return the running pipeline of a camera, starting it for the first viewer"""
+    with pipelines_lock:
+        pipeline = pipelines.get(camera_index)
+        if pipeline is None or pipeline.stopped.is_set():
+            pipeline = CameraPipeline(
+                camera_index,
+                read_frame=get_camera_frame,
+                placeholder=make_placeholder,
+                classify=submit_camera_frame if broker is not None else
+                         classify_camera_frame if model is not None else (lambda *args: []),
+                annotate=annotate_frame,
+                encode=encode_frame,
+                timers=stage_timers(camera_index),
+                renditions=camera_settings(camera_index).renditions,
+                stream_fps=STREAM_FPS,
+                detection_interval=5,  # Run detection every 5 frames for better responsiveness
+                idle_timeout=None if broker is not None else 5.0,  # distributed cameras are watched by the workers
+                on_stop=remove_pipeline
+            )
+            pipelines[camera_index] = pipeline
+            pipeline.start()
+        return pipeline
+
+def generate_frames(camera_index, rendition='full'):
+    """Stream one rendition of the camera pipeline to one MJPEG viewer"""
+    pipeline = get_pipeline(camera_index)
+    active_streams = metrics.ACTIVE_STREAMS.labels(camera_index)
+    active_streams.inc()
+    
+    try:
+        for frame_bytes in pipeline.frames(rendition):
             yield (b'--frame\r\n'
                    b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-            
-            frame_count += 1
-            time.sleep(0.066)  # ~15 FPS for better performance
-            
     except GeneratorExit:
         logger.info(f"Stream generator for camera {camera_index} stopped")
     except Exception as e:
         logger.error(f"Error in frame generation for camera {camera_index}: {e}")
+    finally:
+        active_streams.dec()
+
+# Distributed mode: capture nodes -> FRAMES -> inference workers -> RESULTS -> API tier
+
+def submit_camera_frame(camera_index, frame, timers):
+    """Inference stage of a capture node: send the frame to the inference workers"""
+    start = time.perf_counter()
+    image = inference_image(camera_index, frame)
+    encoded = encode_frame(image, quality=90)
+    if encoded is not None:
+        broker.push(FRAMES, {
+            'camera_index': camera_index,
+            'node': NODE_NAME,
+            'image': base64.b64encode(encoded).decode(),
+            'frame_size': [frame.shape[1], frame.shape[0]],
+            'captured_at': time.time()
+        })
+    timers['emit'].observe(time.perf_counter() - start)
+    # the detections reach the clients through the API tier
+    return []
+
+def run_worker():
+    """Inference worker: classify the frames of any camera, until the process exits"""
+    logger.info(f"Inference worker {NODE_NAME} started")
+    timers = {}
+    while True:
+        message = broker.pop(FRAMES)
+        if message is None:
+            continue
+        try:
+            camera_index = message['camera_index']
+            camera_timers = timers.get(camera_index) or timers.setdefault(camera_index, stage_timers(camera_index))
+            image = decode_base64_image(message['image'])
+            if image is None:
+                continue
+            detections, all_predictions = classify_frame(camera_index, image, message['frame_size'], camera_timers)
+            broker.push(RESULTS, {
+                'camera_index': camera_index,
+                'node': message['node'],
+                'worker': NODE_NAME,
+                'captured_at': message['captured_at'],
+                'detections': detections,
+                'all_predictions': all_predictions
+            })
+        except Exception as e:
+            logger.error(f"Error in inference worker: {e}")
+
+def consume_results():
+    """API tier: emit the results of all the workers and keep the history"""
+    timers = {}
+    while True:
+        message = broker.pop(RESULTS)
+        if message is None:
+            continue
+        try:
+            camera_index = message['camera_index']
+            camera_timers = timers.get(camera_index) or timers.setdefault(camera_index, stage_timers(camera_index))
+            report_detections(camera_index, message['detections'], message['all_predictions'], camera_timers)
+            camera_timers['end_to_end'].observe(max(0.0, time.time() - message['captured_at']))
+        except Exception as e:
+            logger.error(f"Error handling inference result: {e}")
+
+def follow_camera_status():
+    """API tier: follow the camera states reported by the capture nodes"""
+    while True:
+        try:
+            for status in broker.reports('camera_status:').values():
+                camera_registry.update(status)
+        except Exception as e:
+            logger.error(f"Error reading camera states: {e}")
+        time.sleep(PROBE_INTERVAL / 2)
+
+def report_camera_status(status):
+    # unavailable cameras are probed less often, their report must outlive the longest probe interval
+    broker.report(f"camera_status:{status['camera_index']}", status, ttl=2 * PROBE_MAX_INTERVAL)
+
+def start_background(target, name):
+    thread = threading.Thread(target=target, name=name, daemon=True)
+    thread.start()
+    return thread
+
+def start_services():
+    """Start the background services of this process's ROLE, before serving requests"""
+    if broker is None:
+        camera_registry.start()
+        return
+    
+    logger.info(f"Distributed mode: role {ROLE}, node {NODE_NAME}, broker {describe(BROKER_URL)}")
+    if ROLE in ('all', 'capture'):
+        if ROLE == 'capture':
+            camera_registry.on_probe = report_camera_status
+        camera_registry.start()
+        # cameras are classified continuously, not only while watched
+        for camera_index in configured_cameras():
+            get_pipeline(camera_index)
+    if ROLE == 'all':
+        for i in range(int(os.environ.get('WORKER_THREADS', 1))):
+            start_background(run_worker, f'inference-worker-{i}')
+    if ROLE in ('all', 'api'):
+        start_background(consume_results, 'results-consumer')
+        start_background(follow_camera_status, 'camera-status-follower')
+        clients.start()
+
+def is_admin_request():
+    """Admin endpoints require the ADMIN_TOKEN header if configured, else a local client"""
+    token = os.environ.get('ADMIN_TOKEN')
+    if token:
+        return request.headers.get('X-Admin-Token') == token
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+@app.route('/admin/profile', methods=['POST'])
+def admin_profile():
+    """
+    Profile the running server for a bounded window.
+    mode=sample returns collapsed stacks for flamegraphs, mode=trace a Chrome trace of the pipeline stages.
+    """
+    if not is_admin_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    try:
+        params = request.get_json(silent=True) or request.args
+        mode = params.get('mode', 'sample')
+        seconds = float(params.get('seconds', 10))
+        interval = float(params.get('interval_ms', 5)) / 1000
+        
+        logger.info(f"Starting {mode} profile for {seconds}s")
+        result = profiler.capture(mode, seconds, interval)
+        if result is None:
+            return jsonify({'error': 'A profiling session is already running'}), 409
+        
+        if mode == 'sample':
+            return Response(result, mimetype='text/plain')
+        return jsonify(result)
+    
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error while profiling: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics"""
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -361,9 +778,28 @@ def test_detection():
         logger.error(f"Error in test detection: {e}")
         return jsonify({'error': str(e)}), 500
 
+def overloaded_response():
+    """Shed load when the inference endpoints are saturated, instead of queueing"""
+    response = jsonify({'error': 'Server overloaded, retry later'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+def rate_limit(endpoint):
+    """Returns a 429 response if the client exceeded its rate limit on `endpoint`, else None"""
+    wait = rate_limiter.check(request.remote_addr, endpoint)
+    if not wait:
+        return None
+    response = jsonify({'error': 'Too many requests, retry later'})
+    response.headers['Retry-After'] = str(max(1, int(wait + 0.999)))
+    return response, 429
+
 @app.route('/detect', methods=['POST'])
 def detect():
     """Process image and return classification results"""
+    start = time.perf_counter()
+    limited = rate_limit('detect')
+    if limited:
+        return limited
     try:
         data = request.get_json()
         
@@ -379,8 +815,13 @@ def detect():
         # Get confidence threshold from request (default 0.5)
         confidence_threshold = data.get('confidence_threshold', 0.5)
         
-        # Perform classification
-        detections, all_predictions = classify_image(frame, confidence_threshold)
+        # Perform classification, unless the inference endpoints are already saturated
+        if not api_gate.try_enter():
+            return overloaded_response()
+        try:
+            detections, all_predictions = classify_image(frame, confidence_threshold)
+        finally:
+            api_gate.leave()
         
         # Get frame dimensions for frontend reference
         height, width = frame.shape[:2]
@@ -397,8 +838,11 @@ def detect():
             'model_type': 'classification'  # Indicate this is classification
         }
         
+        metrics.REQUEST_SECONDS.labels('detect').observe(time.perf_counter() - start)
         return jsonify(response)
     
+    except Overloaded:
+        return overloaded_response()
     except Exception as e:
         logger.error(f"Error in detect endpoint: {e}")
         return jsonify({'error': str(e)}), 500
@@ -406,33 +850,49 @@ def detect():
 @app.route('/detect_stream', methods=['POST'])
 def detect_stream():
     """Stream endpoint for continuous classification"""
+    start = time.perf_counter()
+    limited = rate_limit('detect_stream')
+    if limited:
+        return limited
     try:
         data = request.get_json()
         
         if not data or 'frames' not in data:
             return jsonify({'error': 'No frame data provided'}), 400
         
+        if len(data['frames']) > MAX_STREAM_FRAMES:
+            return jsonify({'error': f'Too many frames, at most {MAX_STREAM_FRAMES} per request'}), 413
+        
+        if not api_gate.try_enter():
+            return overloaded_response()
+        
         results = []
         confidence_threshold = data.get('confidence_threshold', 0.5)
         
-        for frame_data in data['frames']:
-            frame = decode_base64_image(frame_data['image'])
-            
-            if frame is not None:
-                detections, all_predictions = classify_image(frame, confidence_threshold)
+        try:
+            for frame_data in data['frames']:
+                frame = decode_base64_image(frame_data['image'])
                 
-                results.append({
-                    'frame_id': frame_data.get('frame_id'),
-                    'detections': detections,
-                    'all_predictions': all_predictions,
-                    'timestamp': frame_data.get('timestamp')
-                })
+                if frame is not None:
+                    detections, all_predictions = classify_image(frame, confidence_threshold)
+                    
+                    results.append({
+                        'frame_id': frame_data.get('frame_id'),
+                        'detections': detections,
+                        'all_predictions': all_predictions,
+                        'timestamp': frame_data.get('timestamp')
+                    })
+        finally:
+            api_gate.leave()
         
+        metrics.REQUEST_SECONDS.labels('detect_stream').observe(time.perf_counter() - start)
         return jsonify({
             'results': results,
             'model_type': 'classification'
         })
     
+    except Overloaded:
+        return overloaded_response()
     except Exception as e:
         logger.error(f"Error in detect_stream endpoint: {e}")
         return jsonify({'error': str(e)}), 500
@@ -463,12 +923,15 @@ def model_info():
         return jsonify({'error': str(e)}), 500
 
 # API endpoints that the frontend expects
+def camera_connected(camera_index):
+    return camera_registry.status(camera_index)['status'] in ('connected', 'available')
+
 @app.route('/api/model-status', methods=['GET'])
 def api_model_status():
     """Get model status for dashboard"""
     try:
-        # Check if main camera (index 0) is available
-        camera_status = 'connected' if 0 in cameras or initialize_camera(0) else 'disconnected'
+        # Cached state of the main camera (index 0)
+        camera_status = 'connected' if camera_connected(0) else 'disconnected'
         
         status = {
             'status': 'loaded' if model is not None else 'error',
@@ -476,7 +939,7 @@ def api_model_status():
             'camera_status': camera_status,
             'classes': class_names,
             'num_classes': len(class_names) if class_names else 0,
-            'connected_clients': connected_clients
+            'connected_clients': clients.total()
         }
         
         return jsonify(status)
@@ -488,9 +951,10 @@ def api_model_status():
 def api_history():
     """Get detection history"""
     try:
+        detections = recent_detections()
         return jsonify({
-            'detections': detection_history,
-            'total': len(detection_history)
+            'detections': detections,
+            'total': len(detections)
         })
     except Exception as e:
         logger.error(f"Error getting history: {e}")
@@ -524,58 +988,64 @@ def api_camera_initialize(camera_index):
 
 @app.route('/api/camera/check/<int:camera_index>', methods=['GET'])
 def api_camera_check(camera_index):
-    """Check if a camera is available"""
+    """Check if a camera is available, from the state cached by the camera registry"""
     try:
-        available = camera_index in cameras
-        if not available:
-            # Try to test the camera
-            cap = cv2.VideoCapture(camera_index)
-            available = cap.isOpened()
-            if available:
-                cap.release()
+        status = camera_registry.status(camera_index)
+        metrics.CACHE_REQUESTS.labels('camera_status', 'miss' if status['status'] == 'unknown' else 'hit').inc()
         
         return jsonify({
-            'available': available,
-            'camera_index': camera_index
+            'available': status['status'] in ('connected', 'available'),
+            'camera_index': camera_index,
+            'status': status['status'],
+            'checked_at': status['checked_at']
         })
     except Exception as e:
         logger.error(f"Error checking camera {camera_index}: {e}")
         return jsonify({'available': False, 'error': str(e)})
 
+@app.route('/api/cameras', methods=['GET'])
+def api_cameras():
+    """Cached state of all the known cameras"""
+    return jsonify({'cameras': camera_registry.all()})
+
 # Video streaming endpoints
 @app.route('/stream')
 def video_stream():
     """Main camera stream"""
-    return Response(generate_frames(0), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return video_stream_by_index(0)
 
 @app.route('/stream/<int:camera_index>')
 def video_stream_by_index(camera_index):
-    """Stream from specific camera"""
-    return Response(generate_frames(camera_index), mimetype='multipart/x-mixed-replace; boundary=frame')
+    """Stream from specific camera, at the rendition given by ?rendition= (full by default)"""
+    if broker is not None and ROLE not in ('all', 'capture'):
+        return jsonify({'error': 'Streams are served by the capture nodes'}), 404
+    renditions = camera_settings(camera_index).renditions
+    rendition = request.args.get('rendition', 'full' if 'full' in renditions else next(iter(renditions)))
+    if rendition not in renditions:
+        return jsonify({'error': f'Unknown rendition {rendition}, expected one of {sorted(renditions)}'}), 400
+    return Response(generate_frames(camera_index, rendition), mimetype='multipart/x-mixed-replace; boundary=frame')
 
 # Socket.IO event handlers
 @socketio.on('connect')
 def handle_connect():
-    global connected_clients
-    connected_clients += 1
-    logger.info(f'Client connected. Total clients: {connected_clients}')
+    count = clients.connect()
+    logger.info(f'Client connected. Clients of this process: {count}')
     emit('status', {'connected': True, 'message': 'Connected to weapon detection system'})
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    global connected_clients
-    connected_clients -= 1
-    logger.info(f'Client disconnected. Total clients: {connected_clients}')
+    count = clients.disconnect()
+    logger.info(f'Client disconnected. Clients of this process: {count}')
 
 @socketio.on('request_status')
 def handle_status_request():
     """Handle status requests from clients"""
     try:
-        camera_status = 'connected' if 0 in cameras else 'disconnected'
+        camera_status = 'connected' if camera_connected(0) else 'disconnected'
         status = {
             'model_loaded': model is not None,
             'camera_status': camera_status,
-            'detections_count': len(detection_history),
+            'detections_count': len(recent_detections()),
             'timestamp': datetime.now().isoformat()
         }
         emit('status_update', status)
@@ -589,32 +1059,42 @@ def cleanup_cameras():
     with camera_lock:
         for camera_index in list(cameras.keys()):
             try:
-                cameras[camera_index].release()
+                cameras[camera_index].stop()
                 logger.info(f"Released camera {camera_index}")
             except Exception as e:
                 logger.error(f"Error releasing camera {camera_index}: {e}")
         cameras.clear()
 
 if __name__ == '__main__':
+    if broker is not None and ROLE == 'worker':
+        # Stateless inference worker of the distributed mode, no server
+        try:
+            run_worker()
+        except KeyboardInterrupt:
+            logger.info("Shutting down worker...")
+        raise SystemExit(0)
+    
     logger.info("Starting Weapon Detection API Server...")
     logger.info(f"Model loaded: {model is not None}")
     logger.info(f"Model classes: {class_names}")
     
     # Initialize the main camera (camera 0) on startup
-    if initialize_camera(0):
-        logger.info("Main camera (0) initialized successfully")
-    else:
-        logger.warning("Main camera (0) could not be initialized - will try again on first request")
+    if ROLE in ('all', 'capture'):
+        if not initialize_camera(0):
+            logger.warning("Main camera (0) could not be initialized - will try again on first request")
+    start_services()
     
+    host = os.environ.get('HOST', 'localhost')  # Use localhost for frontend compatibility
+    port = int(os.environ.get('PORT', 5000))
     try:
-        logger.info("Server starting on http://127.0.0.1:5000")
+        logger.info(f"Server starting on http://{host}:{port}")
         logger.info("Frontend dashboard: http://localhost:3000/dashboard")
         
         # Run the Flask-SocketIO app with threading mode for stability
         socketio.run(
             app,
-            host='localhost',  # Use localhost for frontend compatibility
-            port=5000,
+            host=host,
+            port=port,
             debug=False,  # Disable debug for production stability
             use_reloader=False,  # Disable auto-reloader
             log_output=True
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+Load-testing and latency benchmark for the weapon detection backend.
+
+The server is started in a child process with synthetic cameras instead of real
+devices, then N concurrent clients drive it for a fixed duration:
+    * /detect          single-image classification requests
+    * /detect_stream   batches of frames per request
+    * /stream/<index>  MJPEG viewers
+    * Socket.IO        clients listening to `detection_result` events
+
+The report contains the end-to-end latency percentiles of each client type, the
+FPS achieved per camera, and the CPU and RSS of the server process. It is written
+as JSON so that two runs can be compared with --compare.
+
+Usage:
+    python benchmark_backend.py --cameras 2 --detect-clients 4 --mjpeg-clients 4 --duration 30
+    python benchmark_backend.py --output after.json --compare before.json
+"""
+
+import argparse
+import base64
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+import requests
+
+
+class SyntheticCapture:
+    """
+    A stand-in for `cv2.VideoCapture` that produces frames at a fixed rate.
+    A small set of frames is generated once and cycled, so producing a frame costs almost nothing.
+    """
+
+    def __init__(self, camera_index, width=640, height=480, fps=30):
+        self.camera_index = camera_index
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.opened = True
+        self.index = 0
+        self.next_time = time.perf_counter()
+
+        rng = np.random.default_rng(camera_index)
+        self.frames = []
+        for i in range(30):
+            frame = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+            x = int((width - 100) * i / 30)
+            cv2.rectangle(frame, (x, height // 3), (x + 100, height // 3 + 60), (0, 0, 0), -1)
+            self.frames.append(frame)
+
+    def isOpened(self):
+        return self.opened
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            self.width = int(value)
+        elif prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            self.height = int(value)
+        elif prop == cv2.CAP_PROP_FPS:
+            self.fps = value
+        return True
+
+    def get(self, prop):
+        return {cv2.CAP_PROP_FRAME_WIDTH: self.width, cv2.CAP_PROP_FRAME_HEIGHT: self.height,
+                cv2.CAP_PROP_FPS: self.fps}.get(prop, 0)
+
+    def grab(self):
+        if not self.opened:
+            return False
+        # pace the frames like a real camera would
+        delay = self.next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_time = max(self.next_time + 1 / self.fps, time.perf_counter())
+        self.index += 1
+        return True
+
+    def retrieve(self):
+        frame = self.frames[self.index % len(self.frames)]
+        if frame.shape[:2] != (self.height, self.width):
+            frame = cv2.resize(frame, (self.width, self.height))
+        return True, frame.copy()
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def release(self):
+        self.opened = False
+
+
+def serve(args):
+    """
+    Run the backend with synthetic cameras. Executed in the child process.
+    """
+
+    # all the load-test clients share one address: measure the capacity rather than the
+    # per-client rate limits, unless RATE_LIMIT_<ENDPOINT> is set explicitly
+    os.environ.setdefault('RATE_LIMIT_DETECT', '1000000:1000000')
+    os.environ.setdefault('RATE_LIMIT_DETECT_STREAM', '1000000:1000000')
+
+    from werkzeug.serving import make_server
+    import app as backend
+
+    backend.open_capture = lambda source: SyntheticCapture(source, args.width, args.height, args.fps)
+    for camera_index in range(args.cameras):
+        backend.initialize_camera(camera_index)
+    backend.start_services()
+
+    server = make_server(args.host, args.port, backend.app, threaded=True)
+    print('READY', flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        backend.cleanup_cameras()
+
+
+def percentiles(values):
+    """
+    Summarize a list of latencies in milliseconds.
+    """
+
+    if not values:
+        return {'count': 0}
+    values = np.asarray(values)
+    return {
+        'count': int(len(values)),
+        'mean': round(float(values.mean()), 2),
+        'p50': round(float(np.percentile(values, 50)), 2),
+        'p90': round(float(np.percentile(values, 90)), 2),
+        'p95': round(float(np.percentile(values, 95)), 2),
+        'p99': round(float(np.percentile(values, 99)), 2),
+        'max': round(float(values.max()), 2),
+    }
+
+
+class LoadTest:
+    """
+    Drive the running server with concurrent clients and collect the measures.
+    """
+
+    def __init__(self, args, base_url):
+        self.args = args
+        self.base_url = base_url
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.latencies = {'detect': [], 'detect_stream': [], 'mjpeg_frame_interval': [], 'socketio_event': []}
+        self.errors = {'detect': 0, 'detect_stream': 0, 'mjpeg': 0, 'socketio': 0}
+        self.status_codes = {}
+        self.mjpeg_frames = {}
+        self.socketio_events = 0
+
+        frame = SyntheticCapture(0, args.width, args.height).frames[0]
+        _, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
+        self.image = 'data:image/jpeg;base64,' + base64.b64encode(buffer.tobytes()).decode()
+
+    def record(self, kind, latency_ms=None, error=False, status=None):
+        with self.lock:
+            if latency_ms is not None:
+                self.latencies[kind].append(latency_ms)
+            if error:
+                self.errors[kind] += 1
+            if status is not None:
+                self.status_codes[status] = self.status_codes.get(status, 0) + 1
+
+    def detect_client(self):
+        session = requests.Session()
+        while not self.stop.is_set():
+            start = time.perf_counter()
+            try:
+                response = session.post(f'{self.base_url}/detect', json={'image': self.image}, timeout=30)
+                ok = response.status_code == 200
+                self.record('detect', (time.perf_counter() - start) * 1000 if ok else None, not ok,
+                            response.status_code)
+            except requests.RequestException:
+                self.record('detect', error=True)
+
+    def detect_stream_client(self):
+        session = requests.Session()
+        frames = [{'image': self.image, 'frame_id': i} for i in range(self.args.stream_batch)]
+        while not self.stop.is_set():
+            start = time.perf_counter()
+            try:
+                response = session.post(f'{self.base_url}/detect_stream', json={'frames': frames}, timeout=60)
+                ok = response.status_code == 200
+                self.record('detect_stream', (time.perf_counter() - start) * 1000 if ok else None, not ok,
+                            response.status_code)
+            except requests.RequestException:
+                self.record('detect_stream', error=True)
+
+    def mjpeg_client(self, camera_index):
+        key = str(camera_index)
+        try:
+            response = requests.get(f'{self.base_url}/stream/{camera_index}',
+                                    params={'rendition': self.args.rendition}, stream=True, timeout=30)
+            buffer = b''
+            last = None
+            for chunk in response.iter_content(chunk_size=16384):
+                if self.stop.is_set():
+                    break
+                buffer += chunk
+                # every part ends with the JPEG end-of-image marker followed by CRLF
+                while True:
+                    end = buffer.find(b'\xff\xd9\r\n')
+                    if end < 0:
+                        break
+                    buffer = buffer[end + 4:]
+                    now = time.perf_counter()
+                    with self.lock:
+                        self.mjpeg_frames[key] = self.mjpeg_frames.get(key, 0) + 1
+                        if last is not None:
+                            self.latencies['mjpeg_frame_interval'].append((now - last) * 1000)
+                    last = now
+            response.close()
+        except requests.RequestException:
+            self.record('mjpeg', error=True)
+
+    def socketio_client(self):
+        try:
+            import socketio
+        except ImportError:
+            print('python-socketio is not installed, skipping the Socket.IO clients')
+            return
+
+        client = socketio.Client(reconnection=False)
+
+        @client.on('detection_result')
+        def on_detection(data):
+            try:
+                sent = datetime.fromisoformat(data['timestamp'])
+                latency = (datetime.now() - sent).total_seconds() * 1000
+            except (KeyError, ValueError):
+                latency = None
+            with self.lock:
+                self.socketio_events += 1
+            self.record('socketio_event', latency)
+
+        try:
+            client.connect(self.base_url)
+            self.stop.wait()
+            client.disconnect()
+        except Exception:
+            self.record('socketio', error=True)
+
+    def run(self, server_pid):
+        threads = []
+        for _ in range(self.args.detect_clients):
+            threads.append(threading.Thread(target=self.detect_client, daemon=True))
+        for _ in range(self.args.detect_stream_clients):
+            threads.append(threading.Thread(target=self.detect_stream_client, daemon=True))
+        for i in range(self.args.mjpeg_clients):
+            threads.append(threading.Thread(target=self.mjpeg_client, args=(i % self.args.cameras,), daemon=True))
+        for _ in range(self.args.socketio_clients):
+            threads.append(threading.Thread(target=self.socketio_client, daemon=True))
+
+        for thread in threads:
+            thread.start()
+
+        resources = self.sample_resources(server_pid)
+
+        self.stop.set()
+        for thread in threads:
+            thread.join(timeout=5)
+
+        duration = self.args.duration
+        report = {
+            'timestamp': datetime.now().isoformat(),
+            'config': vars(self.args),
+            'latency_ms': {kind: percentiles(values) for kind, values in self.latencies.items()},
+            'throughput_rps': {kind: round(len(self.latencies[kind]) / duration, 2)
+                               for kind in ('detect', 'detect_stream')},
+            'mjpeg_fps_per_camera': {},
+            'socketio_events_per_second': round(self.socketio_events / duration, 2),
+            'errors': self.errors,
+            'status_codes': {str(k): v for k, v in self.status_codes.items()},
+            'server': resources,
+        }
+
+        # the frames of a camera are sent to each of its viewers, so divide by the number of viewers
+        for camera_index in range(self.args.cameras):
+            viewers = len(range(camera_index, self.args.mjpeg_clients, self.args.cameras))
+            frames = self.mjpeg_frames.get(str(camera_index), 0)
+            if viewers:
+                report['mjpeg_fps_per_camera'][str(camera_index)] = round(frames / viewers / duration, 2)
+
+        return report
+
+    def sample_resources(self, pid):
+        """
+        Sample the CPU and RSS of the server process during the test.
+        """
+
+        try:
+            import psutil
+        except ImportError:
+            print('psutil is not installed, CPU and RSS will not be reported')
+            time.sleep(self.args.duration)
+            return {}
+
+        process = psutil.Process(pid)
+        process.cpu_percent(None)
+        cpu, rss = [], []
+        end = time.perf_counter() + self.args.duration
+        while time.perf_counter() < end:
+            time.sleep(0.5)
+            cpu.append(process.cpu_percent(None))
+            rss.append(process.memory_info().rss / 2 ** 20)
+
+        return {
+            'cpu_percent_mean': round(float(np.mean(cpu)), 1) if cpu else None,
+            'cpu_percent_max': round(float(np.max(cpu)), 1) if cpu else None,
+            'rss_mb_mean': round(float(np.mean(rss)), 1) if rss else None,
+            'rss_mb_max': round(float(np.max(rss)), 1) if rss else None,
+        }
+
+
+def compare(report, baseline_path):
+    """
+    Print the relative change of the main metrics against a previous report.
+    """
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    print(f"\nComparison with {baseline_path}:")
+    for kind, stats in report['latency_ms'].items():
+        before = baseline.get('latency_ms', {}).get(kind, {})
+        for p in ('p50', 'p95', 'p99'):
+            if p in stats and before.get(p):
+                change = (stats[p] - before[p]) / before[p] * 100
+                print(f"  {kind} {p}: {before[p]} -> {stats[p]} ms ({change:+.1f}%)")
+    for key in ('cpu_percent_mean', 'rss_mb_max'):
+        before, after = baseline.get('server', {}).get(key), report['server'].get(key)
+        if before and after is not None:
+            print(f"  server {key}: {before} -> {after} ({(after - before) / before * 100:+.1f}%)")
+
+
+def main(args):
+    base_url = f'http://{args.host}:{args.port}'
+    command = [sys.executable, os.path.abspath(__file__), '--serve'] + [
+        f'--{k.replace("_", "-")}={v}' for k, v in (('host', args.host), ('port', args.port),
+                                                    ('cameras', args.cameras), ('width', args.width),
+                                                    ('height', args.height), ('fps', args.fps))]
+    server_log = open(args.server_log, 'w')
+    server = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE,
+                              stderr=server_log, text=True)
+    try:
+        # wait for the model to load and the server to listen
+        for line in server.stdout:
+            if line.strip() == 'READY':
+                break
+        else:
+            raise SystemExit('The server exited before it was ready')
+
+        print(f"Running load test for {args.duration}s against {base_url}")
+        report = LoadTest(args, base_url).run(server.pid)
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+        server_log.close()
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(json.dumps({k: report[k] for k in ('latency_ms', 'mjpeg_fps_per_camera', 'server')}, indent=2))
+    print(f"Report written to {os.path.abspath(args.output)}")
+
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load-test the weapon detection backend with synthetic cameras')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--cameras', type=int, default=2, help='Number of synthetic cameras')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--fps', type=float, default=30, help='Frame rate of the synthetic cameras')
+    parser.add_argument('--detect-clients', type=int, default=2, help='Concurrent /detect clients')
+    parser.add_argument('--detect-stream-clients', type=int, default=1, help='Concurrent /detect_stream clients')
+    parser.add_argument('--stream-batch', type=int, default=4, help='Frames per /detect_stream request')
+    parser.add_argument('--mjpeg-clients', type=int, default=2, help='Concurrent MJPEG viewers')
+    parser.add_argument('--rendition', default='full', help='Stream rendition requested by the MJPEG viewers')
+    parser.add_argument('--socketio-clients', type=int, default=2, help='Concurrent Socket.IO clients')
+    parser.add_argument('--duration', type=float, default=30, help='Duration of the test in seconds')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to write the JSON report')
+    parser.add_argument('--compare', default=None, help='A previous JSON report to compare against')
+    parser.add_argument('--server-log', default='benchmark_server.log', help='Where to write the server logs')
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+    else:
+        main(args)
@@ -0,0 +1,150 @@
+"""
+Message broker of the distributed mode.
+
+Capture nodes push frames to the `frames` queue, any number of stateless inference
+workers pop and classify them, and push their results to the `results` queue read by
+the API tier. Capture nodes also report the states of their cameras.
+Messages are JSON-serializable dicts; frames carry base64 JPEG images.
+
+Brokers are selected with BROKER_URL:
+    memory://             in-process queues, for tests and single-process deployments
+    redis://host:6379/0   Redis lists (requires `pip install redis`)
+
+Queues are bounded: when a queue is full its oldest messages are dropped, so slow
+workers skip stale frames instead of falling behind.
+
+Besides queues, brokers hold the state shared by the API processes:
+    * reports: values with an expiry, e.g. the client count of each process
+    * lists of recent items, e.g. the detection history
+"""
+
+import json
+import threading
+import time
+from collections import deque
+
+import metrics
+
+FRAMES = 'frames'
+RESULTS = 'results'
+
+
+class InProcessBroker:
+    """Queues shared by the threads of one process."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.queues = {}
+        self.condition = threading.Condition()
+        self.values = {}
+        self.lists = {}
+
+    def _queue(self, name):
+        queue = self.queues.get(name)
+        if queue is None:
+            queue = self.queues[name] = deque()
+            metrics.QUEUE_DEPTH.labels(f'broker_{name}').set_function(lambda: len(queue))
+        return queue
+
+    def push(self, name, message):
+        with self.condition:
+            queue = self._queue(name)
+            dropped = len(queue) >= self.maxsize
+            if dropped:
+                queue.popleft()
+            queue.append(message)
+            self.condition.notify_all()
+        if dropped:
+            metrics.QUEUE_DROPPED.labels(f'broker_{name}', 'drop_oldest').inc()
+
+    def pop(self, name, timeout=1.0):
+        """The oldest message of a queue, or None if none arrived within `timeout` seconds."""
+        with self.condition:
+            queue = self._queue(name)
+            if not self.condition.wait_for(lambda: queue, timeout):
+                return None
+            return queue.popleft()
+
+    def report(self, key, value, ttl):
+        """Set a value that expires after `ttl` seconds."""
+        with self.condition:
+            self.values[key] = (value, time.monotonic() + ttl)
+
+    def reports(self, prefix):
+        """The unexpired values whose key starts with `prefix`."""
+        now = time.monotonic()
+        with self.condition:
+            return {key: value for key, (value, expires) in self.values.items()
+                    if key.startswith(prefix) and expires > now}
+
+    def record(self, name, item, limit):
+        """Add an item in front of a list holding the `limit` most recent items."""
+        with self.condition:
+            items = self.lists.get(name)
+            if items is None or items.maxlen != limit:
+                items = self.lists[name] = deque(items or (), maxlen=limit)
+            items.appendleft(item)
+
+    def recent(self, name):
+        """The items of a list, most recent first."""
+        with self.condition:
+            return list(self.lists.get(name, ()))
+
+    def length(self, name):
+        """The number of items of a list."""
+        with self.condition:
+            return len(self.lists.get(name, ()))
+
+
+class RedisBroker:
+    """Queues stored in Redis lists, shared by all the nodes."""
+
+    def __init__(self, url, maxsize=256):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("BROKER_URL=redis://... requires the redis package: pip install redis")
+        self.client = redis.Redis.from_url(url)
+        self.maxsize = maxsize
+
+    def push(self, name, message):
+        pipeline = self.client.pipeline()
+        pipeline.rpush(name, json.dumps(message))
+        # keep the newest `maxsize` messages
+        pipeline.ltrim(name, -self.maxsize, -1)
+        pipeline.execute()
+
+    def pop(self, name, timeout=1.0):
+        item = self.client.blpop(name, timeout=max(1, int(timeout)))
+        return json.loads(item[1]) if item else None
+
+    def report(self, key, value, ttl):
+        self.client.setex(key, int(ttl), json.dumps(value))
+
+    def reports(self, prefix):
+        keys = list(self.client.scan_iter(match=f'{prefix}*'))
+        if not keys:
+            return {}
+        return {key.decode(): json.loads(value) for key, value in zip(keys, self.client.mget(keys))
+                if value is not None}
+
+    def record(self, name, item, limit):
+        pipeline = self.client.pipeline()
+        pipeline.lpush(name, json.dumps(item))
+        pipeline.ltrim(name, 0, limit - 1)
+        pipeline.execute()
+
+    def recent(self, name):
+        return [json.loads(item) for item in self.client.lrange(name, 0, -1)]
+
+    def length(self, name):
+        return self.client.llen(name)
+
+
+def connect(url, maxsize=256):
+    """Return the broker of a BROKER_URL."""
+    if url.startswith('memory://'):
+        return InProcessBroker(maxsize)
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisBroker(url, maxsize)
+    raise ValueError(f"Unsupported BROKER_URL {url}, expected memory:// or redis://")
@@ -0,0 +1,122 @@
+"""
+Running several API processes behind a load balancer.
+
+* Socket.IO broadcasts go through a message queue, SOCKETIO_MESSAGE_QUEUE, so that an
+  event emitted by one process reaches the clients of all of them. Any URL supported by
+  python-socketio works (redis://, amqp://, kafka://, zmq+tcp://); `memory://` is an
+  in-process stand-in connecting the Socket.IO servers of one process, for tests.
+* ClientCounter counts the Socket.IO clients of this process, and of all the API
+  processes when a broker is configured: each process reports its own count with an
+  expiry, so the count of a crashed process disappears by itself.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+
+import socketio
+
+logger = logging.getLogger(__name__)
+
+# seconds between two reports of the client count, which expire after 3 intervals
+REPORT_INTERVAL = 10.0
+
+
+class InProcessManager(socketio.PubSubManager):
+    """A Socket.IO message queue between the servers of the same process."""
+
+    name = 'memory'
+    channels = {}
+    lock = threading.Lock()
+
+    def __init__(self, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.messages = queue.Queue()
+        with self.lock:
+            self.channels.setdefault(channel, []).append(self.messages)
+
+    def _publish(self, data):
+        with self.lock:
+            subscribers = list(self.channels[self.channel])
+        for messages in subscribers:
+            messages.put(data)
+
+    def _listen(self):
+        while True:
+            yield self.messages.get()
+
+
+def socketio_options():
+    """The keyword arguments of SocketIO() for SOCKETIO_MESSAGE_QUEUE, if set."""
+    url = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+    if not url:
+        return {}
+    if url.startswith('memory://'):
+        return {'client_manager': InProcessManager()}
+    return {'message_queue': url}
+
+
+class ClientCounter:
+    """
+    Thread-safe count of the connected Socket.IO clients.
+
+    :param broker: a broker of broker.py to share the count with the other processes, or None.
+    :param node: the name of this process in the reports.
+    """
+
+    def __init__(self, broker=None, node=None):
+        self.broker = broker
+        self.key = f'clients:{node}:{os.getpid()}'
+        self.count = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def connect(self):
+        with self.lock:
+            self.count += 1
+            count = self.count
+        self._report(count)
+        return count
+
+    def disconnect(self):
+        with self.lock:
+            self.count = max(self.count - 1, 0)
+            count = self.count
+        self._report(count)
+        return count
+
+    def local(self):
+        return self.count
+
+    def total(self):
+        """Clients of all the API processes."""
+        if self.broker is None:
+            return self.count
+        try:
+            others = sum(count for key, count in self.broker.reports('clients:').items() if key != self.key)
+        except Exception as e:
+            logger.warning(f"Could not read the client counts of the other processes: {e}")
+            others = 0
+        return self.count + others
+
+    def _report(self, count):
+        if self.broker is None:
+            return
+        try:
+            self.broker.report(self.key, count, ttl=3 * REPORT_INTERVAL)
+        except Exception as e:
+            logger.warning(f"Could not report the client count: {e}")
+
+    def start(self):
+        """Refresh the report of this process before it expires."""
+        if self.broker is None or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run, name='client-counter', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            self._report(self.count)
+            time.sleep(REPORT_INTERVAL)
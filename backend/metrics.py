@@ -0,0 +1,214 @@
+"""
+Low-overhead metrics for the weapon detection backend, exposed in the Prometheus text format.
+
+Recording a value only looks up a pre-built child and updates a few numbers under a lock:
+no string formatting happens on the hot path. Labels are resolved once, e.g.
+
+    capture_seconds = STAGE_SECONDS.labels('0', 'capture')
+    capture_seconds.observe(elapsed)
+
+and all the text is built when /metrics is scraped.
+"""
+
+import bisect
+import threading
+
+# latency buckets in seconds, from 1 ms to 5 s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class _CounterChild:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ('value', 'function', 'lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set_function(self, function):
+        """Read the value from `function` when the metrics are scraped."""
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count', 'lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            self.children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Return the child for these label values, creating it on first use. Keep the result on hot paths."""
+        key = tuple(str(v) for v in values)
+        child = self.children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self.lock:
+                child = self.children.setdefault(key, self._new_child())
+        return child
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, child in list(self.children.items()):
+            lines.extend(self._render_child(key, child))
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def _render_child(self, key, child):
+        return [f'{self.name}{self._label_text(key)} {child.value}']
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self.children[()].set(value)
+
+    def set_function(self, function):
+        self.children[()].set_function(function)
+
+    def _render_child(self, key, child):
+        return [f'{self.name}{self._label_text(key)} {child.get()}']
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+    def _render_child(self, key, child):
+        with child.lock:
+            counts, total, count = list(child.counts), child.sum, child.count
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{self.name}_bucket{self._label_text(key, [("le", le)])} {cumulative}')
+        lines.append(f'{self.name}_sum{self._label_text(key)} {total}')
+        lines.append(f'{self.name}_count{self._label_text(key)} {count}')
+        return lines
+
+
+class Registry:
+    """A collection of metrics rendered together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'codeverse_stage_seconds', 'Time spent in each pipeline stage', ('camera', 'stage')))
+FRAMES_CAPTURED = REGISTRY.register(Counter(
+    'codeverse_frames_captured_total', 'Frames read from the camera', ('camera',)))
+FRAMES_DROPPED = REGISTRY.register(Counter(
+    'codeverse_frames_dropped_total', 'Frames lost before reaching the viewers', ('camera', 'reason')))
+CAMERA_RECONNECTS = REGISTRY.register(Counter(
+    'codeverse_camera_reconnects_total', 'Attempts to reconnect a failed camera', ('camera',)))
+FRAMES_CLASSIFIED = REGISTRY.register(Counter(
+    'codeverse_frames_classified_total', 'Frames sent to the model', ('camera',)))
+DETECTIONS = REGISTRY.register(Counter(
+    'codeverse_detections_total', 'Detections emitted to the clients', ('camera', 'class_name')))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'codeverse_queue_depth', 'Items waiting in a pipeline queue', ('queue',)))
+QUEUE_DROPPED = REGISTRY.register(Counter(
+    'codeverse_queue_dropped_total', 'Items dropped or rejected by a bounded queue', ('queue', 'policy')))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    'codeverse_cache_requests_total', 'Cache lookups by result (hit or miss)', ('cache', 'result')))
+CONNECTED_CLIENTS = REGISTRY.register(Gauge(
+    'codeverse_connected_clients', 'Socket.IO clients currently connected'))
+ACTIVE_STREAMS = REGISTRY.register(Gauge(
+    'codeverse_active_streams', 'MJPEG viewers currently streaming', ('camera',)))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'codeverse_request_seconds', 'Latency of the inference endpoints', ('endpoint',)))
@@ -0,0 +1,355 @@
+"""
+Bounded, load-shedding camera pipeline.
+
+Each camera runs one pipeline shared by all its viewers:
+
+    capture ──> [inference queue] ──> inference ──> [emit queue] ──> Socket.IO
+        └─────> [encode queue] ──> encode ──> FrameBroadcast per rendition ──> MJPEG viewers
+
+Every queue is bounded and has a drop policy, so under overload the pipeline
+sheds frames instead of accumulating lag and memory:
+    * drop_oldest: when full, discard the oldest item to make room for the new one
+    * keep_latest: discard everything pending, so the consumer only sees the newest item
+    * reject:      refuse the new item (the caller answers 429/503)
+Policies and sizes are configured per stage with PIPELINE_QUEUE_<STAGE>=<policy>:<size>,
+e.g. PIPELINE_QUEUE_EMIT=drop_oldest:512. The api stage limits requests in flight, which
+cannot wait in a queue: it always rejects, and only its size can be changed (PIPELINE_QUEUE_API=reject:8).
+Every drop is counted in /metrics.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import metrics
+from renditions import Frame
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ('drop_oldest', 'keep_latest', 'reject')
+
+# default (policy, size) of each stage
+DEFAULT_QUEUES = {
+    'inference': ('keep_latest', 1),
+    'encode': ('keep_latest', 1),
+    'emit': ('drop_oldest', 256),
+    'api': ('reject', 4),
+}
+
+
+class Empty(Exception):
+    """Raised by BoundedQueue.get() when no item arrived before the timeout."""
+
+
+def queue_config(stage):
+    """Read the (policy, size) of a stage from PIPELINE_QUEUE_<STAGE>, or use the default."""
+    policy, size = DEFAULT_QUEUES[stage]
+    value = os.environ.get(f'PIPELINE_QUEUE_{stage.upper()}')
+    if value:
+        try:
+            policy, size = value.split(':')
+            size = int(size)
+        except ValueError:
+            logger.warning(f"Invalid PIPELINE_QUEUE_{stage.upper()}={value}, expected <policy>:<size>")
+            policy, size = DEFAULT_QUEUES[stage]
+    if policy not in POLICIES or size < 1:
+        logger.warning(f"Invalid queue configuration for {stage}: {policy}:{size}")
+        policy, size = DEFAULT_QUEUES[stage]
+    return policy, size
+
+
+class BoundedQueue:
+    """A thread-safe FIFO with a maximum size and a drop policy."""
+
+    def __init__(self, name, stage):
+        self.name = name
+        self.policy, self.maxsize = queue_config(stage)
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.dropped = metrics.QUEUE_DROPPED.labels(name, self.policy)
+        self.depth = metrics.QUEUE_DEPTH.labels(name)
+        self.depth.set_function(self.qsize)
+
+    def qsize(self):
+        return len(self.items)
+
+    def put(self, item):
+        """Add an item. Returns False if it was rejected."""
+        with self.condition:
+            if self.policy == 'keep_latest':
+                dropped = len(self.items)
+                self.items.clear()
+            elif len(self.items) >= self.maxsize:
+                if self.policy == 'reject':
+                    self.dropped.inc()
+                    return False
+                self.items.popleft()
+                dropped = 1
+            else:
+                dropped = 0
+            self.items.append(item)
+            self.condition.notify()
+        if dropped:
+            self.dropped.inc(dropped)
+        return True
+
+    def get(self, timeout=None):
+        """Remove and return the oldest item, waiting up to `timeout` seconds."""
+        with self.condition:
+            if not self.items and not self.condition.wait_for(lambda: self.items, timeout):
+                raise Empty()
+            return self.items.popleft()
+
+    def close(self):
+        """Stop reporting the depth of a queue that is no longer used."""
+        self.depth.set_function(lambda: 0)
+
+
+class Gate:
+    """
+    Limits the number of requests in a stage at the same time.
+    Requests above the limit are rejected instead of queued, whatever the policy of the stage.
+    """
+
+    def __init__(self, name, stage='api'):
+        policy, self.size = queue_config(stage)
+        if policy != 'reject':
+            logger.warning(f"PIPELINE_QUEUE_{stage.upper()}: requests cannot be queued, "
+                           f"rejecting above {self.size} instead of {policy}")
+        self.policy = 'reject'
+        self.inflight = 0
+        self.lock = threading.Lock()
+        self.rejected = metrics.QUEUE_DROPPED.labels(name, 'reject')
+        metrics.QUEUE_DEPTH.labels(name).set_function(lambda: self.inflight)
+
+    def try_enter(self):
+        with self.lock:
+            if self.inflight >= self.size:
+                self.rejected.inc()
+                return False
+            self.inflight += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.inflight -= 1
+
+
+class FrameBroadcast:
+    """
+    Holds the latest encoded frame of a camera. Each viewer waits for a newer frame
+    than the one it sent last, so a slow viewer skips frames instead of slowing the camera.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.sequence = 0
+        self.frame = None
+
+    def publish(self, frame):
+        with self.condition:
+            self.frame = frame
+            self.sequence += 1
+            self.condition.notify_all()
+
+    def wait(self, last_sequence, timeout=1.0):
+        """Return (sequence, frame) of the first frame newer than `last_sequence`, or (last_sequence, None)."""
+        with self.condition:
+            if self.condition.wait_for(lambda: self.sequence > last_sequence, timeout):
+                return self.sequence, self.frame
+            return last_sequence, None
+
+
+class Emitter:
+    """Sends Socket.IO events from a bounded queue on a single background thread."""
+
+    def __init__(self, emit):
+        self.emit = emit
+        self.queue = BoundedQueue('emit', 'emit')
+        self.queue_seconds = metrics.STAGE_SECONDS.labels('all', 'emit_queue')
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def send(self, event, data):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='socketio-emitter', daemon=True)
+                self.thread.start()
+        self.queue.put((event, data, time.perf_counter()))
+
+    def _run(self):
+        while True:
+            event, data, queued = self.queue.get()
+            try:
+                self.emit(event, data)
+                self.queue_seconds.observe(time.perf_counter() - queued)
+            except Exception as e:
+                logger.error(f"Error emitting {event}: {e}")
+
+
+class CameraPipeline:
+    """
+    The capture, inference and encode threads of one camera, shared by all its viewers.
+    It stops by itself when nobody has watched the camera for `idle_timeout` seconds,
+    or runs until stopped if `idle_timeout` is None.
+
+    The work of each stage is injected:
+        * read_frame(camera_index) -> image or None
+        * placeholder(camera_index) -> image shown when the camera is unavailable
+        * classify(camera_index, frame, timers) -> detections, `frame` being a renditions.Frame
+        * annotate(image, detections, frame_size) -> image drawn before encoding, the boxes of the detections
+          being in the coordinates of the captured frame, of `frame_size` (width, height)
+        * encode(image, quality) -> bytes or None
+
+    Each rendition (see renditions.py) is resized, annotated and encoded only while it has viewers.
+    """
+
+    def __init__(self, camera_index, read_frame, placeholder, classify, annotate, encode, timers, renditions,
+                 stream_fps=15, detection_interval=5, idle_timeout=5.0, on_stop=None):
+        self.camera_index = camera_index
+        self.read_frame = read_frame
+        self.placeholder = placeholder
+        self.classify = classify
+        self.annotate = annotate
+        self.encode = encode
+        self.timers = timers
+        self.renditions = renditions
+        self.frame_interval = 1.0 / stream_fps
+        self.detection_interval = detection_interval
+        self.idle_timeout = idle_timeout
+        self.on_stop = on_stop
+
+        self.inference_queue = BoundedQueue(f'camera{camera_index}_inference', 'inference')
+        self.encode_queue = BoundedQueue(f'camera{camera_index}_encode', 'encode')
+        self.broadcasts = {name: FrameBroadcast() for name in renditions}
+        self.latest_detections = []
+
+        self.viewers = dict.fromkeys(renditions, 0)
+        self.last_viewer = time.perf_counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads = []
+
+        self.frames_captured = metrics.FRAMES_CAPTURED.labels(camera_index)
+        self.frames_classified = metrics.FRAMES_CLASSIFIED.labels(camera_index)
+        self.frames_unavailable = metrics.FRAMES_DROPPED.labels(camera_index, 'capture_failed')
+        self.frames_encode_failed = metrics.FRAMES_DROPPED.labels(camera_index, 'encode_failed')
+        self.frames_skipped = metrics.FRAMES_DROPPED.labels(camera_index, 'slow_viewer')
+
+    def start(self):
+        for name, target in (('capture', self._capture), ('inference', self._inference), ('encode', self._encode)):
+            thread = threading.Thread(target=target, name=f'camera{self.camera_index}-{name}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logger.info(f"Pipeline for camera {self.camera_index} started")
+
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.inference_queue.close()
+        self.encode_queue.close()
+        if self.on_stop is not None:
+            self.on_stop(self)
+        logger.info(f"Pipeline for camera {self.camera_index} stopped")
+
+    def add_viewer(self, rendition):
+        with self.lock:
+            self.viewers[rendition] += 1
+
+    def remove_viewer(self, rendition):
+        with self.lock:
+            self.viewers[rendition] -= 1
+            self.last_viewer = time.perf_counter()
+
+    def frames(self, rendition):
+        """Yield the encoded frames of a rendition for one viewer, skipping those it was too slow to receive."""
+        broadcast = self.broadcasts[rendition]
+        self.add_viewer(rendition)
+        sequence = broadcast.sequence
+        try:
+            while not self.stopped.is_set():
+                new_sequence, frame = broadcast.wait(sequence)
+                if frame is None:
+                    continue
+                if new_sequence - sequence > 1:
+                    self.frames_skipped.inc(new_sequence - sequence - 1)
+                sequence = new_sequence
+                yield frame
+        finally:
+            self.remove_viewer(rendition)
+
+    def _watched(self):
+        """The renditions that currently have viewers."""
+        with self.lock:
+            return [self.renditions[name] for name, viewers in self.viewers.items() if viewers]
+
+    def _idle(self):
+        if self.idle_timeout is None:
+            return False
+        with self.lock:
+            return not any(self.viewers.values()) and time.perf_counter() - self.last_viewer > self.idle_timeout
+
+    def _capture(self):
+        frame_count = 0
+        next_frame = time.perf_counter()
+        try:
+            while not self.stopped.is_set():
+                if self._idle():
+                    break
+
+                start = time.perf_counter()
+                frame = self.read_frame(self.camera_index)
+                self.timers['capture'].observe(time.perf_counter() - start)
+
+                if frame is None:
+                    self.frames_unavailable.inc()
+                    self.latest_detections = []
+                    self.encode_queue.put(Frame(self.placeholder(self.camera_index)))
+                else:
+                    frame = Frame(frame)
+                    self.frames_captured.inc()
+                    # Only perform detection every N frames to reduce processing load
+                    if frame_count % self.detection_interval == 0:
+                        self.inference_queue.put(frame)
+                    self.encode_queue.put(frame)
+                    frame_count += 1
+
+                # pace the stream at `stream_fps`
+                next_frame = max(next_frame + self.frame_interval, time.perf_counter())
+                time.sleep(max(0.0, next_frame - time.perf_counter()))
+        except Exception as e:
+            logger.error(f"Error in capture of camera {self.camera_index}: {e}")
+        finally:
+            self.stop()
+
+    def _inference(self):
+        while not self.stopped.is_set():
+            try:
+                frame = self.inference_queue.get(timeout=0.5)
+            except Empty:
+                continue
+            try:
+                self.latest_detections = self.classify(self.camera_index, frame, self.timers)
+                self.frames_classified.inc()
+            except Exception as e:
+                logger.error(f"Detection error on camera {self.camera_index}: {e}")
+
+    def _encode(self):
+        while not self.stopped.is_set():
+            try:
+                frame = self.encode_queue.get(timeout=0.5)
+            except Empty:
+                continue
+            start = time.perf_counter()
+            detections = self.latest_detections
+            for rendition in self._watched():
+                image = self.annotate(frame.resized(rendition.size), detections, (frame.shape[1], frame.shape[0]))
+                encoded = self.encode(image, rendition.quality)
+                if encoded is None:
+                    self.frames_encode_failed.inc()
+                    continue
+                self.broadcasts[rendition.name].publish(encoded)
+            self.timers['encode'].observe(time.perf_counter() - start)
@@ -0,0 +1,153 @@
+"""
+On-demand diagnostics for a running backend, enabled for a bounded window only.
+
+* SamplingProfiler: samples the Python stack of every thread at a fixed interval and
+  returns them in the collapsed format ("frame;frame;frame count") read by flamegraph.pl,
+  speedscope and most flamegraph viewers.
+* StageTracer: records each pipeline stage (capture, preprocess, inference, encode, emit)
+  of each camera as a Chrome trace event, viewable in chrome://tracing or Perfetto.
+
+When nothing is being captured the cost is a single attribute check per stage.
+"""
+
+import os
+import sys
+import threading
+import time
+
+# longest window an admin can request, in seconds
+MAX_DURATION = 60
+
+
+class SamplingProfiler:
+    """Statistical profiler based on `sys._current_frames()`."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = {}
+        self.samples = 0
+
+    def run(self, duration):
+        """Sample all the threads during `duration` seconds and return the collapsed stacks."""
+        own_thread = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        end = time.perf_counter() + duration
+
+        while time.perf_counter() < end:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = ';'.join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+        return self.collapsed()
+
+    def collapsed(self):
+        return '\n'.join(f'{stack} {count}' for stack, count in
+                         sorted(self.counts.items(), key=lambda item: -item[1])) + '\n'
+
+
+class StageTracer:
+    """Collects Chrome trace events for the pipeline stages while active."""
+
+    def __init__(self):
+        self.active = False
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.tids = {}
+
+    def start(self):
+        with self.lock:
+            self.events = []
+            self.tids = {}
+            self.origin = time.perf_counter()
+        self.active = True
+
+    def stop(self):
+        self.active = False
+        with self.lock:
+            events, self.events = self.events, []
+            tids, self.tids = self.tids, {}
+        # name the rows of the timeline after the cameras
+        names = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                  'args': {'name': f'camera {camera}'}} for camera, tid in tids.items()]
+        return {
+            'traceEvents': names + events,
+            'displayTimeUnit': 'ms',
+        }
+
+    def add(self, camera, stage, duration):
+        """Record a stage that just ended and lasted `duration` seconds."""
+        end = time.perf_counter()
+        with self.lock:
+            self.events.append({
+                'name': stage,
+                'cat': 'pipeline',
+                'ph': 'X',
+                'ts': (end - duration - self.origin) * 1e6,
+                'dur': duration * 1e6,
+                'pid': os.getpid(),
+                'tid': self.tids.setdefault(camera, len(self.tids) + 1),
+            })
+
+
+class TracedTimer:
+    """
+    A histogram child that also reports to the tracer while it is active.
+    Used in place of the plain histogram children returned by `metrics.STAGE_SECONDS.labels()`.
+    """
+
+    __slots__ = ('histogram', 'camera', 'stage')
+
+    def __init__(self, histogram, camera, stage):
+        self.histogram = histogram
+        self.camera = camera
+        self.stage = stage
+
+    def observe(self, value):
+        self.histogram.observe(value)
+        if TRACER.active:
+            TRACER.add(self.camera, self.stage, value)
+
+
+TRACER = StageTracer()
+
+# only one capture at a time
+_session_lock = threading.Lock()
+
+
+def capture(mode, duration, interval=0.005):
+    """
+    Run a profiling or tracing session for `duration` seconds (at most MAX_DURATION).
+
+    :param mode: 'sample' for the sampling profiler, 'trace' for the per-stage timeline.
+    :return: the collapsed stacks (str) or the Chrome trace (dict), or None if a session is already running.
+    """
+    if mode not in ('sample', 'trace'):
+        raise ValueError("mode must be 'sample' or 'trace'")
+    duration = min(max(float(duration), 0.1), MAX_DURATION)
+
+    if not _session_lock.acquire(blocking=False):
+        return None
+    try:
+        if mode == 'sample':
+            return SamplingProfiler(interval=max(float(interval), 0.001)).run(duration)
+        TRACER.start()
+        try:
+            time.sleep(duration)
+        finally:
+            trace = TRACER.stop()
+        return trace
+    finally:
+        _session_lock.release()
@@ -0,0 +1,157 @@
+"""
+Regions of interest and tiling for the camera inference.
+
+Resizing a whole wide-angle frame to the model input shrinks a distant weapon to a few
+pixels. Instead, a camera can be classified on crops of its frame:
+
+    CAMERA_ROI_<index>='[[[0.1, 0.2], [0.6, 0.2], [0.6, 0.9], [0.1, 0.9]]]'
+        polygons in coordinates relative to the frame (0 to 1), as JSON. Only their
+        bounding boxes are cropped, and the pixels outside the polygon are blanked.
+    CAMERA_TILES_<index>=3x2
+        split each region (or the whole frame) in columns x rows tiles overlapping
+        by TILE_OVERLAP (default 0.2), so that objects on the edges are seen whole.
+
+All the crops of a frame are classified in one batch and their results merged back
+into frame coordinates.
+"""
+
+import json
+import logging
+import os
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TILE_OVERLAP = float(os.environ.get('TILE_OVERLAP', 0.2))
+
+
+def parse_polygons(value):
+    """
+    JSON list of polygons, each a list of [x, y] relative to the frame.
+    The polygons entirely outside the frame, e.g. written in pixels, are left out.
+    """
+    polygons = [np.asarray(polygon, dtype=np.float32) for polygon in json.loads(value)]
+    for polygon in polygons:
+        if polygon.ndim != 2 or polygon.shape[0] < 3 or polygon.shape[1] != 2:
+            raise ValueError('a polygon needs at least 3 [x, y] points')
+    inside = [p for p in polygons if (p.min(axis=0) < 1).all() and (p.max(axis=0) > 0).all()]
+    if len(inside) < len(polygons):
+        logger.warning(f"{len(polygons) - len(inside)} polygons outside the frame, coordinates must be between 0 and 1")
+    if polygons and not inside:
+        raise ValueError('no polygon intersects the frame')
+    return inside
+
+
+def parse_tiles(value):
+    """'3x2' -> (3 columns, 2 rows)."""
+    columns, rows = value.lower().split('x')
+    return int(columns), int(rows)
+
+
+class Region:
+    """A crop of the frame: its box (x1, y1, x2, y2) in pixels and the mask of its polygon, if any."""
+
+    __slots__ = ('box', 'mask')
+
+    def __init__(self, box, mask=None):
+        self.box = box
+        self.mask = mask
+
+    def crop(self, image):
+        x1, y1, x2, y2 = self.box
+        crop = image[y1:y2, x1:x2]
+        if self.mask is not None:
+            crop = cv2.bitwise_and(crop, crop, mask=self.mask)
+        return crop
+
+
+def split(box, tiles, overlap):
+    """Split a box in columns x rows boxes, each enlarged by `overlap` of its size."""
+    x1, y1, x2, y2 = box
+    columns, rows = tiles
+    width, height = (x2 - x1) / columns, (y2 - y1) / rows
+    pad_x, pad_y = width * overlap / 2, height * overlap / 2
+    boxes = []
+    for row in range(rows):
+        for column in range(columns):
+            boxes.append((
+                max(x1, int(x1 + column * width - pad_x)),
+                max(y1, int(y1 + row * height - pad_y)),
+                min(x2, int(x1 + (column + 1) * width + pad_x)),
+                min(y2, int(y1 + (row + 1) * height + pad_y)),
+            ))
+    return boxes
+
+
+class CameraRegions:
+    """The regions classified for a camera, computed once per frame size."""
+
+    def __init__(self, camera_index):
+        self.camera_index = camera_index
+        self.polygons = []
+        self.tiles = (1, 1)
+        try:
+            roi = os.environ.get(f'CAMERA_ROI_{camera_index}')
+            if roi:
+                self.polygons = parse_polygons(roi)
+            tiles = os.environ.get(f'CAMERA_TILES_{camera_index}')
+            if tiles:
+                self.tiles = parse_tiles(tiles)
+        except ValueError as e:
+            logger.warning(f"Invalid regions for camera {camera_index}, classifying whole frames: {e}")
+            self.polygons, self.tiles = [], (1, 1)
+        self.plans = {}
+
+    @property
+    def enabled(self):
+        return bool(self.polygons) or self.tiles != (1, 1)
+
+    def regions(self, shape):
+        """The regions of a frame of this shape."""
+        height, width = shape[:2]
+        regions = self.plans.get((height, width))
+        if regions is None:
+            regions = self.plans[(height, width)] = self._plan(width, height)
+        return regions
+
+    def _plan(self, width, height):
+        regions = self._plan_polygons(width, height) if self.polygons else []
+        if not regions:
+            if self.polygons:
+                logger.warning(f"The regions of camera {self.camera_index} are outside its {width}x{height} frames, "
+                               f"classifying whole frames")
+            regions = [Region(box) for box in split((0, 0, width, height), self.tiles, TILE_OVERLAP)]
+        return regions
+
+    def _plan_polygons(self, width, height):
+
+        regions = []
+        for polygon in self.polygons:
+            points = np.round(polygon * (width, height)).astype(np.int32)
+            mask = np.zeros((height, width), dtype=np.uint8)
+            cv2.fillPoly(mask, [points], 255)
+            x, y, w, h = cv2.boundingRect(points)
+            bounds = (max(x, 0), max(y, 0), min(x + w, width), min(y + h, height))
+            for x1, y1, x2, y2 in split(bounds, self.tiles, TILE_OVERLAP):
+                tile_mask = mask[y1:y2, x1:x2]
+                # skip the tiles entirely outside the polygon
+                if x2 > x1 and y2 > y1 and tile_mask.any():
+                    regions.append(Region((x1, y1, x2, y2), None if tile_mask.all() else tile_mask))
+        return regions
+
+
+def merge_boxes(detections):
+    """Merge the overlapping detections of the same class, e.g. one object seen by two tiles."""
+    merged = []
+    for detection in sorted(detections, key=lambda d: -d['confidence']):
+        for kept in merged:
+            a, b = kept['bbox'], detection['bbox']
+            if kept['class_id'] == detection['class_id'] and \
+                    a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                kept['bbox'] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                break
+        else:
+            merged.append(dict(detection))
+    return merged
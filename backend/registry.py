@@ -0,0 +1,152 @@
+"""
+Registry of the known cameras and their last known state.
+
+A background health monitor probes every camera on its own schedule, so the status
+endpoints answer from the cache instead of opening devices on each request. Cameras
+that stay unavailable are probed less and less often (up to PROBE_MAX_INTERVAL),
+and every state change is reported to `on_change`, e.g. as a Socket.IO event.
+
+States:
+    connected     the camera is open and delivering frames
+    reconnecting  the camera is open but its source failed, see sources.py
+    available     the camera is closed and its source can be opened
+    unavailable   the camera is closed and its source cannot be opened
+    unknown       not probed yet
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from sources import camera_source, describe
+
+logger = logging.getLogger(__name__)
+
+PROBE_INTERVAL = float(os.environ.get('CAMERA_PROBE_INTERVAL', 10))
+PROBE_MAX_INTERVAL = 300.0
+# bound on the cameras registered by status requests
+MAX_CAMERAS = 64
+
+
+def configured_cameras():
+    """Camera 0, the cameras with a CAMERA_SOURCE_<index>, and devices 0 to CAMERA_DISCOVER - 1."""
+    indexes = {0}
+    for key in os.environ:
+        if key.startswith('CAMERA_SOURCE_') and key[len('CAMERA_SOURCE_'):].isdigit():
+            indexes.add(int(key[len('CAMERA_SOURCE_'):]))
+    indexes.update(range(int(os.environ.get('CAMERA_DISCOVER', 0))))
+    return sorted(indexes)
+
+
+class CameraRegistry:
+    """
+    :param probe: function(camera_index) -> state, may block while a source is opened.
+    :param on_change: function(status) called from the monitor thread when a camera changes state.
+    :param on_probe: function(status) called from the monitor thread after every probe.
+    """
+
+    def __init__(self, probe, on_change=None, on_probe=None, interval=PROBE_INTERVAL):
+        self.probe = probe
+        self.on_change = on_change
+        self.on_probe = on_probe
+        self.interval = interval
+        self.cameras = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        for camera_index in configured_cameras():
+            self.register(camera_index)
+
+    def register(self, camera_index):
+        """Add a camera, probed on the next round. Returns True if it was not known."""
+        with self.lock:
+            if camera_index in self.cameras or len(self.cameras) >= MAX_CAMERAS:
+                return False
+            self.cameras[camera_index] = {
+                'camera_index': camera_index,
+                'source': describe(camera_source(camera_index)),
+                'status': 'unknown',
+                'checked_at': None,
+                'next_probe': 0.0,
+                'failures': 0,
+            }
+        self.wakeup.set()
+        return True
+
+    def refresh(self, camera_index):
+        """Probe a camera on the next round, e.g. after it was opened or closed."""
+        if not self.register(camera_index):
+            with self.lock:
+                if camera_index in self.cameras:
+                    self.cameras[camera_index]['next_probe'] = 0.0
+            self.wakeup.set()
+
+    def status(self, camera_index):
+        """The cached status of a camera. Unknown cameras are registered and probed in the background."""
+        self.register(camera_index)
+        with self.lock:
+            camera = self.cameras.get(camera_index)
+            if camera is None:
+                return {'camera_index': camera_index, 'source': None, 'status': 'unknown', 'checked_at': None}
+            return {k: camera[k] for k in ('camera_index', 'source', 'status', 'checked_at')}
+
+    def update(self, status):
+        """Set the state of a camera probed by another node, e.g. a capture node of the distributed mode."""
+        camera_index = status['camera_index']
+        self.register(camera_index)
+        with self.lock:
+            camera = self.cameras.get(camera_index)
+            if camera is None:
+                return
+            changed = camera['status'] != status['status']
+            camera.update(source=status['source'], status=status['status'], checked_at=status['checked_at'])
+        if changed and self.on_change is not None:
+            self.on_change(self.status(camera_index))
+
+    def all(self):
+        with self.lock:
+            indexes = sorted(self.cameras)
+        return [self.status(camera_index) for camera_index in indexes]
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='camera-monitor', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            with self.lock:
+                due = [i for i, camera in self.cameras.items() if camera['next_probe'] <= now]
+            for camera_index in due:
+                self._probe(camera_index)
+
+            with self.lock:
+                next_probe = min((camera['next_probe'] for camera in self.cameras.values()), default=now + self.interval)
+            self.wakeup.wait(max(0.0, next_probe - time.monotonic()))
+            self.wakeup.clear()
+
+    def _probe(self, camera_index):
+        try:
+            state = self.probe(camera_index)
+        except Exception as e:
+            logger.error(f"Error probing camera {camera_index}: {e}")
+            state = 'unavailable'
+
+        with self.lock:
+            camera = self.cameras[camera_index]
+            changed = camera['status'] != state
+            camera['status'] = state
+            camera['checked_at'] = datetime.now().isoformat()
+            camera['failures'] = camera['failures'] + 1 if state == 'unavailable' else 0
+            delay = min(self.interval * 2 ** max(camera['failures'] - 1, 0), PROBE_MAX_INTERVAL)
+            camera['next_probe'] = time.monotonic() + delay
+
+        if changed:
+            logger.info(f"Camera {camera_index} is {state}")
+            if self.on_change is not None:
+                self.on_change(self.status(camera_index))
+        if self.on_probe is not None:
+            self.on_probe(self.status(camera_index))
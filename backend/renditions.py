@@ -0,0 +1,103 @@
+"""
+Per-camera resolutions: capture, inference and stream renditions.
+
+    CAMERA_CAPTURE_<index>=1280x720     resolution requested from local devices (default 640x480,
+                                        `source` keeps the resolution of the device)
+    CAMERA_INFERENCE_<index>=224x224    resolution of the frames given to the model (default: the model input,
+                                        or the captured frame when the camera has regions, see regions.py)
+    STREAM_RENDITIONS=full:source:80,thumb:320x240:60
+                                        <name>:<WxH or source>:<JPEG quality> of each stream served,
+                                        also settable per camera with STREAM_RENDITIONS_<index>
+
+Viewers pick a rendition with /stream/<index>?rendition=thumb, and only the renditions
+that currently have viewers are encoded: a grid of thumbnails never pays for
+full-resolution encodes.
+"""
+
+import logging
+import os
+import threading
+
+import cv2
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CAPTURE_SIZE = '640x480'
+DEFAULT_RENDITIONS = 'full:source:80,thumb:320x240:60'
+
+
+def parse_size(value):
+    """'640x480' -> (640, 480), 'source' -> None."""
+    if value == 'source':
+        return None
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def camera_setting(name, camera_index, default):
+    """Read CAMERA_<name>_<index>, or return `default`."""
+    return os.environ.get(f'CAMERA_{name}_{camera_index}', default)
+
+
+class Rendition:
+    """A stream output: its size (None for the captured size) and JPEG quality."""
+
+    __slots__ = ('name', 'size', 'quality')
+
+    def __init__(self, name, size, quality):
+        self.name = name
+        self.size = size
+        self.quality = quality
+
+
+def parse_renditions(value):
+    renditions = {}
+    for item in value.split(','):
+        name, size, quality = item.strip().split(':')
+        renditions[name] = Rendition(name, parse_size(size), int(quality))
+    return renditions
+
+
+class CameraSettings:
+    """The resolutions of one camera, read from the environment."""
+
+    def __init__(self, camera_index):
+        self.camera_index = camera_index
+        try:
+            self.capture_size = parse_size(camera_setting('CAPTURE', camera_index, DEFAULT_CAPTURE_SIZE))
+            self.inference_size = parse_size(camera_setting('INFERENCE', camera_index, 'source'))
+            self.renditions = parse_renditions(os.environ.get(f'STREAM_RENDITIONS_{camera_index}',
+                                                              os.environ.get('STREAM_RENDITIONS', DEFAULT_RENDITIONS)))
+        except ValueError as e:
+            logger.warning(f"Invalid resolution settings for camera {camera_index}, using the defaults: {e}")
+            self.capture_size = parse_size(DEFAULT_CAPTURE_SIZE)
+            self.inference_size = None
+            self.renditions = parse_renditions(DEFAULT_RENDITIONS)
+
+
+class Frame:
+    """
+    A captured frame and its resized copies, each computed at most once.
+    The inference and encode stages share the same Frame.
+    """
+
+    __slots__ = ('image', 'sizes', 'lock')
+
+    def __init__(self, image):
+        self.image = image
+        self.sizes = {}
+        self.lock = threading.Lock()
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    def resized(self, size):
+        """The frame at `size` (width, height), or the frame itself for None or its own size."""
+        if size is None or size == (self.image.shape[1], self.image.shape[0]):
+            return self.image
+        with self.lock:
+            resized = self.sizes.get(size)
+            if resized is None:
+                resized = self.sizes[size] = cv2.resize(self.image, size, interpolation=cv2.INTER_AREA)
+        return resized
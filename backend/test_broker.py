@@ -0,0 +1,88 @@
+"""
+Tests of the in-process broker of broker.py, run with `python -m pytest test_broker.py` from `backend/`.
+"""
+
+import threading
+import time
+
+import pytest
+
+import broker
+from broker import FRAMES, InProcessBroker
+
+
+def test_push_pop():
+    queues = InProcessBroker()
+    queues.push(FRAMES, {'camera': 0, 'sequence': 1})
+    queues.push(FRAMES, {'camera': 0, 'sequence': 2})
+
+    assert queues.pop(FRAMES) == {'camera': 0, 'sequence': 1}
+    assert queues.pop(FRAMES) == {'camera': 0, 'sequence': 2}
+    # an empty queue waits `timeout` seconds
+    start = time.monotonic()
+    assert queues.pop(FRAMES, timeout=0.1) is None
+    assert time.monotonic() - start >= 0.1
+
+
+def test_pop_waits_for_push():
+    queues = InProcessBroker()
+    timer = threading.Timer(0.05, queues.push, (FRAMES, {'sequence': 1}))
+    timer.start()
+
+    assert queues.pop(FRAMES, timeout=2.0) == {'sequence': 1}
+    timer.join()
+
+
+def test_full_queue_drops_oldest():
+    queues = InProcessBroker(maxsize=3)
+    for sequence in range(5):
+        queues.push(FRAMES, {'sequence': sequence})
+
+    assert [queues.pop(FRAMES, timeout=0)['sequence'] for _ in range(3)] == [2, 3, 4]
+    assert queues.pop(FRAMES, timeout=0) is None
+
+
+def test_queues_are_separate():
+    queues = InProcessBroker()
+    queues.push(FRAMES, {'frame': 1})
+    queues.push(broker.RESULTS, {'result': 1})
+
+    assert queues.pop(broker.RESULTS, timeout=0) == {'result': 1}
+    assert queues.pop(FRAMES, timeout=0) == {'frame': 1}
+
+
+def test_reports_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(broker.time, 'monotonic', lambda: now[0])
+    queues = InProcessBroker()
+    queues.report('clients:a:1', 2, ttl=30)
+    queues.report('clients:b:2', 3, ttl=10)
+    queues.report('cameras:0', 'connected', ttl=30)
+
+    assert queues.reports('clients:') == {'clients:a:1': 2, 'clients:b:2': 3}
+    now[0] += 15
+    assert queues.reports('clients:') == {'clients:a:1': 2}
+    # reporting again renews the expiry
+    queues.report('clients:b:2', 1, ttl=10)
+    assert queues.reports('clients:') == {'clients:a:1': 2, 'clients:b:2': 1}
+
+
+def test_recent_items():
+    lists = InProcessBroker()
+    for i in range(5):
+        lists.record('history', {'id': i}, limit=3)
+
+    # most recent first, limited to the last `limit`
+    assert lists.recent('history') == [{'id': 4}, {'id': 3}, {'id': 2}]
+    assert lists.length('history') == 3
+    assert lists.recent('other') == [] and lists.length('other') == 0
+
+    # a larger limit keeps the items already recorded
+    lists.record('history', {'id': 5}, limit=5)
+    assert [item['id'] for item in lists.recent('history')] == [5, 4, 3, 2]
+
+
+def test_connect():
+    assert isinstance(broker.connect('memory://'), InProcessBroker)
+    with pytest.raises(ValueError):
+        broker.connect('amqp://localhost')
@@ -0,0 +1,114 @@
+"""
+Tests of cluster.py: the in-process Socket.IO message queue and the client counts,
+run with `python -m pytest test_cluster.py` from `backend/`.
+"""
+
+import time
+import uuid
+
+import socketio
+
+import cluster
+from broker import InProcessBroker
+from cluster import ClientCounter, InProcessManager
+
+
+def api_process(channel):
+    """
+    A Socket.IO server publishing its broadcasts to `channel`, as one API process, with one
+    connected client whose received events are listed in `server.received`.
+    """
+    server = socketio.Server(async_mode='threading', client_manager=InProcessManager(channel=channel))
+    server.received = []
+    server._send_eio_packet = lambda eio_sid, pkt: server.received.append(
+        socketio.packet.Packet(encoded_packet=pkt.data).data)
+    server.manager.initialize()
+    server.manager.connect(uuid.uuid4().hex, '/')
+    return server
+
+
+def received(server, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not server.received and time.monotonic() < deadline:
+        time.sleep(0.01)
+    events, server.received[:] = list(server.received), []
+    return events
+
+
+def test_broadcast_reaches_every_process():
+    channel = f'test-{uuid.uuid4().hex}'
+    first, second = api_process(channel), api_process(channel)
+
+    # emitted by one process, received by the clients of both
+    first.emit('detection', {'weapon_type': 'Gun'})
+    assert received(first) == [['detection', {'weapon_type': 'Gun'}]]
+    assert received(second) == [['detection', {'weapon_type': 'Gun'}]]
+
+    # another channel is another deployment
+    other = api_process(f'test-{uuid.uuid4().hex}')
+    second.emit('detection', {'weapon_type': 'Knife'})
+    assert received(first) == [['detection', {'weapon_type': 'Knife'}]]
+    assert received(other, timeout=0.2) == []
+
+
+def test_socketio_options(monkeypatch):
+    monkeypatch.delenv('SOCKETIO_MESSAGE_QUEUE', raising=False)
+    assert cluster.socketio_options() == {}
+    monkeypatch.setenv('SOCKETIO_MESSAGE_QUEUE', 'redis://localhost:6379/0')
+    assert cluster.socketio_options() == {'message_queue': 'redis://localhost:6379/0'}
+    monkeypatch.setenv('SOCKETIO_MESSAGE_QUEUE', 'memory://')
+    assert isinstance(cluster.socketio_options()['client_manager'], InProcessManager)
+
+
+def test_local_count():
+    counter = ClientCounter()
+    assert counter.connect() == 1
+    assert counter.connect() == 2
+    assert counter.disconnect() == 1
+    assert counter.disconnect() == 0
+    # a disconnection without connection never makes it negative
+    assert counter.disconnect() == 0
+    assert counter.total() == 0
+
+
+def test_count_of_all_processes():
+    shared = InProcessBroker()
+    first, second = ClientCounter(shared, node='a'), ClientCounter(shared, node='b')
+    first.connect()
+    first.connect()
+    second.connect()
+
+    assert first.local() == 2 and second.local() == 1
+    assert first.total() == second.total() == 3
+    second.disconnect()
+    assert first.total() == 2
+
+
+def test_count_of_a_crashed_process_expires(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cluster, 'REPORT_INTERVAL', 1.0)
+    monkeypatch.setattr('broker.time.monotonic', lambda: now[0])
+    shared = InProcessBroker()
+    first, crashed = ClientCounter(shared, node='a'), ClientCounter(shared, node='b')
+    first.connect()
+    crashed.connect()
+    assert first.total() == 2
+
+    # the report of the crashed process is not refreshed
+    now[0] += 3.5
+    assert first.total() == 1
+
+
+class BrokenBroker:
+    def report(self, key, value, ttl):
+        raise ConnectionError('broker is down')
+
+    def reports(self, prefix):
+        raise ConnectionError('broker is down')
+
+
+def test_broker_down():
+    counter = ClientCounter(BrokenBroker(), node='a')
+    # the clients of this process are still counted
+    assert counter.connect() == 1
+    assert counter.total() == 1
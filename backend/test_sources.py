@@ -0,0 +1,182 @@
+"""
+Tests of the camera decode threads of sources.py with a fake capture, run with
+`python -m pytest test_sources.py` from `backend/`.
+"""
+
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import sources
+from sources import VideoSource
+
+
+class FakeCapture:
+    """
+    Stands in for cv2.VideoCapture. `opens` says which open attempts succeed, `frames` how many
+    frames a capture delivers before failing (None: forever), and `grab_delay` how long a grab blocks.
+    """
+
+    def __init__(self, opens=(True,), frames=None, grab_delay=0.002):
+        self.opens = list(opens)
+        self.frames = frames
+        self.grab_delay = grab_delay
+        self.attempts = []
+        self.grabs = 0
+        self.retrieves = 0
+        self.releases = 0
+        self.opened = False
+        self.delivered = 0
+        self.grabbing = False
+        self.released_while_grabbing = False
+
+    def __call__(self, source):
+        self.attempts.append(time.monotonic())
+        self.opened = self.opens.pop(0) if len(self.opens) > 1 else self.opens[0]
+        self.delivered = 0
+        return self
+
+    def isOpened(self):
+        return self.opened
+
+    def set(self, prop, value):
+        return True
+
+    def get(self, prop):
+        return 0
+
+    def grab(self):
+        self.grabbing = True
+        time.sleep(self.grab_delay)
+        self.grabbing = False
+        if self.frames is not None and self.delivered >= self.frames:
+            return False
+        self.grabs += 1
+        self.delivered += 1
+        return True
+
+    def retrieve(self):
+        self.retrieves += 1
+        return True, np.full((4, 4, 3), self.grabs % 256, np.uint8)
+
+    def release(self):
+        self.releases += 1
+        self.released_while_grabbing |= self.grabbing
+        self.opened = False
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(sources, 'BACKOFF_INITIAL', 0.05)
+    monkeypatch.setattr(sources.random, 'uniform', lambda low, high: 1.0)
+
+
+def test_reconnect_with_backoff():
+    capture = FakeCapture(opens=(False, False, False, True))
+    source = VideoSource(0, 0, open_capture=capture)
+    source.start()
+    try:
+        # the first attempt is made at once by the decode thread, then the delays double
+        assert wait_for(lambda: source.connected)
+        assert len(capture.attempts) == 4
+        gaps = np.diff(capture.attempts)
+        assert gaps[0] == pytest.approx(0.05, abs=0.04)
+        assert gaps[1] == pytest.approx(0.1, abs=0.04)
+        assert gaps[2] == pytest.approx(0.2, abs=0.04)
+        assert source.read() is not None
+    finally:
+        source.stop()
+
+
+def test_reconnect_after_failure():
+    capture = FakeCapture(frames=20)
+    source = VideoSource(0, 0, open_capture=capture)
+    source.start()
+    try:
+        # the capture fails after 20 frames, is released and opened again
+        assert wait_for(lambda: len(capture.attempts) >= 2)
+        assert capture.releases >= 1
+        assert wait_for(lambda: source.connected)
+        assert source.read() is not None
+    finally:
+        source.stop()
+
+
+def test_only_wanted_frames_are_decoded():
+    capture = FakeCapture()
+    source = VideoSource(0, 0, open_capture=capture)
+    source.start()
+    try:
+        frames = []
+        for _ in range(5):
+            frames.append(source.read())
+            time.sleep(0.03)
+        assert all(frame is not None for frame in frames)
+        # every frame is grabbed to stay live, only the frames read are decoded
+        assert capture.retrieves <= len(frames) + 1
+        assert capture.grabs > 3 * capture.retrieves
+    finally:
+        source.stop()
+
+
+def test_stop_releases_once():
+    capture = FakeCapture()
+    source = VideoSource(0, 0, open_capture=capture)
+    source.start()
+    assert wait_for(lambda: source.connected)
+    source.stop()
+
+    assert not source.thread.is_alive()
+    assert capture.releases == 1
+    assert not source.connected
+    assert source.read(timeout=0.1) is None
+
+
+def test_stop_during_grab():
+    capture = FakeCapture(grab_delay=0.3)
+    source = VideoSource(0, 0, open_capture=capture)
+    source.start()
+    assert wait_for(lambda: capture.grabbing)
+    source.stop()
+
+    # the capture is released by the decode thread once the grab returned, never under it
+    assert wait_for(lambda: capture.releases == 1)
+    assert not capture.released_while_grabbing
+
+
+def test_stop_while_reconnecting():
+    capture = FakeCapture(opens=(False,))
+    source = VideoSource(0, 0, open_capture=capture)
+    source.start()
+    assert wait_for(lambda: len(capture.attempts) >= 2)
+    start = time.monotonic()
+    source.stop()
+
+    # the backoff wait is interrupted
+    assert time.monotonic() - start < 1.0
+    assert not source.thread.is_alive()
+
+
+def test_readers_wait_for_a_new_frame():
+    capture = FakeCapture()
+    source = VideoSource(0, 0, open_capture=capture)
+    source.start()
+    try:
+        results = []
+        readers = [threading.Thread(target=lambda: results.append(source.read())) for _ in range(3)]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        assert len(results) == 3 and all(frame is not None for frame in results)
+    finally:
+        source.stop()
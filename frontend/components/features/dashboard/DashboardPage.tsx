@@ -30,8 +30,14 @@ interface Alert {
   confidence?: number;
 }
 
+interface CameraStatus {
+  camera_index: number;
+  status: string;
+  checked_at: string | null;
+}
+
 interface Detection {
-  id: number;
+  id: string;
   date: string;
   weapon_type: string;
   location: string;
@@ -52,6 +58,7 @@ export default function DashboardPage() {
   const [detectionHistory, setDetectionHistory] = useState<Detection[]>([])
   const [showCameraMessage, setShowCameraMessage] = useState('')
   const [currentDetections, setCurrentDetections] = useState<any[]>([])
+  const [cameraStatuses, setCameraStatuses] = useState<Record<number, string>>({})
   const socketRef = useRef<Socket | null>(null)
 
   // Initialize backend connections
@@ -92,6 +99,11 @@ export default function DashboardPage() {
       }, 3000)
     })
     
+    // Pushed by the backend camera monitor whenever a camera changes state
+    socket.on("camera_status", (data: CameraStatus) => {
+      setCameraStatuses((prev) => ({ ...prev, [data.camera_index]: data.status }))
+    })
+    
     socket.on("connect_error", (error) => {
       console.error("Connection error:", error)
       setIsConnected(false)
@@ -117,6 +129,17 @@ export default function DashboardPage() {
           setModelStatus(modelData)
         }
         
+        // Fetch the cached camera states, kept up to date by "camera_status" events afterwards
+        const camerasResponse = await fetch(`${apiBase}/cameras`)
+        if (camerasResponse.ok) {
+          const camerasData = await camerasResponse.json()
+          const statuses: Record<number, string> = {}
+          for (const camera of camerasData.cameras || []) {
+            statuses[camera.camera_index] = camera.status
+          }
+          setCameraStatuses(statuses)
+        }
+        
         // Fetch detection history
         const historyResponse = await fetch(`${apiBase}/history`)
         if (historyResponse.ok) {
@@ -157,11 +180,14 @@ export default function DashboardPage() {
 
   const streamBase = process.env.NEXT_PUBLIC_STREAM_BASE_URL || "http://localhost:5000/stream"
   
+  const isCameraOnline = (cameraIndex: number) =>
+    ['connected', 'available'].includes(cameraStatuses[cameraIndex])
+  
   const cameraLocations = [
     {
       id: 'main-entrance',
       name: 'Main Entrance',
-      status: modelStatus?.camera_status === 'connected' ? 'online' : 'offline',
+      status: (0 in cameraStatuses ? isCameraOnline(0) : modelStatus?.camera_status === 'connected') ? 'online' : 'offline',
       lastUpdate: '2 min ago',
       streamUrl: streamBase, // Main working camera
       cameraIndex: 0,
@@ -170,29 +196,29 @@ export default function DashboardPage() {
     {
       id: 'parking-lot',
       name: 'Parking Lot',
-      status: 'offline',
+      status: isCameraOnline(1) ? 'online' : 'offline',
       lastUpdate: '1 min ago',
       streamUrl: `${streamBase}/1`, // Future external camera
       cameraIndex: 1,
-      isActive: false
+      isActive: isCameraOnline(1)
     },
     {
       id: 'side-entrance',
       name: 'Side Entrance',
-      status: 'offline',
+      status: isCameraOnline(2) ? 'online' : 'offline',
       lastUpdate: '15 min ago',
       streamUrl: `${streamBase}/2`, // Future external camera
       cameraIndex: 2,
-      isActive: false
+      isActive: isCameraOnline(2)
     },
     {
       id: 'lobby',
       name: 'Lobby',
-      status: 'offline',
+      status: isCameraOnline(3) ? 'online' : 'offline',
       lastUpdate: '30 sec ago',
       streamUrl: `${streamBase}/3`, // Future external camera
       cameraIndex: 3,
-      isActive: false
+      isActive: isCameraOnline(3)
     }
   ]
 
@@ -233,7 +259,7 @@ export default function DashboardPage() {
     try {
       // Stop only external cameras (not the main active camera)
       for (const camera of cameraLocations) {
-        if (!camera.isActive) {
+        if (camera.cameraIndex !== 0) {
           await fetch(`${apiBase}/camera/stop/${camera.cameraIndex}`, {
             method: 'POST'
           })
@@ -282,23 +308,6 @@ export default function DashboardPage() {
     return false
   }
 
-  // Update external camera statuses periodically (reduced frequency)
-  useEffect(() => {
-    const checkExternalCameras = async () => {
-      // Only check main camera status, assume external cameras are offline
-      // This prevents spam of OpenCV errors for non-existent cameras
-      console.log('Camera status check: Main camera active, external cameras offline')
-    }
-
-    // Check camera statuses every 60 seconds (reduced frequency)
-    const interval = setInterval(checkExternalCameras, 60000)
-    
-    // Initial check after a delay
-    setTimeout(checkExternalCameras, 5000)
-
-    return () => clearInterval(interval)
-  }, [modelStatus])
-
   return (
     <div className="h-screen bg-gradient-to-br from-slate-50 to-slate-100 dark:from-neutral-900 dark:to-neutral-800 flex flex-col">
       {/* Top Navigation Bar */}
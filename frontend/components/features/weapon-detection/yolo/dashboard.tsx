@@ -58,6 +58,12 @@ const Dashboard = () => {
     return camera ? camera.streamUrl.trim() : cameras[0].streamUrl.trim();
   };
 
+  // Grid tiles use the small rendition of the stream, the selected camera the full one
+  const getThumbnailUrl = (streamUrl: string) => {
+    const url = streamUrl.trim();
+    return `${url}${url.includes('?') ? '&' : '?'}rendition=thumb`;
+  };
+
   const getActiveCameraName = () => {
     const camera = cameras.find(cam => cam.id === activeCamera);
     return camera ? camera.name : cameras[0].name;
@@ -257,7 +263,7 @@ const Dashboard = () => {
                     <Card className="h-full bg-white dark:bg-neutral-800 border border-slate-200 dark:border-neutral-700">
                       <div className="relative h-full">
                         <img
-                          src={camera.streamUrl}
+                          src={getThumbnailUrl(camera.streamUrl)}
                           alt={camera.name}
                           className="w-full h-full object-cover"
                           onError={(e) => {
@@ -0,0 +1,226 @@
+import csv
+import os
+import time
+
+import numpy as np
+from ultralytics import YOLO
+
+
+class Benchmark:
+    """
+    Compare the CPU export formats of a trained YOLOv8 model to choose the deployment format.
+
+    Each combination of format, image size and precision is exported, then measured on:
+        * latency per image: p50, p95 and p99 in milliseconds
+        * throughput (images per second) at several batch sizes
+        * memory: resident memory used by the loaded model, and size of the exported file
+        * accuracy: mAP50 and mAP50-95 on the validation split, and their delta against PyTorch fp32
+
+    The results are written to `benchmark.csv` and `benchmark.md` in `output_dir`.
+    """
+
+    # precisions that can be exported on CPU for each format
+    FORMATS = {
+        'pytorch': ('fp32',),
+        'torchscript': ('fp32',),
+        'onnx': ('fp32',),
+        'openvino': ('fp32', 'fp16', 'int8'),
+        'tflite': ('fp32', 'fp16', 'int8'),
+    }
+
+    # formats exported with a dynamic batch dimension. The others only run with a batch of 1.
+    DYNAMIC = ('pytorch', 'onnx', 'openvino')
+
+    def __init__(self, model, data, formats=None, img_sizes=(320, 640), precisions=('fp32', 'fp16', 'int8'),
+                 batch_sizes=(1, 4, 8), warmup=5, runs=50, validate=True, output_dir='benchmarks'):
+        """
+        Create a Benchmark.
+
+        :param model: a `Model` object with loaded weights (a `.pt` file).
+        :param data: the path to the `data.yaml` file, used for int8 calibration and validation.
+        :param formats: the formats to compare. All the formats in `Benchmark.FORMATS` by default.
+        :param img_sizes: the image sizes to compare.
+        :param precisions: the precisions to compare, among 'fp32', 'fp16' and 'int8'.
+        :param batch_sizes: the batch sizes used to measure the throughput.
+        :param warmup: number of inferences before measuring.
+        :param runs: number of measured inferences.
+        :param validate: if True, run the validation split to compute the mAP of each export.
+        :param output_dir: where to write the report.
+        """
+
+        formats = list(self.FORMATS) if formats is None else list(formats)
+        unknown = set(formats) - set(self.FORMATS)
+        if unknown:
+            raise ValueError(f'Unknown format(s) {sorted(unknown)}. Available formats are {list(self.FORMATS)}')
+
+        self.model = model
+        self.data = data
+        self.formats = formats
+        self.img_sizes = img_sizes
+        self.precisions = precisions
+        self.batch_sizes = batch_sizes
+        self.warmup = warmup
+        self.runs = runs
+        self.validate = validate
+        self.output_dir = output_dir
+        self.results = []
+
+    def run(self):
+        """
+        Export and measure every combination, then write the report.
+
+        :return: results: a list of dictionaries, one per combination.
+        """
+
+        self.results = []
+        for img_size in self.img_sizes:
+            rows = []
+            for format in self.formats:
+                for precision in self.precisions:
+                    if precision not in self.FORMATS[format]:
+                        continue
+
+                    row = self.measure(format, img_size, precision)
+                    rows.append(row)
+                    print(f"{format} {precision} {img_size}: p50 {row.get('p50 (ms)')} ms, "
+                          f"mAP50-95 {row.get('mAP50-95')} {row.get('error', '')}")
+
+            # the reference is PyTorch fp32 at the same image size, validated on its own if it is not compared
+            reference = next((row for row in rows if row['format'] == 'pytorch' and row['precision'] == 'fp32'), None)
+            if reference is None and self.validate:
+                reference = self.reference(img_size)
+            for row in rows:
+                if reference is not None and row.get('mAP50-95') is not None \
+                        and reference.get('mAP50-95') is not None:
+                    row['mAP50 delta'] = round(row['mAP50'] - reference['mAP50'], 4)
+                    row['mAP50-95 delta'] = round(row['mAP50-95'] - reference['mAP50-95'], 4)
+            self.results.extend(rows)
+
+        self.save_report()
+        return self.results
+
+    def measure(self, format, img_size, precision):
+        """
+        Export the model in one format and measure it.
+
+        :return: row: the measures of this combination.
+        """
+
+        row = {'format': format, 'image size': img_size, 'precision': precision}
+
+        try:
+            path = self.export(format, img_size, precision)
+            row['file size (MB)'] = round(self.file_size(path) / 2 ** 20, 2)
+
+            rss_before = self.rss()
+            exported = YOLO(path, task='detect')
+            image = np.random.randint(0, 255, (img_size, img_size, 3), dtype=np.uint8)
+            predict = dict(imgsz=img_size, verbose=False, half=precision == 'fp16')
+
+            for _ in range(self.warmup):
+                exported.predict(source=image, **predict)
+            row['memory (MB)'] = round((self.rss() - rss_before) / 2 ** 20, 1) if rss_before is not None else None
+
+            latencies = []
+            for _ in range(self.runs):
+                start = time.perf_counter()
+                exported.predict(source=image, **predict)
+                latencies.append((time.perf_counter() - start) * 1000)
+            for p in (50, 95, 99):
+                row[f'p{p} (ms)'] = round(float(np.percentile(latencies, p)), 2)
+
+            batch_sizes = self.batch_sizes if format in self.DYNAMIC else [b for b in self.batch_sizes if b == 1]
+            for batch_size in batch_sizes:
+                batch = [image] * batch_size
+                n = max(1, self.runs // batch_size)
+                start = time.perf_counter()
+                for _ in range(n):
+                    exported.predict(source=batch, **predict)
+                row[f'throughput bs{batch_size} (img/s)'] = round(n * batch_size / (time.perf_counter() - start), 1)
+
+            if self.validate:
+                row.update(self.accuracy(exported, img_size, precision))
+
+        except Exception as e:
+            row['error'] = f'{type(e).__name__}: {e}'
+
+        return row
+
+    def accuracy(self, exported, img_size, precision):
+        """
+        :return: metrics: the mAP50 and mAP50-95 of a loaded model on the validation split.
+        """
+
+        metrics = exported.val(data=self.data, imgsz=img_size, batch=1, half=precision == 'fp16',
+                               int8=precision == 'int8', plots=False, verbose=False)
+        return {'mAP50': round(float(metrics.box.map50), 4), 'mAP50-95': round(float(metrics.box.map), 4)}
+
+    def reference(self, img_size):
+        """
+        Validate the PyTorch fp32 model, when it is not one of the compared formats.
+
+        :return: reference: its mAP50 and mAP50-95, or None if it cannot be validated.
+        """
+
+        try:
+            return self.accuracy(YOLO(self.export('pytorch', img_size, 'fp32'), task='detect'), img_size, 'fp32')
+        except Exception as e:
+            print(f"pytorch fp32 {img_size}: no reference for the mAP deltas ({type(e).__name__}: {e})")
+            return None
+
+    def export(self, format, img_size, precision):
+        """
+        Export the model, or return the path to the PyTorch weights for `pytorch`.
+        """
+
+        if format == 'pytorch':
+            return self.model.model.ckpt_path
+
+        return self.model.export(format=format, imgsz=img_size, half=precision == 'fp16',
+                                 int8=precision == 'int8', dynamic=format in self.DYNAMIC, data=self.data)
+
+    def save_report(self):
+        """
+        Write the results as a CSV file and a Markdown table.
+        """
+
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        columns = []
+        for row in self.results:
+            for key in row:
+                if key not in columns:
+                    columns.append(key)
+
+        with open(os.path.join(self.output_dir, 'benchmark.csv'), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(self.results)
+
+        with open(os.path.join(self.output_dir, 'benchmark.md'), 'w') as f:
+            f.write('| ' + ' | '.join(columns) + ' |\n')
+            f.write('|' + '---|' * len(columns) + '\n')
+            for row in self.results:
+                f.write('| ' + ' | '.join(str(row.get(c, '')) for c in columns) + ' |\n')
+
+    @staticmethod
+    def file_size(path):
+        """
+        Size of an exported model, which is a directory for some formats (e.g. OpenVINO).
+        """
+
+        if os.path.isdir(path):
+            return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+        return os.path.getsize(path)
+
+    @staticmethod
+    def rss():
+        """
+        Resident memory of the process in bytes, or `None` if psutil is not installed.
+        """
+
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().rss
@@ -1,8 +1,15 @@
+import hashlib
+import json
 import os
+import shutil
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from types import SimpleNamespace
+
+import yaml
 
-os.environ["HOME"] = "C:/Users/balde"  # fix Roboflow issue
+# Roboflow reads its configuration from $HOME, which is not set on Windows
+os.environ.setdefault("HOME", os.path.expanduser("~"))
 from roboflow import Roboflow
-import shutil
 from dotenv import load_dotenv
 
 
@@ -12,48 +19,195 @@ class DataFlow:
     """
     A class that connects to Roboflow to load the dataset,
     load the YOLO8 model from roboflow, and make predictions.
+
+    Downloaded datasets are kept in a local content-addressed cache (`cache_dir`):
+        * `objects/`: every file of every dataset version, stored once under its SHA-256
+        * `refs/<workspace>/<project>/<version>.json`: the files of a version and their checksums
+    A version is only downloaded once. Its folder in `datasets/` is rebuilt from the cache
+    with hard links (to read-only objects) when files are missing or damaged, so later runs start without any network
+    access (`offline=True` or `ROBOFLOW_OFFLINE=1` never connects to Roboflow).
     """
 
-    def __init__(self, workspace="yolo-xkggu", project="guns-mms73", version=3):
+    def __init__(self, workspace="yolo-xkggu", project="guns-mms73", version=3, dataset_dir="datasets",
+                 cache_dir=None, offline=None):
         """
         Load the specified `project` from roboflow
 
         :param workspace: roboflow workspace
         :param project: project id
+        :param version: the version of the dataset
+        :param dataset_dir: where the datasets are extracted
+        :param cache_dir: the dataset cache. `$DATASET_CACHE` or `<dataset_dir>/.cache` by default.
+        :param offline: if True, only use the cache. `$ROBOFLOW_OFFLINE` by default.
         """
 
-        load_dotenv('credentials.env')
-        key = os.getenv('ROBOFLOW_API_KEY')
-        rf = Roboflow(key)
-
-        self.project = rf.workspace(workspace).project(project)
+        self.workspace = workspace
+        self.project_id = project
         self.version = version
+        self.dataset_dir = dataset_dir
+        self.cache_dir = cache_dir or os.getenv('DATASET_CACHE') or os.path.join(dataset_dir, '.cache')
+        self.offline = offline if offline is not None else os.getenv('ROBOFLOW_OFFLINE', '0') == '1'
+        self._project = None
 
-    def load_dataset(self):
+    @property
+    def project(self):
+        """
+        The Roboflow project, connected on first use.
         """
-        Load the dataset from roboflow.
-        then move it to the `datasets` folder  project loaded when creating the object.
 
-        Note: the dataset is downloaded in the folder `name-version`. E.g: `Guns-3`.
+        if self._project is None:
+            if self.offline:
+                raise RuntimeError(f'Offline: {self.workspace}/{self.project_id} version {self.version} '
+                                   f'is not in the cache {self.cache_dir}')
+            load_dotenv('credentials.env')
+            key = os.getenv('ROBOFLOW_API_KEY')
+            rf = Roboflow(key)
+            self._project = rf.workspace(self.workspace).project(self.project_id)
+        return self._project
 
-        :return: `(dataset, data_yaml_path)` the roboflow dataset and the path to
-        the data.yaml file which contains information for training the model.
+    def ref_path(self):
+        return os.path.join(self.cache_dir, 'refs', self.workspace, self.project_id, f'{self.version}.json')
+
+    def object_path(self, digest):
+        return os.path.join(self.cache_dir, 'objects', digest[:2], digest)
+
+    @staticmethod
+    def file_digest(path):
+        """
+        :return: digest: the SHA-256 of a file.
+        """
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def add_to_cache(self, folder, name, workers=None):
+        """
+        Store the files of a downloaded dataset in the cache, and record them for the current version.
+
+        :return: ref: the record of the version: its name and `{relative path: [sha256, size]}`.
         """
 
-        dataset = self.project.version(self.version).download("yolov8")
-        original_dir = f"{dataset.name}-{dataset.version}"
-        dataset_dir = "datasets/"
+        # roboflow writes the absolute paths of the download folder in data.yaml, the cached one must not depend on it
+        data_yaml = os.path.join(folder, 'data.yaml')
+        if os.path.exists(data_yaml):
+            with open(data_yaml) as f:
+                data = yaml.safe_load(f)
+            for split in ('train', 'val', 'test'):
+                value = data.get(split)
+                if isinstance(value, str) and value.startswith(folder):
+                    data[split] = value[len(folder):].lstrip('/\\')
+            with open(data_yaml, 'w') as f:
+                yaml.safe_dump(data, f, sort_keys=False)
+
+        paths = [os.path.join(root, file) for root, _, files in os.walk(folder) for file in files]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            digests = list(executor.map(self.file_digest, paths))
+
+        files = {}
+        for path, digest in zip(paths, digests):
+            files[os.path.relpath(path, folder).replace(os.sep, '/')] = [digest, os.path.getsize(path)]
+            target = self.object_path(digest)
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(path, target + '.tmp')
+                # read-only: the datasets are hard links to the objects, and must not be edited in place
+                os.chmod(target + '.tmp', 0o444)
+                os.replace(target + '.tmp', target)
 
-        # create `datasets/` directory if it doesn't exist
-        if not os.path.exists(dataset_dir):
-            os.makedirs(dataset_dir)
+        ref = {'workspace': self.workspace, 'project': self.project_id, 'version': self.version,
+               'name': name, 'files': files}
+        os.makedirs(os.path.dirname(self.ref_path()), exist_ok=True)
+        with open(self.ref_path() + '.tmp', 'w') as f:
+            json.dump(ref, f)
+        os.replace(self.ref_path() + '.tmp', self.ref_path())
+        return ref
 
-        # move the dataset to `datasets/`
-        try:
-            shutil.move(original_dir, dataset_dir)
-        except shutil.Error:
-            print('Warning: Destination path already exists\nCheck if the dataset has not already been loaded.')
+    def stamps_path(self):
+        return os.path.join(self.cache_dir, 'refs', self.workspace, self.project_id, f'{self.version}.stamps.json')
+
+    def checkout(self, ref, location, verify=False):
+        """
+        Make sure that `location` holds the files of `ref`, restoring the missing or damaged ones from the cache.
+
+        The checksum of a file is only computed again when its size or modification time changed since it was
+        last verified (recorded in `stamps_path()`), so a checkout that is up to date does not read the dataset.
+
+        :param verify: if True, compare the checksum of every file, even the unchanged ones.
+        :return: restored: the number of files restored.
+        """
 
+        stamps = {}
+        if not verify and os.path.exists(self.stamps_path()):
+            with open(self.stamps_path()) as f:
+                recorded = json.load(f)
+            if recorded.get('location') == location:
+                stamps = recorded['files']
+
+        restored = 0
+        verified = {}
+        for relative, (digest, size) in ref['files'].items():
+            path = os.path.join(location, *relative.split('/'))
+            if os.path.exists(path):
+                st = os.stat(path)
+                stamp = [digest, st.st_size, st.st_mtime_ns]
+                if st.st_size == size and (stamps.get(relative) == stamp or self.file_digest(path) == digest):
+                    verified[relative] = stamp
+                    continue
+
+            source = self.object_path(digest)
+            if not os.path.exists(source) or self.file_digest(source) != digest:
+                raise RuntimeError(f'The cached copy of {relative} is missing or corrupted, '
+                                   f'delete {self.ref_path()} to download the dataset again')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.lexists(path):
+                os.remove(path)
+            try:
+                # the cache and the datasets are usually on the same drive: no copy
+                os.link(source, path)
+            except OSError:
+                shutil.copyfile(source, path)
+            st = os.stat(path)
+            verified[relative] = [digest, st.st_size, st.st_mtime_ns]
+            restored += 1
+
+        if verified != stamps:
+            with open(self.stamps_path() + '.tmp', 'w') as f:
+                json.dump({'location': location, 'files': verified}, f)
+            os.replace(self.stamps_path() + '.tmp', self.stamps_path())
+        return restored
+
+    def load_dataset(self, verify=False):
+        """
+        Load the dataset from the cache, or download it from roboflow and add it to the cache,
+        then extract it in the `datasets` folder.
+
+        Note: the dataset is extracted in the folder `name-version`. E.g: `Guns-3`.
+
+        :param verify: if True, check the checksum of every file of the dataset, not only of the modified ones.
+        :return: `(dataset, data_yaml_path)` the dataset (its `name`, `version` and `location`) and the path to
+        the data.yaml file which contains information for training the model.
+        """
+
+        ref = None
+        if os.path.exists(self.ref_path()):
+            with open(self.ref_path()) as f:
+                ref = json.load(f)
+        else:
+            download_dir = os.path.join(self.cache_dir, 'downloads', f'{self.project_id}-{self.version}')
+            shutil.rmtree(download_dir, ignore_errors=True)
+            dataset = self.project.version(self.version).download("yolov8", location=download_dir)
+            ref = self.add_to_cache(download_dir, dataset.name)
+            shutil.rmtree(download_dir, ignore_errors=True)
+
+        location = os.path.abspath(os.path.join(self.dataset_dir, f"{ref['name']}-{self.version}"))
+        restored = self.checkout(ref, location, verify=verify)
+        if restored:
+            print(f"{restored} files of {ref['name']}-{self.version} extracted from the cache {self.cache_dir}")
+
+        dataset = SimpleNamespace(name=ref['name'], version=self.version, location=location)
         data_yaml_path = os.path.join(dataset.location, 'data.yaml')
 
         return dataset, data_yaml_path
@@ -65,7 +219,7 @@ class DataFlow:
 
         self.model = self.project.version(self.version).model
 
-    def predict(self, data, confidence=40, overlap=30, save=True):
+    def predict(self, data, confidence=40, overlap=30, save=True, output_path="prediction.jpg"):
         """
         Predict the data.
 
@@ -73,13 +227,62 @@ class DataFlow:
         :param confidence:
         :param overlap:
         :param save:
+        :param output_path: where the annotated image is saved if `save` is True
         :return: the result of the prediction
         """
 
-        result = self.model.predict(data, confidence=confidence, overlap=overlap).json()
+        # a single prediction gives both the JSON and the annotated image
+        prediction = self.model.predict(data, confidence=confidence, overlap=overlap)
         # print(model.predict("IMAGE_URL", hosted=True, confidence=40, overlap=30).json())
+        result = prediction.json()
 
         if save is True:
-            self.model.predict(data, confidence=confidence, overlap=overlap).save("prediction.jpg")
+            prediction.save(output_path)
 
         return result
+
+    def predict_batch(self, inputs, confidence=40, overlap=30, save_dir=None, workers=4):
+        """
+        Predict many inputs concurrently, with at most `workers` predictions running at a time,
+        and yield each result as soon as it is ready (not in the order of `inputs`).
+
+        :param inputs: an iterable of images: paths, URLs or arrays. It is consumed as the predictions complete.
+        :param confidence:
+        :param overlap:
+        :param save_dir: if set, the annotated images are saved there, named after the position and name of the inputs.
+        :param workers: the number of concurrent predictions.
+        :return: a generator of `(index, data, result)`, the position of the input in `inputs`, the input and
+        the JSON result of its prediction, or `{'error': message}` if the prediction failed.
+        """
+
+        if save_dir is not None:
+            os.makedirs(save_dir, exist_ok=True)
+
+        def predict_one(index, data):
+            output_path = None
+            if save_dir is not None:
+                # inputs of different folders or URLs can have the same name
+                name = os.path.splitext(os.path.basename(data))[0] if isinstance(data, str) else 'image'
+                output_path = os.path.join(save_dir, f'{index}_{name}_prediction.jpg')
+            return self.predict(data, confidence=confidence, overlap=overlap, save=save_dir is not None,
+                                output_path=output_path)
+
+        items = enumerate(inputs)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            while True:
+                # keep the pool busy without submitting every input at once
+                for index, data in items:
+                    pending[executor.submit(predict_one, index, data)] = (index, data)
+                    if len(pending) >= 2 * workers:
+                        break
+                if not pending:
+                    return
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, data = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = {'error': str(e)}
+                    yield index, data, result
@@ -0,0 +1,169 @@
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from LabelIndex import LabelIndex
+
+IMG_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+
+class DatasetShards:
+    """
+    A split of a YOLO dataset packed into a few large shard files, read through memory mapping.
+
+    A packed split is a directory holding:
+        * `shard-00000.bin`, ...: the encoded images (as they were on disk, not re-encoded), back to back
+        * `index.npz`: the name, shard, offset, length and size of each image, and its boxes in the
+          columnar layout of `LabelIndex` (`label_offsets`, `classes`, `boxes`)
+
+    Reading an image is a slice of a mapped shard instead of opening a small file, so an epoch
+    on network storage reads a few large files sequentially instead of thousands of small ones.
+    The shards are mapped lazily, once per process, so the reader can be shared by data loader workers.
+    """
+
+    INDEX = 'index.npz'
+
+    def __init__(self, path):
+        """
+        Open a packed split.
+
+        :param path: the directory of the split.
+        """
+
+        self.path = path
+        with np.load(os.path.join(path, self.INDEX)) as index:
+            self.names = index['names']
+            self.shard = index['shard']
+            self.offsets = index['offsets']
+            self.lengths = index['lengths']
+            self.widths = index['widths']
+            self.heights = index['heights']
+            self.label_offsets = index['label_offsets']
+            self.classes = index['classes']
+            self.boxes = index['boxes']
+        self._maps = {}
+        self._pid = None
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def is_packed(cls, path):
+        return os.path.isfile(os.path.join(path, cls.INDEX))
+
+    def _map(self, shard):
+        # mappings are not shared with the forked data loader workers, each process maps the shards again
+        if self._pid != os.getpid():
+            self._maps, self._pid = {}, os.getpid()
+        mapped = self._maps.get(shard)
+        if mapped is None:
+            with open(os.path.join(self.path, f'shard-{shard:05d}.bin'), 'rb') as f:
+                mapped = self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return mapped
+
+    def image_bytes(self, i):
+        """
+        :return: data: the encoded image `i`, without copy.
+        """
+
+        offset, length = int(self.offsets[i]), int(self.lengths[i])
+        return memoryview(self._map(int(self.shard[i])))[offset:offset + length]
+
+    def image(self, i, flags=cv2.IMREAD_COLOR):
+        """
+        :return: image: the decoded image `i` (BGR).
+        """
+
+        return cv2.imdecode(np.frombuffer(self.image_bytes(i), dtype=np.uint8), flags)
+
+    def labels(self, i):
+        """
+        :return: classes: the class id of each box of the image `i`.
+        :return: boxes: the normalized `x, y, w, h` of each box.
+        """
+
+        start, end = self.label_offsets[i], self.label_offsets[i + 1]
+        return self.classes[start:end], self.boxes[start:end]
+
+    @staticmethod
+    def label_path(image_path):
+        """
+        The label file of an image: next to it, or in the `labels` folder matching its `images` folder.
+        """
+
+        stem = os.path.splitext(image_path)[0]
+        if os.path.exists(stem + '.txt'):
+            return stem + '.txt'
+        sa, sb = f'{os.sep}images{os.sep}', f'{os.sep}labels{os.sep}'
+        return sb.join(stem.rsplit(sa, 1)) + '.txt'
+
+    @staticmethod
+    def read_file(image_path):
+        """
+        Read an image file, its size and its labels, in a packing thread.
+        """
+
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        with Image.open(image_path) as image:
+            width, height = image.size
+        label = DatasetShards.label_path(image_path)
+        classes, boxes = LabelIndex.parse(label) if os.path.exists(label) else ([], [])
+        return data, width, height, classes, boxes
+
+    @classmethod
+    def pack(cls, images_dir, out_dir, shard_size=1 << 30, workers=None):
+        """
+        Pack the images of a folder and their labels into shards.
+
+        :param images_dir: the folder of the images of one split.
+        :param out_dir: the directory of the packed split.
+        :param shard_size: the maximum size of a shard, in bytes.
+        :param workers: number of threads reading the files.
+        :return: shards: a `DatasetShards` reading the packed split.
+        """
+
+        paths = sorted(os.path.join(images_dir, name) for name in os.listdir(images_dir)
+                       if name.lower().endswith(IMG_EXTS))
+        os.makedirs(out_dir, exist_ok=True)
+        for name in os.listdir(out_dir):
+            if name.startswith('shard-') and name.endswith('.bin'):
+                os.remove(os.path.join(out_dir, name))
+
+        n = len(paths)
+        shard, offsets, lengths = np.zeros(n, np.int16), np.zeros(n, np.int64), np.zeros(n, np.int64)
+        widths, heights, counts = np.zeros(n, np.int32), np.zeros(n, np.int32), np.zeros(n, np.int64)
+        classes, boxes = [], []
+
+        current, f = -1, None
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # files are read ahead in parallel, one chunk at a time to bound the memory, and written in order
+                chunks = (executor.map(cls.read_file, paths[i:i + 256]) for i in range(0, n, 256))
+                for i, (data, width, height, c, b) in enumerate(item for chunk in chunks for item in chunk):
+                    if f is None or (f.tell() and f.tell() + len(data) > shard_size):
+                        if f is not None:
+                            f.close()
+                        current += 1
+                        f = open(os.path.join(out_dir, f'shard-{current:05d}.bin'), 'wb')
+                    shard[i], offsets[i], lengths[i] = current, f.tell(), len(data)
+                    widths[i], heights[i], counts[i] = width, height, len(c)
+                    f.write(data)
+                    classes.append(np.asarray(c, dtype=np.int16))
+                    boxes.append(np.asarray(b, dtype=np.float32).reshape(-1, 4))
+        finally:
+            if f is not None:
+                f.close()
+
+        tmp = os.path.join(out_dir, cls.INDEX + '.tmp.npz')
+        np.savez(tmp, names=np.array([os.path.basename(p) for p in paths], dtype=str), shard=shard,
+                 offsets=offsets, lengths=lengths, widths=widths, heights=heights,
+                 label_offsets=np.concatenate([[0], np.cumsum(counts)]),
+                 classes=np.concatenate(classes) if classes else np.zeros(0, np.int16),
+                 boxes=np.concatenate(boxes) if boxes else np.zeros((0, 4), np.float32))
+        os.replace(tmp, os.path.join(out_dir, cls.INDEX))
+        return cls(out_dir)
@@ -0,0 +1,100 @@
+import cv2
+import numpy as np
+
+
+class Detections:
+    """
+    The boxes predicted on one image, stored in a compact numpy structured array.
+
+    Boxes of a whole batch of results are converted at once by `from_results()`:
+    one tensor transfer per result and a single vectorized conversion for the batch,
+    so the cost per box stays the same whether a frame contains one object or twenty.
+    The same object is used to draw the boxes and to build the JSON sent by the backend.
+    """
+
+    DTYPE = np.dtype([
+        ('x1', np.int32), ('y1', np.int32), ('x2', np.int32), ('y2', np.int32),
+        ('confidence', np.float32), ('class_id', np.int16)
+    ])
+
+    def __init__(self, boxes, names):
+        """
+        :param boxes: a structured array of dtype `Detections.DTYPE`.
+        :param names: a dictionary `{class_id: class_name}`.
+        """
+
+        self.boxes = boxes
+        self.names = names
+
+    def __len__(self):
+        return len(self.boxes)
+
+    @classmethod
+    def from_results(cls, results):
+        """
+        Convert the results of `model.predict()` into one `Detections` per result.
+
+        :param results: the results of the prediction on a batch of images.
+        :return: detections: a list with one `Detections` per result.
+        """
+
+        if not results:
+            return []
+
+        # `boxes.data` holds `x1, y1, x2, y2, confidence, class` for each box
+        data = [r.boxes.data.cpu().numpy() for r in results]
+        counts = [len(d) for d in data]
+        data = np.concatenate(data).reshape(-1, 6) if sum(counts) else np.zeros((0, 6), dtype=np.float32)
+
+        boxes = np.empty(len(data), dtype=cls.DTYPE)
+        xyxy = np.rint(data[:, :4]).astype(np.int32)
+        boxes['x1'], boxes['y1'], boxes['x2'], boxes['y2'] = xyxy.T
+        boxes['confidence'] = np.round(data[:, 4], 3)
+        boxes['class_id'] = data[:, 5]
+
+        splits = np.cumsum(counts)[:-1]
+        return [cls(b, r.names) for b, r in zip(np.split(boxes, splits), results)]
+
+    def class_names(self):
+        """
+        :return: class_names: an array with the class name of each box.
+        """
+
+        # look the names up once per class rather than once per box
+        unique, inverse = np.unique(self.boxes['class_id'], return_inverse=True)
+        lookup = np.array([self.names.get(int(i), str(i)) for i in unique], dtype=object)
+        return lookup[inverse.reshape(-1)]
+
+    def draw(self, image, color=(0, 0, 255), thickness=2):
+        """
+        Draw every box with its class name and confidence on `image` (in place).
+
+        :param image: the image on which the boxes were predicted.
+        :param color: BGR color of the boxes.
+        :param thickness: thickness of the boxes.
+        :return: image: the annotated image.
+        """
+
+        if not len(self.boxes):
+            return image
+
+        labels = [f'{name}: {confidence:.2f}' for name, confidence in
+                  zip(self.class_names(), (self.boxes['confidence'] * 100).round(2))]
+        for (x1, y1, x2, y2, _, _), label in zip(self.boxes.tolist(), labels):
+            cv2.rectangle(image, (x1, y1), (x2, y2), color, thickness)
+            cv2.putText(img=image, text=label, org=(x1, max(y1 - 10, 10)), fontFace=cv2.FONT_HERSHEY_SIMPLEX,
+                        fontScale=0.5, color=color, thickness=1, lineType=cv2.LINE_AA)
+        return image
+
+    def to_json(self):
+        """
+        :return: detections: a list of dictionaries `{bbox, confidence, class_name, class_id}`,
+        the format used by the backend.
+        """
+
+        xyxy = np.stack([self.boxes[k] for k in ('x1', 'y1', 'x2', 'y2')], axis=1).tolist()
+        confidences = self.boxes['confidence'].astype(np.float64).round(3).tolist()
+        class_ids = self.boxes['class_id'].tolist()
+        names = self.class_names().tolist()
+        return [{'bbox': b, 'confidence': p, 'class_name': n, 'class_id': c}
+                for b, p, n, c in zip(xyxy, confidences, names, class_ids)]
@@ -0,0 +1,332 @@
+import hashlib
+import json
+import os
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from DatasetShards import IMG_EXTS, DatasetShards
+from LabelIndex import LabelIndex
+
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+
+
+def file_digest(path):
+    """
+    :return: digest: the SHA-256 of a file.
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def box_iou(a, b):
+    """
+    :return: iou: the IoU of each box of `a` (N, 4) with each box of `b` (M, 4), in `x1, y1, x2, y2`.
+    """
+
+    inter = (np.minimum(a[:, None, 2:], b[None, :, 2:]) - np.maximum(a[:, None, :2], b[None, :, :2])).clip(0).prod(2)
+    area_a = (a[:, 2:] - a[:, :2]).prod(1)
+    area_b = (b[:, 2:] - b[:, :2]).prod(1)
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-9)
+
+
+def nms(boxes, scores, classes, iou, max_det):
+    """
+    Greedy non-maximum suppression per class, as ultralytics does.
+
+    :return: keep: the indices of the kept boxes, by decreasing score.
+    """
+
+    # boxes of different classes never overlap once offset by their class
+    boxes = boxes + classes[:, None].astype(np.float32) * 4
+    order = np.argsort(-scores, kind='stable')
+    keep = []
+    while len(order) and len(keep) < max_det:
+        i, order = order[0], order[1:]
+        keep.append(i)
+        if len(order):
+            order = order[box_iou(boxes[i:i + 1], boxes[order])[0] <= iou]
+    return np.array(keep, dtype=np.int64)
+
+
+def match(pred_boxes, pred_classes, true_boxes, true_classes):
+    """
+    :return: correct: whether each prediction matches a label, at each IoU threshold (N, 10).
+    """
+
+    correct = np.zeros((len(pred_boxes), len(IOU_THRESHOLDS)), dtype=bool)
+    if not len(pred_boxes) or not len(true_boxes):
+        return correct
+    iou = box_iou(true_boxes, pred_boxes) * (true_classes[:, None] == pred_classes[None, :])
+    for t, threshold in enumerate(IOU_THRESHOLDS):
+        label, pred = np.nonzero(iou >= threshold)
+        if not len(label):
+            continue
+        # each prediction keeps its best overlap, then each label its first prediction (the most confident),
+        # as ultralytics does
+        order = np.argsort(-iou[label, pred], kind='stable')
+        label, pred = label[order], pred[order]
+        _, first = np.unique(pred, return_index=True)
+        label, pred = label[first], pred[first]
+        _, first = np.unique(label, return_index=True)
+        correct[pred[first], t] = True
+    return correct
+
+
+def smooth(y, f=0.05):
+    nf = round(len(y) * f * 2) // 2 + 1
+    p = np.ones(nf // 2)
+    return np.convolve(np.concatenate((p * y[0], y, p * y[-1])), np.ones(nf) / nf, mode='valid')
+
+
+def average_precision(recall, precision):
+    """
+    :return: ap: the area under the precision/recall curve, interpolated at 101 points (COCO).
+    """
+
+    mrec = np.concatenate(([0.0], recall, [1.0]))
+    mpre = np.flip(np.maximum.accumulate(np.flip(np.concatenate(([1.0], precision, [0.0])))))
+    x = np.linspace(0, 1, 101)
+    y = np.interp(x, mrec, mpre)
+    return float(((y[1:] + y[:-1]) / 2 * np.diff(x)).sum())
+
+
+def detection_metrics(correct, conf, pred_classes, true_classes):
+    """
+    Precision, recall and mAP of a set of predictions, computed as `ultralytics.yolo.utils.metrics.ap_per_class`.
+
+    :return: metrics: `{'precision', 'recall', 'mAP50', 'mAP50_95'}` and the mAP50-95 of each class (`maps`).
+    """
+
+    order = np.argsort(-conf, kind='stable')
+    correct, conf, pred_classes = correct[order], conf[order], pred_classes[order]
+    classes, counts = np.unique(true_classes, return_counts=True)
+
+    px = np.linspace(0, 1, 1000)
+    ap = np.zeros((len(classes), len(IOU_THRESHOLDS)))
+    p, r = np.zeros((len(classes), len(px))), np.zeros((len(classes), len(px)))
+    for ci, (c, n_labels) in enumerate(zip(classes, counts)):
+        i = pred_classes == c
+        if not i.any():
+            continue
+        tpc = correct[i].cumsum(0)
+        fpc = (1 - correct[i]).cumsum(0)
+        recall = tpc / (n_labels + 1e-16)
+        precision = tpc / (tpc + fpc)
+        r[ci] = np.interp(-px, -conf[i], recall[:, 0], left=0)
+        p[ci] = np.interp(-px, -conf[i], precision[:, 0], left=1)
+        for t in range(len(IOU_THRESHOLDS)):
+            ap[ci, t] = average_precision(recall[:, t], precision[:, t])
+
+    f1 = 2 * p * r / (p + r + 1e-16)
+    best = smooth(f1.mean(0), 0.1).argmax() if len(classes) else 0
+    return {
+        'precision': float(p[:, best].mean()) if len(classes) else 0.0,
+        'recall': float(r[:, best].mean()) if len(classes) else 0.0,
+        'mAP50': float(ap[:, 0].mean()) if len(classes) else 0.0,
+        'mAP50_95': float(ap.mean()) if len(classes) else 0.0,
+        'maps': dict(zip(classes.tolist(), ap.mean(1).tolist())),
+    }
+
+
+class EvaluationCache:
+    """
+    The raw predictions of a model on a dataset split, cached on disk to evaluate it again without inference.
+
+    The predictions are made once with a very low confidence and no suppression of overlapping boxes,
+    keeping as many boxes per image as ultralytics' suppression receives (`max_nms`), so that the duplicates
+    of a confident object never push the weaker objects out of the cache. Evaluating with a given `conf`,
+    `iou` and `max_det` only runs the non-maximum suppression and the metrics with numpy, so thresholds
+    are tuned in seconds.
+
+    A cache entry (`<cache_dir>/<key>.npz`) is keyed by the SHA-256 of the weights, a digest of
+    the images and labels of the split (names, sizes and modification times), and the inference
+    parameters. Retraining the model or editing the dataset therefore makes new predictions.
+
+    The metrics follow ultralytics' validation, but the images are letterboxed as for predictions,
+    so they can differ slightly from `YOLO.val`.
+    """
+
+    def __init__(self, cache_dir='runs/eval_cache'):
+        """
+        :param cache_dir: the folder of the cached predictions.
+        """
+
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def list_split(images_dir):
+        """
+        :return: images: the paths of the images of a split folder.
+        :return: labels: a `LabelIndex` of their label files.
+        """
+
+        images = sorted(os.path.join(images_dir, name) for name in os.listdir(images_dir)
+                        if name.lower().endswith(IMG_EXTS))
+        labels_dir = os.path.dirname(DatasetShards.label_path(images[0])) if images else images_dir
+        return images, LabelIndex.load(labels_dir)
+
+    @staticmethod
+    def dataset_digest(images, labels):
+        """
+        :return: digest: a digest of the manifest of a split, changing when an image or a label file changes.
+        """
+
+        digest = hashlib.sha256()
+        for path in images:
+            st = os.stat(path)
+            digest.update(f'{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}\n'.encode())
+        for array in (labels.names, labels.sizes, labels.mtimes):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def packed_digest(split_dir):
+        """
+        :return: digest: a digest of a split packed by `DatasetShards`, changing when it is packed again.
+        """
+
+        digest = hashlib.sha256()
+        for name in sorted(os.listdir(split_dir)):
+            st = os.stat(os.path.join(split_dir, name))
+            digest.update(f'{name}:{st.st_size}:{st.st_mtime_ns}\n'.encode())
+        return digest.hexdigest()
+
+    def key(self, weights, dataset, **params):
+        """
+        :return: key: the key of the predictions of `weights` on a split (its digest) with the inference `params`.
+        """
+
+        manifest = {'weights': file_digest(weights), 'dataset': dataset, **params}
+        return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:32]
+
+    def predictions(self, model, weights, images_dir, imgsz=640, batch=16, candidates=30000, min_conf=0.001):
+        """
+        Load the cached predictions of a model on a split, or predict the split and cache them.
+
+        :param model: the `YOLO` model.
+        :param weights: the path of its weights, to key the cache.
+        :param images_dir: the folder of the images of the split, or of a split packed by `DatasetShards`.
+        :param imgsz: image size.
+        :param batch: number of images per batch.
+        :param candidates: number of boxes kept per image before any suppression, ultralytics' `max_nms`.
+        :param min_conf: the lowest confidence that can be evaluated.
+        :return: predictions: a dictionary of arrays `names`, `offsets`, `boxes` (normalized `x1, y1, x2, y2`),
+                 `scores`, `classes`, and the label arrays `label_offsets`, `label_classes`, `label_boxes`.
+        """
+
+        if DatasetShards.is_packed(images_dir):
+            shards = DatasetShards(images_dir)
+            names, digest = shards.names.tolist(), self.packed_digest(images_dir)
+            # the images are decoded from the shards, there is no file to predict
+            images, read = list(range(len(shards))), shards.image
+            image_labels = [shards.labels(i) for i in range(len(shards))]
+        else:
+            images, labels = self.list_split(images_dir)
+            read = None
+            names, digest = [os.path.basename(p) for p in images], self.dataset_digest(images, labels)
+            rows = labels.rows()
+            image_labels = []
+            for image in images:
+                row = rows.get(os.path.splitext(os.path.basename(image))[0])
+                if row is None:
+                    image_labels.append(None)
+                    continue
+                lstart, lend = labels.offsets[row], labels.offsets[row + 1]
+                image_labels.append((labels.classes[lstart:lend], labels.boxes[lstart:lend]))
+
+        key = self.key(weights, digest, imgsz=imgsz, candidates=candidates, min_conf=min_conf)
+        path = os.path.join(self.cache_dir, f'{key}.npz')
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                return dict(cached)
+
+        boxes, scores, classes, counts = [], [], [], []
+        start = time.perf_counter()
+        speed = np.zeros(3)
+        for i in range(0, len(images), batch):
+            # iou=1 keeps every overlapping box, the suppression is done at evaluation
+            sources = images[i:i + batch] if read is None else [read(k) for k in images[i:i + batch]]
+            for result in model.predict(sources, imgsz=imgsz, conf=min_conf, iou=1.0,
+                                        max_det=candidates, stream=True, verbose=False):
+                boxes.append(result.boxes.xyxyn.cpu().numpy().astype(np.float32))
+                scores.append(result.boxes.conf.cpu().numpy().astype(np.float32))
+                classes.append(result.boxes.cls.cpu().numpy().astype(np.int16))
+                counts.append(len(scores[-1]))
+                speed += [result.speed.get(k, 0.0) for k in ('preprocess', 'inference', 'postprocess')]
+        print(f"Predicted {len(images)} images in {time.perf_counter() - start:.1f}s, cached as {key}")
+
+        label_classes, label_boxes, label_counts = [], [], []
+        for image_label in image_labels:
+            if image_label is None:
+                label_counts.append(0)
+                continue
+            label_class, xywh = image_label
+            label_classes.append(label_class)
+            label_boxes.append(np.concatenate([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, :2] + xywh[:, 2:] / 2], axis=1))
+            label_counts.append(len(label_class))
+
+        predictions = {
+            'names': np.array(names, dtype=str),
+            'offsets': np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]),
+            'boxes': np.concatenate(boxes) if boxes else np.zeros((0, 4), np.float32),
+            'scores': np.concatenate(scores) if scores else np.zeros(0, np.float32),
+            'classes': np.concatenate(classes) if classes else np.zeros(0, np.int16),
+            'label_offsets': np.concatenate([[0], np.cumsum(label_counts, dtype=np.int64)]),
+            'label_classes': np.concatenate(label_classes) if label_classes else np.zeros(0, np.int16),
+            'label_boxes': np.concatenate(label_boxes).astype(np.float32) if label_boxes else np.zeros((0, 4), np.float32),
+            'speed': speed / max(len(images), 1),
+        }
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, **predictions)
+        os.replace(tmp, path)
+        return predictions
+
+    @staticmethod
+    def evaluate(predictions, conf=0.001, iou=0.6, max_det=300):
+        """
+        Evaluate cached predictions with a confidence threshold, an NMS IoU threshold and a number of detections.
+
+        :return: metrics: `{'precision', 'recall', 'mAP50', 'mAP50_95', 'maps'}`.
+        """
+
+        offsets, label_offsets = predictions['offsets'], predictions['label_offsets']
+        correct, conf_kept, classes_kept = [], [], []
+        for i in range(len(offsets) - 1):
+            start, end = offsets[i], offsets[i + 1]
+            scores = predictions['scores'][start:end]
+            selected = np.nonzero(scores >= conf)[0]
+            boxes, classes = predictions['boxes'][start:end][selected], predictions['classes'][start:end][selected]
+            keep = nms(boxes, scores[selected], classes, iou, max_det)
+            lstart, lend = label_offsets[i], label_offsets[i + 1]
+            correct.append(match(boxes[keep], classes[keep], predictions['label_boxes'][lstart:lend],
+                                 predictions['label_classes'][lstart:lend]))
+            conf_kept.append(scores[selected][keep])
+            classes_kept.append(classes[keep])
+
+        return detection_metrics(np.concatenate(correct) if correct else np.zeros((0, 10), bool),
+                                 np.concatenate(conf_kept) if conf_kept else np.zeros(0, np.float32),
+                                 np.concatenate(classes_kept) if classes_kept else np.zeros(0, np.int16),
+                                 predictions['label_classes'])
+
+    @staticmethod
+    def results(metrics, predictions):
+        """
+        :return: results: the metrics in the layout of ultralytics' validation results (`results_dict`, `speed`),
+                 as read by `Monitor.log_performance_metrics`.
+        """
+
+        speed = dict(zip(('preprocess', 'inference', 'postprocess'), predictions['speed'].tolist()))
+        return SimpleNamespace(results_dict={
+            'metrics/precision(B)': metrics['precision'],
+            'metrics/recall(B)': metrics['recall'],
+            'metrics/mAP50(B)': metrics['mAP50'],
+            'metrics/mAP50-95(B)': metrics['mAP50_95'],
+            'fitness': 0.1 * metrics['mAP50'] + 0.9 * metrics['mAP50_95'],
+        }, speed=speed, maps=metrics['maps'])
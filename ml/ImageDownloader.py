@@ -1,7 +1,11 @@
 import os
 import shutil
+import threading
 import requests
 import json
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pixabay import image
 from simple_image_download import simple_image_download as sid
 
@@ -10,21 +14,123 @@ class ImageDownloader:
     """
     A class that contains methods to download images from Google, unsplash and pixabay
     using a simple `query` that contanins keywords.
+
+    Unsplash and pixabay images are downloaded concurrently, at most `concurrency[provider]`
+    at a time, through a shared pool of HTTP connections. Failed requests are retried with an
+    exponential backoff, and rate-limited requests (429) wait for the `Retry-After` of the provider.
+    Images are streamed to disk, and the completed ids are recorded in a `manifest.jsonl`
+    in the query directory, so an interrupted download resumes where it stopped.
     """
 
-    def __init__(self, query=None):
+    # simultaneous downloads per provider
+    CONCURRENCY = {'unsplash': 4, 'pixabay': 4}
+
+    def __init__(self, query=None, concurrency=None, timeout=30, retries=5):
         """
         Create an ImageDownloder
 
         :param query: a string that contains keyword(s) to search and download the images.
+        :param concurrency: a dictionary `{provider: simultaneous downloads}` overriding `CONCURRENCY`.
+        :param timeout: timeout of the HTTP requests, in seconds.
+        :param retries: number of retries of a failed request.
         """
 
         self.pixabay_key = '15625626-1238828730abaf9c134a2238a'
         self.unsplash_key = 'm8VNiQK6r3ETdHG9rbhvbd81O1ERoYYF4zSveI8tvlY'
+        self.unsplash_endpoint = "https://api.unsplash.com/search/photos"
         self.query = query
         self.download_dir = "downloads"
+        self.concurrency = dict(self.CONCURRENCY, **(concurrency or {}))
+        self.timeout = timeout
+        self.session = self.make_session(max(self.concurrency.values()), retries)
+        self.lock = threading.Lock()
         # self.make_dirs()
 
+    @staticmethod
+    def make_session(pool_size, retries):
+        """
+        Create a `requests.Session` keeping up to `pool_size` connections open per host,
+        and retrying the failed requests with an exponential backoff.
+        """
+
+        retry = Retry(total=retries, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=('GET',), respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def load_manifest(self, query):
+        """
+        :return: completed: the set of `(provider, id)` already downloaded for `query`.
+        """
+
+        completed = set()
+        path = os.path.join(self.download_dir, query, 'manifest.jsonl')
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line may be truncated if the download was killed while writing it
+                        continue
+                    completed.add((entry['provider'], str(entry['id'])))
+        return completed
+
+    def fetch(self, url, filename):
+        """
+        Stream `url` to `filename`. The file only appears once complete.
+        """
+
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            with open(filename + '.part', 'wb') as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+        os.replace(filename + '.part', filename)
+
+    def download_all(self, provider, query, images):
+        """
+        Download images concurrently, skipping the ones recorded in the manifest of `query`.
+
+        :param provider: the name of the provider, e.g. 'unsplash'.
+        :param query: the query, whose directory receives the images.
+        :param images: a list of `(image_id, image_url)`.
+        :return: downloaded: the number of images downloaded.
+        """
+
+        completed = self.load_manifest(query)
+        todo = [(str(image_id), url) for image_id, url in images if (provider, str(image_id)) not in completed]
+        if len(todo) < len(images):
+            print(f"Skipping {len(images) - len(todo)} images already downloaded from {provider}")
+
+        manifest_path = os.path.join(self.download_dir, query, 'manifest.jsonl')
+        if os.path.exists(manifest_path) and os.path.getsize(manifest_path):
+            # end a truncated last line, otherwise the next entry would be appended to it and lost
+            with open(manifest_path, 'rb+') as manifest:
+                manifest.seek(-1, os.SEEK_END)
+                if manifest.read(1) != b'\n':
+                    manifest.write(b'\n')
+
+        def download(item):
+            image_id, url = item
+            filename = os.path.join(self.download_dir, query, f"{image_id}.jpg")
+            try:
+                self.fetch(url, filename)
+            except (requests.RequestException, OSError) as e:
+                print(f"Failed to download {image_id}.jpg: {e}")
+                return False
+            with self.lock:
+                with open(manifest_path, 'a') as manifest:
+                    manifest.write(json.dumps({'provider': provider, 'id': image_id, 'file': f"{image_id}.jpg"}) + '\n')
+            print(f"Downloaded {image_id}.jpg")
+            return True
+
+        with ThreadPoolExecutor(max_workers=self.concurrency[provider]) as executor:
+            return sum(executor.map(download, todo))
+
     def make_dirs(self, query=None):
         """
         Create a directory to store the downloaded images.
@@ -61,7 +167,7 @@ class ImageDownloader:
         self.make_dirs(query)
 
         # Define search query and API endpoint
-        endpoint = "https://api.unsplash.com/search/photos"
+        endpoint = self.unsplash_endpoint
 
         # Set up parameters for first request
         params = {
@@ -72,24 +178,25 @@ class ImageDownloader:
         }
 
         # Send first request and get total number of pages
-        response = requests.get(endpoint, params=params)
-        data = json.loads(response.text)
+        response = self.session.get(endpoint, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
         total_pages = data["total_pages"]
 
-        # Download through each page
-        for page in range(1, total_pages):
-            params["page"] = page
-            response = requests.get(endpoint, params=params)
-            data = json.loads(response.text)
+        # List the images of every page, the first one is already there
+        images = []
+        for page in range(1, total_pages + 1):
+            if page > 1:
+                params["page"] = page
+                response = self.session.get(endpoint, params=params, timeout=self.timeout)
+                response.raise_for_status()
+                data = response.json()
 
             for result in data["results"]:
-                image_url = result["urls"]["regular"]
-                image_id = result["id"]
-                response = requests.get(image_url)
+                images.append((result["id"], result["urls"]["regular"]))
 
-                with open(f"{self.download_dir}/{self.query}/{image_id}.jpg", "wb") as f:
-                    f.write(response.content)
-                    print(f"Downloaded {image_id}.jpg")
+        # Download the images
+        return self.download_all('unsplash', query, images)
 
     def pixabay(self, query=None):
         """
@@ -105,18 +212,15 @@ class ImageDownloader:
         # create folder to store the images
         self.make_dirs(query)
 
-        image = image(self.pixabay_key)
-        results = image.search(q=query,
-                               lang='en',
-                               image_type='photo',
-                               per_page=10)
+        api = image(self.pixabay_key)
+        results = api.search(q=query,
+                             lang='en',
+                             image_type='photo',
+                             per_page=10)
 
         # Download the images
-        for i, result in enumerate(results['hits']):
-            image_url = result['largeImageURL']
-            image_id = result['id']
-            filename = os.path.join(self.download_dir, query, f"{image_id}.jpg")
-            image.download(image_url, filename)
+        images = [(result['id'], result['largeImageURL']) for result in results['hits']]
+        return self.download_all('pixabay', query, images)
 
     def simple_image_download(self, query=None, limit=100):
         """
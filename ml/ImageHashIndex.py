@@ -0,0 +1,220 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+IMG_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def phash(path):
+    """
+    Compute the perceptual hash of an image: the signs of the low frequencies of its DCT.
+    Resized, recompressed or slightly edited copies of an image have hashes at a small Hamming distance.
+
+    :return: hash: the 64 bits hash, or None if the image cannot be read.
+    :return: width: the width of the image.
+    :return: height: the height of the image.
+    """
+
+    # np.fromfile + imdecode also reads the non-ASCII paths that cv2.imread cannot open on Windows
+    image = cv2.imdecode(np.fromfile(path, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return None, 0, 0
+    height, width = image.shape
+    small = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()
+    # the DC coefficient is the mean brightness, it is left out of the median
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view('>u8')[0]), width, height
+
+
+def hash_files(paths):
+    """
+    Hash a chunk of files, in a worker process.
+    """
+
+    return [phash(path) for path in paths]
+
+
+class BKTree:
+    """
+    A BK-tree of 64 bits hashes, to find the hashes within a Hamming distance of a hash
+    without comparing it to every other hash.
+    """
+
+    def __init__(self):
+        # a node is [hash, items, {distance: child}]
+        self.root = None
+
+    @staticmethod
+    def distance(a, b):
+        return bin(a ^ b).count('1')
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            d = self.distance(value, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+        """
+        :return: matches: a list of `(distance, item)` of the items whose hash is within `radius` of `value`.
+        """
+
+        matches = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = self.distance(value, node[0])
+            if d <= radius:
+                matches += [(d, item) for item in node[1]]
+            # by the triangle inequality, only the children at distance d - radius to d + radius can match
+            stack += [child for k, child in node[2].items() if d - radius <= k <= d + radius]
+        return matches
+
+
+class ImageHashIndex:
+    """
+    The perceptual hashes of a set of images, computed by a pool of processes and cached in a `.npz` file.
+
+    The cache is updated incrementally by `build()`: only the images added or modified since the last
+    build are hashed again. `duplicates()` then groups the near-duplicate images with a `BKTree`.
+    """
+
+    def __init__(self, paths, sizes, mtimes, hashes, widths, heights):
+        """
+        :param paths: the absolute path of each image.
+        :param sizes: the size of each file, to detect the modified files.
+        :param mtimes: the modification time of each file, in nanoseconds.
+        :param hashes: the perceptual hash of each image (0 for the unreadable images).
+        :param widths: the width of each image (0 for the unreadable images).
+        :param heights: the height of each image.
+        """
+
+        self.paths = np.asarray(paths, dtype=str)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.mtimes = np.asarray(mtimes, dtype=np.int64)
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.widths = np.asarray(widths, dtype=np.int32)
+        self.heights = np.asarray(heights, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.paths)
+
+    @staticmethod
+    def walk(folders):
+        """
+        :return: files: a dictionary `{absolute path: os.stat_result}` of the images under `folders`.
+        """
+
+        files = {}
+        for folder in folders:
+            for root, _, names in os.walk(folder):
+                for name in names:
+                    if name.lower().endswith(IMG_EXTS):
+                        path = os.path.abspath(os.path.join(root, name))
+                        files[path] = os.stat(path)
+        return files
+
+    @classmethod
+    def read(cls, path):
+        """
+        Read a cache file, or return an empty index if it does not exist or cannot be read.
+        """
+
+        try:
+            with np.load(path) as data:
+                return cls(data['paths'], data['sizes'], data['mtimes'], data['hashes'], data['widths'], data['heights'])
+        except (OSError, KeyError, ValueError):
+            return cls([], [], [], [], [], [])
+
+    def write(self, path):
+        """
+        Write the index to a cache file, atomically.
+        """
+
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, paths=self.paths, sizes=self.sizes, mtimes=self.mtimes, hashes=self.hashes,
+                 widths=self.widths, heights=self.heights)
+        os.replace(tmp, path)
+
+    @classmethod
+    def build(cls, folders, cache_path, workers=None, chunk_size=64):
+        """
+        Index the images under `folders`, hashing the images that are not in the cache yet, or were modified,
+        in parallel. The images no longer in the folders are left out.
+
+        :param folders: the folders to index.
+        :param cache_path: the `.npz` cache file, updated with the new hashes.
+        :param workers: number of processes. The number of CPUs by default.
+        :param chunk_size: number of images hashed per task.
+        :return: index: an `ImageHashIndex`.
+        """
+
+        cached = cls.read(cache_path)
+        files = cls.walk(folders)
+        rows = {p: i for i, p in enumerate(cached.paths.tolist())}
+        paths = sorted(files)
+        stale = [p for p in paths if p not in rows or
+                 (cached.sizes[rows[p]], cached.mtimes[rows[p]]) != (files[p].st_size, files[p].st_mtime_ns)]
+
+        results = {}
+        if stale:
+            chunks = [stale[i:i + chunk_size] for i in range(0, len(stale), chunk_size)]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for chunk, hashed in zip(chunks, executor.map(hash_files, chunks)):
+                    results.update(zip(chunk, hashed))
+
+        hashes, widths, heights = [], [], []
+        for p in paths:
+            value, width, height = results[p] if p in results else \
+                (int(cached.hashes[rows[p]]), int(cached.widths[rows[p]]), int(cached.heights[rows[p]]))
+            hashes.append(0 if value is None else value)
+            widths.append(width)
+            heights.append(height)
+
+        print(f"{len(stale)} images hashed, {len(paths) - len(stale)} read from {cache_path}")
+        index = cls(paths, [files[p].st_size for p in paths], [files[p].st_mtime_ns for p in paths],
+                    hashes, widths, heights)
+        if stale or len(paths) != len(cached):
+            index.write(cache_path)
+        return index
+
+    def duplicates(self, threshold=6):
+        """
+        Group the near-duplicate images and choose the one to keep in each group:
+        the largest image, then the largest file, then the first path.
+
+        :param threshold: the maximum Hamming distance between the hashes of two duplicates (out of 64 bits).
+        :return: duplicates: a dictionary `{row: (kept row, distance)}` of the images to drop.
+        :return: unreadable: the rows of the images that could not be read.
+        """
+
+        readable = self.widths > 0
+        tree = BKTree()
+        for row in np.flatnonzero(readable):
+            tree.add(int(self.hashes[row]), int(row))
+
+        # visit the best images first, so that each group is represented by its best image
+        order = np.lexsort((self.paths, -self.sizes, -(self.widths.astype(np.int64) * self.heights)))
+        duplicates, assigned = {}, np.zeros(len(self), dtype=bool)
+        for row in order:
+            if not readable[row] or assigned[row]:
+                continue
+            assigned[row] = True
+            for d, other in tree.search(int(self.hashes[row]), threshold):
+                if not assigned[other]:
+                    assigned[other] = True
+                    duplicates[other] = (int(row), d)
+        return duplicates, np.flatnonzero(~readable).tolist()
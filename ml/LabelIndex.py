@@ -0,0 +1,281 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class LabelIndex:
+    """
+    The boxes of a folder of YOLO label files, parsed once and cached in a columnar `.npz` file.
+
+    Each label file is a row (its name, size and modification time), and the boxes of all the files
+    are stored in flat arrays (`classes`, `boxes`) sliced by `offsets`, so statistics over a whole
+    dataset are a few numpy operations instead of reading thousands of small `.txt` files.
+    The cache is updated incrementally: only the label files added or modified since the last
+    build are parsed again. It is kept outside the dataset, one file per labels folder in
+    `$LABEL_INDEX_CACHE` (`~/.cache/guns-detection/label_index` by default), so read-only datasets can be indexed.
+    """
+
+    CACHE_DIR = os.getenv('LABEL_INDEX_CACHE') or os.path.join(os.path.expanduser('~'), '.cache', 'guns-detection',
+                                                               'label_index')
+
+    def __init__(self, names, sizes, mtimes, offsets, classes, boxes):
+        """
+        :param names: the label names, without the `.txt` extension (the image names without extension).
+        :param sizes: the size of each label file, to detect the modified files.
+        :param mtimes: the modification time of each label file, in nanoseconds.
+        :param offsets: the boxes of the label `i` are `boxes[offsets[i]:offsets[i + 1]]`.
+        :param classes: the class id of each box.
+        :param boxes: the `x, y, w, h` of each box, relative to the image size.
+        """
+
+        self.names = np.asarray(names, dtype=str)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.mtimes = np.asarray(mtimes, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.classes = np.asarray(classes, dtype=np.int16)
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self._rows = None
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def parse(path):
+        """
+        Parse a YOLO label file. Segmentation polygons are converted to their bounding box.
+
+        :return: classes: the class id of each box.
+        :return: boxes: the `x, y, w, h` of each box.
+        """
+
+        classes, boxes = [], []
+        with open(path) as f:
+            for line in f:
+                values = line.split()
+                if len(values) < 5:
+                    continue
+                try:
+                    class_id, coords = int(float(values[0])), [float(v) for v in values[1:]]
+                except ValueError:
+                    continue
+                if class_id < 0:
+                    continue
+                if len(coords) > 4:
+                    xs, ys = coords[0::2], coords[1::2]
+                    x1, x2, y1, y2 = min(xs), max(xs), min(ys), max(ys)
+                    coords = [(x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1]
+                classes.append(class_id)
+                boxes.append(coords)
+        return classes, boxes
+
+    @classmethod
+    def cache_path(cls, folder, cache_dir=None):
+        """
+        :return: path: the cache file of a labels folder, named after the folder and a hash of its absolute path.
+        """
+
+        folder = os.path.abspath(folder)
+        key = hashlib.sha1(os.path.normcase(folder).encode()).hexdigest()[:16]
+        return os.path.join(cache_dir or cls.CACHE_DIR, f'{os.path.basename(folder)}-{key}.npz')
+
+    @classmethod
+    def load(cls, folder, entries=None, workers=None, save=True, cache_dir=None):
+        """
+        Load the index of a folder of label files, parsing the new and modified files in parallel.
+
+        :param folder: the folder of the label files.
+        :param entries: a dictionary `{name: os.DirEntry}` of the label files, if the folder was already listed.
+        :param workers: number of threads reading the label files.
+        :param save: if True, write the updated cache.
+        :param cache_dir: the folder of the cache files. `LabelIndex.CACHE_DIR` by default.
+        :return: index: a `LabelIndex`.
+        """
+
+        if entries is None:
+            entries = {}
+            if os.path.isdir(folder):
+                with os.scandir(folder) as it:
+                    entries = {os.path.splitext(e.name)[0]: e for e in it
+                               if e.is_file() and e.name.lower().endswith('.txt')}
+
+        cache_path = cls.cache_path(folder, cache_dir)
+        cached = cls.read(cache_path) if os.path.exists(cache_path) else None
+        rows = cached.rows() if cached is not None else {}
+
+        names = sorted(entries)
+        stats = [entries[name].stat() for name in names]
+        stale = [i for i, (name, st) in enumerate(zip(names, stats))
+                 if name not in rows or (cached.sizes[rows[name]], cached.mtimes[rows[name]]) != (st.st_size, st.st_mtime_ns)]
+        if cached is not None and not stale and len(names) == len(cached):
+            return cached
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            parsed = dict(zip(stale, executor.map(cls.parse, [entries[names[i]].path for i in stale])))
+
+        classes, boxes, counts = [], [], []
+        for i, name in enumerate(names):
+            if i in parsed:
+                c, b = parsed[i]
+            else:
+                start, end = cached.offsets[rows[name]], cached.offsets[rows[name] + 1]
+                c, b = cached.classes[start:end], cached.boxes[start:end]
+            classes.append(np.asarray(c, dtype=np.int16))
+            boxes.append(np.asarray(b, dtype=np.float32).reshape(-1, 4))
+            counts.append(len(c))
+
+        index = cls(names, [st.st_size for st in stats], [st.st_mtime_ns for st in stats],
+                    np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]),
+                    np.concatenate(classes) if classes else [], np.concatenate(boxes) if boxes else [])
+        if save:
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                index.write(cache_path)
+            except OSError as e:
+                # the index is still usable, it is only parsed again next time
+                print(f"Could not write the label index cache {cache_path}: {e}")
+        return index
+
+    @classmethod
+    def read(cls, path):
+        """
+        Read a cache file, or return None if it cannot be read.
+        """
+
+        try:
+            with np.load(path) as data:
+                return cls(data['names'], data['sizes'], data['mtimes'], data['offsets'], data['classes'], data['boxes'])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def write(self, path):
+        """
+        Write the index to a cache file, atomically.
+        """
+
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, names=self.names, sizes=self.sizes, mtimes=self.mtimes, offsets=self.offsets,
+                 classes=self.classes, boxes=self.boxes)
+        os.replace(tmp, path)
+
+    def rows(self):
+        """
+        :return: rows: a dictionary `{name: row}`.
+        """
+
+        if self._rows is None:
+            self._rows = {name: i for i, name in enumerate(self.names.tolist())}
+        return self._rows
+
+    def box_counts(self):
+        """
+        :return: counts: the number of boxes of each label file.
+        """
+
+        return np.diff(self.offsets)
+
+    def empty(self):
+        """
+        :return: mask: True for the label files without any box (background images).
+        """
+
+        return self.box_counts() == 0
+
+    def num_classes(self):
+        return int(self.classes.max()) + 1 if len(self.classes) else 0
+
+    def class_counts(self, num_classes=None):
+        """
+        :return: counts: the number of boxes of each class.
+        """
+
+        return np.bincount(self.classes, minlength=num_classes or self.num_classes())
+
+    def presence(self, num_classes=None):
+        """
+        :return: presence: a boolean matrix `(labels, classes)`, True if the label has a box of the class.
+        """
+
+        num_classes = num_classes or self.num_classes()
+        presence = np.zeros((len(self), num_classes), dtype=bool)
+        rows = np.repeat(np.arange(len(self)), self.box_counts())
+        presence[rows, self.classes] = True
+        return presence
+
+    def box_areas(self):
+        """
+        :return: areas: the area of each box, relative to the image area.
+        """
+
+        return self.boxes[:, 2] * self.boxes[:, 3]
+
+    def summary(self, class_names=None, rows=None):
+        """
+        Statistics of the whole index, or of a subset of its rows.
+
+        :param class_names: the name of each class id.
+        :param rows: the rows to include, all of them by default.
+        :return: summary: a dictionary with the number of labels, of empty labels, and per class
+                 the number of boxes, of images and the median box area.
+        """
+
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+        num_classes = max(self.num_classes(), len(class_names or ()))
+        counts = self.box_counts()[rows]
+        selected = np.zeros(len(self), dtype=bool)
+        selected[rows] = True
+        box_mask = np.repeat(selected, self.box_counts())
+        classes, areas = self.classes[box_mask], self.box_areas()[box_mask]
+        presence = self.presence(num_classes)[rows]
+
+        per_class = {}
+        for class_id in range(num_classes):
+            name = class_names[class_id] if class_names and class_id < len(class_names) else str(class_id)
+            class_areas = areas[classes == class_id]
+            per_class[name] = {
+                'boxes': int((classes == class_id).sum()),
+                'images': int(presence[:, class_id].sum()),
+                'median_area': float(np.median(class_areas)) if len(class_areas) else 0.0,
+            }
+        return {'labels': int(len(rows)), 'empty': int((counts == 0).sum()), 'boxes': int(counts.sum()),
+                'classes': per_class}
+
+    def stratified_split(self, names, fractions, seed=42):
+        """
+        Split images so that every class is represented in each split in proportion to `fractions`.
+
+        Each image is assigned to the stratum of its rarest class (images without boxes or without
+        label file form their own stratum), then every stratum is ordered by a hash of the seed and
+        the names, and cut by `fractions`. The split only depends on the names, the labels and the seed,
+        and adding or relabeling a few images only moves a few images between splits.
+
+        :param names: the names of the images to split, without extension.
+        :param fractions: a dictionary `{split: fraction}`, e.g. `{'train': 0.7, 'val': 0.2, 'test': 0.1}`.
+        :param seed: the seed of the shuffles.
+        :return: splits: a dictionary `{split: [names]}`.
+        """
+
+        rows = self.rows()
+        frequency = self.class_counts()
+        strata = {}
+        for name in sorted(names):
+            row = rows.get(name)
+            classes = self.classes[self.offsets[row]:self.offsets[row + 1]] if row is not None else ()
+            key = int(min(set(classes.tolist()), key=lambda c: (frequency[c], c))) if len(classes) else -1
+            strata.setdefault(key, []).append(name)
+
+        total = sum(fractions.values())
+        splits = {split: [] for split in fractions}
+        for key in sorted(strata):
+            members = sorted(strata[key], key=lambda name: hashlib.md5(f'{seed}:{name}'.encode()).digest())
+            # largest remainder rounding, so that the sizes of the splits add up to the stratum size
+            quotas = np.array([len(members) * f / total for f in fractions.values()])
+            sizes = np.floor(quotas).astype(int)
+            for i in np.argsort(sizes - quotas)[:len(members) - sizes.sum()]:
+                sizes[i] += 1
+            start = 0
+            for split, size in zip(fractions, sizes):
+                splits[split] += members[start:start + size]
+                start += size
+        return splits
@@ -1,6 +1,13 @@
+import os
+
 from ultralytics import YOLO
-from ultralytics.yolo.utils.benchmarks import benchmark
 import cv2
+import yaml
+
+from Benchmark import Benchmark
+from Detections import Detections
+from EvaluationCache import EvaluationCache
+from VideoProcessor import VideoProcessor
 
 
 class Model:
@@ -12,6 +19,7 @@ class Model:
         self.model = None
         self.hyper_parameters = {}
         self.validation_results = None
+        self.benchmark_results = None
         self.COLORS = {'red': (0, 0, 255), 'green': (0, 255, 0), 'blue': (255, 0, 0)}
 
     def build(self, pretrained, model=None):
@@ -53,11 +61,12 @@ class Model:
         self.model = YOLO(path)
 
     def fit(self, data, epochs=10, patience=3, batch_size=16, img_size=640, save=True, optimizer='SGD', verbose=False,
-            seed=123, resume=False, lr0=0.01, lrf=0.01, dropout=0.0):
+            seed=123, resume=False, lr0=0.01, lrf=0.01, dropout=0.0, **kwargs):
         """
         Train the model on the `data`.
 
         :param data: the path to the `data.yaml` file. E.g.: `datasets/Guns-3/data.yaml`.
+        A dataset packed by `pack_dataset.py` is read from its shards by a `ShardTrainer`.
         :param epochs: the number of epochs.
         :param patience: number of epochs to wait before stopping if there is no improvement.
         :param: batch_size: number of images per batch. -1 for autobatch
@@ -70,28 +79,63 @@ class Model:
         :param lr0: initial learning rate (i.e. SGD=1E-2, Adam=1E-3)
         :param lrf: final learning rate (lr0 * lrf)
         :param dropout: use dropout regularization (classify train only)
+        :param kwargs: other arguments of `YOLO.train`, e.g. `device`, `project` or `name`.
         """
 
         self.hyper_parameters.update({
             'epochs': epochs,
             'batch size': batch_size,
-            'image size': imgsz,
+            'image size': img_size,
             'optimizer': optimizer,
             'learning rate initial': lr0,
             'learning rate final': lrf,
             'dropout': dropout
         })
 
-        self.model.train(data=data, epochs=epochs, patience=patience, batch=batch_size, imgsz=img_size, save=save,
-                         optimizer=optimizer, verbose=verbose, seed=seed, resume=resume, lr0=lr0, lrf=lrf,
-                         dropout=dropout)
+        train_args = dict(data=data, epochs=epochs, patience=patience, batch=batch_size, imgsz=img_size, save=save,
+                          optimizer=optimizer, verbose=verbose, seed=seed, resume=resume, lr0=lr0, lrf=lrf,
+                          dropout=dropout, **kwargs)
+
+        if not self.is_packed(data):
+            self.model.train(**train_args)
+            return
+
+        from ShardTrainer import ShardTrainer
+        # the weights to start from: the loaded checkpoint, or the architecture when built from scratch
+        weights = getattr(self.model, 'ckpt_path', None) or self.model.cfg
+        # the callbacks added to the model, e.g. by a `Sweep`, are run by the trainer
+        trainer = ShardTrainer(overrides=dict(train_args, model=weights), _callbacks=self.model.callbacks)
+        trainer.train()
+        if os.path.isfile(trainer.best):
+            self.model = YOLO(str(trainer.best))
+        else:
+            # with `save=False` no checkpoint is written, the trained weights are only in memory
+            self.model.model = trainer.model
 
-    def evaluate(self, split='val', batch=16, conf=0.001, save_hybrid=True, save_json=True, iou=0.6,
-                 max_detect=30, imgsz=640, plots=False):
+    @staticmethod
+    def is_packed(data):
+        """
+        :return: True if `data` is the `data.yaml` of a dataset packed by `pack_dataset.py`.
+        False for the datasets known by ultralytics, e.g. 'coco128.yaml'.
+        """
+
+        if not os.path.isfile(data):
+            return False
+        with open(data) as f:
+            return bool(yaml.safe_load(f).get('packed', False))
+
+    def evaluate(self, split='val', batch=16, conf=0.001, save_hybrid=False, save_json=False, iou=0.6,
+                 max_detect=30, imgsz=640, plots=False, data=None, cache=True):
         """
         Evaluate the model on the validation data.
         Results are saved in `self.validation_results`.
 
+        The predictions of the model on the split are cached by `EvaluationCache`, keyed by the weights,
+        the dataset and `imgsz`, so evaluating again, e.g. with another `conf` or `iou`, does not run the model.
+        Ultralytics' validation, writing a `runs/detect/valN` folder, only runs when artifacts are requested
+        (`save_hybrid`, `save_json` or `plots`), with `cache=False`, or when the split cannot be read from its files.
+        A dataset packed by `pack_dataset.py` can only be evaluated from the cache, ultralytics cannot read its shards.
+
         :param split: dataset split to use for validation. 'val', 'test' or 'train'
         :parm: batch: number of images per batch. -1 is for autobatch, default is 16
         :parm conf:	object confidence threshold for detection
@@ -101,12 +145,75 @@ class Model:
         :param: max_det: maximum number of detections per image. 300 by default.
         :param: imgsz: image size. 640 by default.
         :param: plots: if True, show plots during training.
+        :param data: the path to the `data.yaml` file. The dataset the model was trained on by default.
+        :param cache: if True, evaluate from the cached predictions.
         """
 
         self.hyper_parameters.update({'validation_confidence_threshold': conf})
 
-        self.validation_results = self.model.val(split=split, batch=batch, conf=conf, save_hybrid=save_hybrid,
-                                                 save_json=save_json, iou=iou, max_det=max_detect)
+        predictions = None
+        if cache and not (save_hybrid or save_json or plots):
+            predictions = self.cached_predictions(split, data, imgsz, batch)
+        if predictions is None:
+            if self.is_packed(data or self.model.overrides.get('data') or ''):
+                raise ValueError("A packed dataset is only evaluated from the cached predictions, without "
+                                 "save_hybrid, save_json or plots, once the model is saved. Evaluate the unpacked "
+                                 "data.yaml otherwise")
+            self.validation_results = self.model.val(data=data, split=split, batch=batch, conf=conf,
+                                                     save_hybrid=save_hybrid, save_json=save_json, iou=iou,
+                                                     max_det=max_detect, imgsz=imgsz, plots=plots)
+            return self.validation_results
+
+        metrics = EvaluationCache.evaluate(predictions, conf=conf, iou=iou, max_det=max_detect)
+        self.validation_results = EvaluationCache.results(metrics, predictions)
+        return self.validation_results
+
+    def tune_thresholds(self, confs=(0.1, 0.25, 0.4, 0.5, 0.6), ious=(0.45, 0.6, 0.7), split='val', max_detect=30,
+                        imgsz=640, data=None):
+        """
+        Evaluate every combination of confidence and NMS IoU thresholds, from the cached predictions.
+        The model only runs once, for the first evaluation of these weights on the split.
+
+        :param confs: the confidence thresholds.
+        :param ious: the IoU thresholds of the non-maximum suppression.
+        :return: results: a list of dictionaries `{'conf', 'iou', 'precision', 'recall', 'mAP50', 'mAP50_95'}`,
+                 the best mAP50-95 first.
+        """
+
+        predictions = self.cached_predictions(split, data, imgsz)
+        if predictions is None:
+            raise ValueError(f"The {split} split cannot be evaluated from the cache")
+
+        results = []
+        for conf in confs:
+            for iou in ious:
+                metrics = EvaluationCache.evaluate(predictions, conf=conf, iou=iou, max_det=max_detect)
+                metrics.pop('maps')
+                results.append({'conf': conf, 'iou': iou, **metrics})
+        return sorted(results, key=lambda r: r['mAP50_95'], reverse=True)
+
+    def cached_predictions(self, split, data=None, imgsz=640, batch=16):
+        """
+        :return: predictions: the cached predictions of the model on a split (see `EvaluationCache.predictions`),
+                 or None if the weights or the images of the split are not files.
+        """
+
+        # after training, the model holds the best weights of the trainer
+        trainer = getattr(self.model, 'trainer', None)
+        weights = str(trainer.best) if trainer is not None else getattr(self.model, 'ckpt_path', None)
+        data = data or self.model.overrides.get('data')
+        if not weights or not os.path.isfile(weights) or not data or not os.path.isfile(data):
+            return None
+
+        from pack_dataset import split_dirs
+        try:
+            _, dirs = split_dirs(data)
+        except (ValueError, FileNotFoundError):
+            # several folders per split, or a missing one
+            return None
+        if split not in dirs:
+            return None
+        return EvaluationCache().predictions(self.model, weights, dirs[split], imgsz=imgsz, batch=max(batch, 1))
 
     def predict(self, source, conf=0.25, stream=False, save=True, save_txt=True, save_conf=True, line_thickness=3):
         """
@@ -136,7 +243,7 @@ class Model:
 
         self.hyper_parameters.update({'prediction_confidence_threshold': conf})
 
-        results = self.model.predict(source=source, conf=conf, stream=stream, save=True, save_txt=save_txt,
+        results = self.model.predict(source=source, conf=conf, stream=stream, save=save, save_txt=save_txt,
                                      save_conf=save_conf, line_thickness=line_thickness)
 
         return results
@@ -150,31 +257,36 @@ class Model:
         :return: pred_image: an image with predicted bounding boxes.
         """
 
-        if color in self.COLORS.keys():
-            color = self.COLORS.get(color)
-        else:
-            color = self.COLORS.get('red')
-
-        pred_image = pred_results[0].plot()
-        # pred_results = self.predict(source=image)
-        # pred_image = self.draw_predicted_boxes(pred_results, color=color)
+        pred_results = self.model.predict(source=image, verbose=False)
+        pred_image = self.draw_predicted_boxes(pred_results, color=color)
 
         return pred_image
 
-    def predict_video(self, video_path, title='Predicted Video', color=None):
+    def predict_video(self, video_path, title='Predicted Video', color=None, show=True, output_path=None,
+                      track_path=None, batch_size=8, stride=1, conf=0.25):
         """
-        TODO: Save the video just like you do with the images
-
         Make inference on a video and draw predicted bounding boxes.
 
+        With `show=False`, the video is processed headless by a `VideoProcessor`:
+        frames are decoded, predicted in batches and encoded on separate threads,
+        the annotated video is saved to `output_path` and the detections to `track_path`.
+        Use it on servers or to reprocess archived footage.
+
         :param video_path: a video
         :param title: the title of the frame used to show the video
+        :param color: the color used to draw the predictions
+        :param show: if True, show the video with cv2. If False, process it without a display.
+        :param output_path: headless only. Where to save the annotated video.
+        :param track_path: headless only. Where to save the detections (`.json` or `.csv`).
+        :param batch_size: headless only. Number of frames per inference batch.
+        :param stride: headless only. Process one frame every `stride` frames.
+        :param conf: object confidence threshold for detection
+        :return: stats: headless only. Number of frames, detections and throughput.
         """
 
-        if color in self.COLORS.keys():
-            color = self.COLORS.get(color)
-        else:
-            color = self.COLORS.get('red')
+        if not show:
+            processor = VideoProcessor(self, batch_size=batch_size, stride=stride, conf=conf, color=color)
+            return processor.process(video_path, output_path=output_path, track_path=track_path)
 
         cap = cv2.VideoCapture(video_path)
 
@@ -185,12 +297,12 @@ class Model:
 
             if success:
                 # Run YOLOv8 inference on the frame
-
-                results = self.model.predict(source=frame)
+                results = self.model.predict(source=frame, conf=conf, verbose=False)
 
                 # get the predicted image with annotations
-                # annotated_frame = results[0].plot()
-                annotated_frame = self.draw_predicted_boxes(results)
+                annotated_frame = self.draw_predicted_boxes(results, color=color)
+                if annotated_frame is None:
+                    annotated_frame = frame
 
                 # Display the annotated frame
                 cv2.imshow(title, annotated_frame)
@@ -208,11 +320,14 @@ class Model:
 
     def draw_predicted_boxes(self, pred_results, color=None):
         """
-        Draw the predicted bounding boxes on the image.
+        Draw every predicted bounding box on the image, with its class name and confidence.
         Note that predicted boxes can be retrieved with `pred_results[i].plot()`.
 
+        The boxes of all the results are converted at once by `Detections.from_results()`.
+
         :param pred_results: the results of the prediction. They are returned by `modelpredict()`
-        :return: predicted_image: the image with predicted boxes.
+        :param color: the color used to draw the predictions
+        :return: predicted_image: the image of the last result, with its predicted boxes.
         """
         if color in self.COLORS.keys():
             color = self.COLORS.get(color)
@@ -221,34 +336,8 @@ class Model:
 
         predicted_image = None
 
-        # draw the predicted bounding boxes in the image
-        for pred in pred_results:
-            # get bounding box coordinates
-
-            # check if gun coordinates are present
-            if pred.boxes.xywh.tolist():
-                bbox = pred.boxes.xywh.tolist()[0]
-                bbox = np.array(bbox, dtype=int)
-
-                original_image = pred.orig_img
-
-                # x and y are the center of the box, so we put the at the top left
-                w = bbox[2]
-                h = bbox[3]
-                x = int(bbox[0] - w / 2)
-                y = int(bbox[1] - h / 2)
-
-                # draw the bounding box
-                predicted_image = cv2.rectangle(original_image, (x, y), (x + w, y + h), color, 2)
-
-                # draw class name and confidence
-                class_name = pred.names.get(0)
-                confidence = np.array(pred.boxes.conf)[0]
-                confidence = np.round(confidence * 100, 2)
-                text = class_name + ': ' + str(confidence)
-
-                cv2.putText(img=predicted_image, text=text, org=(x, y-10), fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=0.5,
-                    color=color, thickness=1, lineType=cv2.LINE_AA)
+        for pred, detections in zip(pred_results, Detections.from_results(pred_results)):
+            predicted_image = detections.draw(pred.orig_img, color=color)
 
         return predicted_image
 
@@ -265,7 +354,11 @@ class Model:
         cv2.waitKey(0)
         cv2.destroyAllWindows()
 
-    def export(self, format):
+    # formats accepted by `export()`, see: https://docs.ultralytics.com/modes/export/#export-formats
+    EXPORT_FORMATS = ('torchscript', 'onnx', 'openvino', 'engine', 'coreml', 'saved_model', 'pb', 'tflite',
+                      'edgetpu', 'tfjs', 'paddle')
+
+    def export(self, format, imgsz=640, half=False, int8=False, dynamic=False, **kwargs):
         """
         Export the model to the specifed `format`.
 
@@ -273,28 +366,57 @@ class Model:
         * `tfjs`: the Tensorflow JS format. Use it to train a model on web browsers.
         * `saved_model`: the Tensorfow format.
 
-        See all format here: https://docs.ultralytics.com/modes/val/#arguments
+        See all format here: https://docs.ultralytics.com/modes/export/#export-formats
 
         :param format: the format in which to export the model
+        :param imgsz: image size
+        :param half: FP16 quantization
+        :param int8: INT8 quantization
+        :param dynamic: dynamic batch size and image size (ONNX, OpenVINO, TensorRT)
+        :param kwargs: other export arguments, e.g. `data` for INT8 calibration
+        :return: path: the path to the exported model.
         """
 
-        self.model.export(format=format)
+        if format not in self.EXPORT_FORMATS:
+            raise ValueError(f'Unknown export format `{format}`. Available formats are {self.EXPORT_FORMATS}')
+        if half and int8:
+            raise ValueError('`half` and `int8` cannot be used together')
+        if self.model is None:
+            raise ValueError('No model to export. Call `build()` or `load()` first')
+
+        return self.model.export(format=format, imgsz=imgsz, half=half, int8=int8, dynamic=dynamic, **kwargs)
 
-    def benchmark(self):
+    def benchmark(self, data, formats=None, img_sizes=(320, 640), precisions=('fp32', 'fp16', 'int8'),
+                  batch_sizes=(1, 4, 8), runs=50, validate=True, output_dir='benchmarks'):
+        """
+        Find the optimal export format by exporting the model to several CPU formats
+        (PyTorch, TorchScript, ONNX, OpenVINO, TFLite) at several image sizes and precisions.
+
+        It provides, for each combination:
+            * latency p50/p95/p99 in milliseconds per image
+            * throughput at several batch sizes
+            * memory used and size of the exported model
+            * mAP50 and mAP50-95 on the validation split and their delta against PyTorch fp32
+
+        The results are saved in `self.benchmark_results` and in a report in `output_dir`.
+        See `Benchmark`.
+
+        :param data: the path to the `data.yaml` file.
+        :param formats: the formats to compare. All by default.
+        :param img_sizes: the image sizes to compare.
+        :param precisions: the precisions to compare: 'fp32', 'fp16', 'int8'.
+        :param batch_sizes: the batch sizes used to measure the throughput.
+        :param runs: number of measured inferences.
+        :param validate: if True, compute the mAP of each export on the validation split.
+        :param output_dir: where to write `benchmark.csv` and `benchmark.md`.
+        :return: benchmark_results: a list with the measures of each combination.
         """
-        TODO:
-        This allows us to find the optimal export format
-        by providing metrics on various export formats for YOLOv8.
 
-        It provides:
-            * speed and accuracy
-            * size
-            * mAP50-95 (object detection) or accuracy_top5  (classification)
-            * inference time in milliseconds per image
+        bench = Benchmark(self, data, formats=formats, img_sizes=img_sizes, precisions=precisions,
+                          batch_sizes=batch_sizes, runs=runs, validate=validate, output_dir=output_dir)
+        self.benchmark_results = bench.run()
 
-        :return:
-        """
-        self.benchmark = benchmark(model=self.model)
+        return self.benchmark_results
 
     def track(self, data):
         """
@@ -1,27 +1,236 @@
-from comet_ml import Experiment
+import atexit
+import json
 import os
+import queue
+import threading
+import time
+import uuid
 from dotenv import load_dotenv
 
+try:
+    from comet_ml import Experiment, ExistingExperiment
+except ImportError:
+    # only the offline mode is available
+    Experiment = ExistingExperiment = None
+
+
+class LocalExperiment:
+    """
+    A stand-in for a Comet `Experiment` keeping everything logged in memory, used by the offline mode.
+    """
+
+    def __init__(self):
+        self.alive = True
+        self.parameters = {}
+        self.metrics = []
+        self.models = []
+        self.ended = False
+
+    def log_parameters(self, parameters):
+        self.parameters.update(parameters)
+
+    def log_metrics(self, metrics, step=None, epoch=None):
+        self.metrics.append((dict(metrics), step))
+
+    def log_model(self, name, file_or_folder):
+        self.models.append((name, file_or_folder))
+
+    def end(self):
+        self.ended = True
+
+    def get_key(self):
+        return 'local'
+
 
 class Monitor:
     """
     This class acts as an interface to interact with Comet.
     It contanis methods to log the hyperparameters, performances metrics and upload the model to Comet.
 
+    Logging never blocks the caller: the calls are put on a queue and a background thread
+    appends them to a local spool file (`<spool_dir>/<id>.jsonl`), then sends them to Comet
+    in batches. When Comet cannot be reached (no network, no API key, comet_ml not installed),
+    the events stay in the spool, the thread tries again every `retry_interval` seconds and once
+    more when the experiment ends, and what is still not sent can be sent later with
+    `Monitor.replay()`. With `offline=True` (or `MONITOR_OFFLINE=1`), nothing is sent and
+    `self.experiment` is a `LocalExperiment` holding what was logged, e.g. for tests.
+
     See: https://www.comet.com/becayesoft/guns-detection
     """
 
-    def __init__(self, project_name="Guns-Detection", workspace="becayesoft"):
+    def __init__(self, project_name="Guns-Detection", workspace="becayesoft", offline=None, spool_dir=None,
+                 batch_size=100, retry_interval=60):
+        """
+        Create a Monitor.
+
+        :param project_name: the Comet project.
+        :param workspace: the Comet workspace.
+        :param offline: if True, never connect to Comet. `$MONITOR_OFFLINE` by default.
+        :param spool_dir: the folder of the spool files. `$MONITOR_SPOOL` or 'comet_spool' by default.
+        :param batch_size: maximum number of events sent at once.
+        :param retry_interval: seconds between two attempts to reach Comet.
+        """
+
         load_dotenv('credentials.env')
-        key = os.getenv('COMET_API_KEY')
+        self.project_name = project_name
+        self.workspace = workspace
+        self.offline = offline if offline is not None else os.getenv('MONITOR_OFFLINE', '0') == '1'
+        self.spool_dir = spool_dir or os.getenv('MONITOR_SPOOL') or 'comet_spool'
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+
+        self.id = time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:8]
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.spool_path = os.path.join(self.spool_dir, f'{self.id}.jsonl')
+        with open(self.spool_path, 'w') as f:
+            f.write(json.dumps({'type': 'experiment', 'project_name': project_name, 'workspace': workspace}) + '\n')
+
+        # the Comet experiment is created by the background thread, on the first batch
+        self.experiment = LocalExperiment() if self.offline else None
+        self.key = None
+        self.pending = []
+        self.sent = 0
+        self.last_attempt = None
 
-        self.experiment = Experiment(
-            api_key=key,
-            project_name=project_name,
-            workspace=workspace,
-            log_code=True
-        )
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='monitor', daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
 
+    def _run(self):
+        ended = False
+        while not ended:
+            events = []
+            try:
+                # wakes up while idle to retry the pending events
+                events.append(self.queue.get(timeout=self.retry_interval))
+            except queue.Empty:
+                pass
+            while events and len(events) < self.batch_size:
+                try:
+                    events.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not events and not self.pending:
+                continue
+
+            ended = any(event['type'] == 'end' for event in events)
+            try:
+                if events:
+                    with open(self.spool_path, 'a') as f:
+                        f.writelines(json.dumps(event, default=to_json) + '\n' for event in events)
+                    self.pending.extend(events)
+                # the last chance to send before the thread exits
+                self._send(force=ended)
+            except Exception as e:
+                print(f"Monitor: logging failed ({e})")
+            finally:
+                for _ in events:
+                    self.queue.task_done()
+
+    def _send(self, force=False):
+        """
+        Send the pending events, if Comet can be reached.
+
+        :param force: if True, try to reach Comet even if the last attempt failed less than `retry_interval` ago.
+        """
+
+        if self.experiment is None:
+            if not force and self.last_attempt is not None and time.time() - self.last_attempt < self.retry_interval:
+                return
+            self.last_attempt = time.time()
+            # after a failure, the events are sent to the same experiment
+            self.experiment = self.connect(self.project_name, self.workspace, self.key)
+            if self.experiment is None:
+                return
+            self.key = self.experiment.get_key()
+            self.save_state(self.spool_path, self.key, self.sent)
+
+        try:
+            send_events(self.experiment, self.pending)
+            # comet_ml disables an experiment that lost its connection, and then drops what is logged
+            if not self.experiment.alive:
+                raise ConnectionError("the experiment is not alive")
+        except Exception as e:
+            print(f"Monitor: Comet unreachable, events kept in {self.spool_path} ({e})")
+            if not self.offline:
+                self.experiment, self.last_attempt = None, time.time()
+            return
+        self.sent += len(self.pending)
+        self.pending = []
+        if not self.offline:
+            self.save_state(self.spool_path, self.key, self.sent)
+
+    @staticmethod
+    def connect(project_name, workspace, key=None):
+        """
+        :return: experiment: a Comet experiment, the existing experiment `key` if given, or None if Comet is unavailable.
+        """
+
+        api_key = os.getenv('COMET_API_KEY')
+        if Experiment is None or not api_key:
+            return None
+        try:
+            if key:
+                experiment = ExistingExperiment(api_key=api_key, previous_experiment=key)
+            else:
+                experiment = Experiment(api_key=api_key, project_name=project_name, workspace=workspace, log_code=True)
+        except Exception as e:
+            print(f"Monitor: cannot reach Comet ({e})")
+            return None
+        if not experiment.alive:
+            print("Monitor: cannot reach Comet (the experiment is not alive)")
+            return None
+        return experiment
+
+    @staticmethod
+    def save_state(spool_path, key, sent):
+        with open(spool_path + '.state.tmp', 'w') as f:
+            json.dump({'key': key, 'sent': sent}, f)
+        os.replace(spool_path + '.state.tmp', os.path.splitext(spool_path)[0] + '.state.json')
+
+    @classmethod
+    def replay(cls, spool_dir='comet_spool'):
+        """
+        Send to Comet the events spooled by monitors that could not reach it, e.g. of offline runs.
+
+        :param spool_dir: the folder of the spool files.
+        :return: replayed: the number of events sent.
+        """
+
+        load_dotenv('credentials.env')
+        replayed = 0
+        for name in sorted(os.listdir(spool_dir)):
+            if not name.endswith('.jsonl'):
+                continue
+            path = os.path.join(spool_dir, name)
+            state_path = os.path.splitext(path)[0] + '.state.json'
+            state = {'key': None, 'sent': 0}
+            if os.path.exists(state_path):
+                with open(state_path) as f:
+                    state = json.load(f)
+            with open(path) as f:
+                header, *events = [json.loads(line) for line in f if line.strip()]
+            if len(events) <= state['sent']:
+                continue
+
+            experiment = cls.connect(header['project_name'], header['workspace'], state['key'])
+            if experiment is None:
+                raise ConnectionError(f"Comet is unavailable, {replayed} events were replayed")
+            send_events(experiment, events[state['sent']:])
+            if not experiment.alive:
+                raise ConnectionError(f"Comet disconnected, {replayed} events were replayed")
+            replayed += len(events) - state['sent']
+            cls.save_state(path, experiment.get_key(), len(events))
+        return replayed
+
+    def flush(self):
+        """
+        Wait until everything logged so far is spooled and, if possible, sent.
+        """
+
+        if self.thread.is_alive():
+            self.queue.join()
 
     def log_hyper_parameters(self, hyper_params):
         """
@@ -31,7 +240,7 @@ class Monitor:
         :param pred_confidence: confidence used to make new predictions.
         """
 
-        self.experiment.log_parameters(hyper_params)
+        self.queue.put({'type': 'parameters', 'value': hyper_params})
 
 
     def log_performance_metrics(self, val_results):
@@ -51,13 +260,23 @@ class Monitor:
             "fitness": val_results.results_dict['fitness']
         }
         for key, value in performance_metrics.items():
-            performance_metrics[key] = round(value, 3)
+            performance_metrics[key] = round(float(value), 3)
 
         # Add speed metrics
         performance_metrics.update(val_results.speed)
 
-        # log to comet
-        self.experiment.log_metrics(performance_metrics, step=None, epoch=None)
+        self.log_metrics(performance_metrics)
+
+
+    def log_metrics(self, metrics, step=None):
+        """
+        Log any metrics, e.g. the results of a sweep trial.
+
+        :param metrics: a dictionary `{name: value}`.
+        :param step: the step (e.g. epoch) of the metrics.
+        """
+
+        self.queue.put({'type': 'metrics', 'value': metrics, 'step': step})
 
 
     def upload_model(self, path_to_model, name='YOLOv8'):
@@ -67,13 +286,43 @@ class Monitor:
         :param path_to_model: the path to the model. E.g: 'runs/detect/train18/weights/best.pt'
         """
 
-        self.experiment.log_model(name=name, file_or_folder=path)
+        self.queue.put({'type': 'model', 'name': name, 'path': os.path.abspath(path_to_model)})
 
 
-    def end_experiment():
+    def end_experiment(self):
         """
-        End the experiment.
+        End the experiment, once everything logged is spooled and, if possible, sent.
         """
 
-        self.experiment.end()
+        self.queue.put({'type': 'end'})
+        self.thread.join()
+
+
+def to_json(value):
+    # numpy scalars, e.g. in the validation results
+    return value.item() if hasattr(value, 'item') else str(value)
+
+
+def send_events(experiment, events):
+    """
+    Send spooled events to an experiment, merging the consecutive metrics of a same step into one call.
+    """
 
+    i = 0
+    while i < len(events):
+        event = events[i]
+        if event['type'] == 'metrics':
+            metrics = dict(event['value'])
+            # a metric logged twice at the same step is kept as two calls
+            while (i + 1 < len(events) and events[i + 1]['type'] == 'metrics' and events[i + 1]['step'] == event['step']
+                   and not metrics.keys() & events[i + 1]['value'].keys()):
+                i += 1
+                metrics.update(events[i]['value'])
+            experiment.log_metrics(metrics, step=event['step'])
+        elif event['type'] == 'parameters':
+            experiment.log_parameters(event['value'])
+        elif event['type'] == 'model':
+            experiment.log_model(name=event['name'], file_or_folder=event['path'])
+        elif event['type'] == 'end':
+            experiment.end()
+        i += 1
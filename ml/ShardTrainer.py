@@ -0,0 +1,133 @@
+import math
+import os
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, distributed
+
+from DatasetShards import DatasetShards
+
+try:
+    # ultralytics 8.0.x, pinned in requirements.txt
+    from ultralytics.yolo.data import build
+    from ultralytics.yolo.data.dataset import YOLODataset
+    from ultralytics.yolo.data.utils import PIN_MEMORY
+    from ultralytics.yolo.utils import RANK, colorstr
+    from ultralytics.yolo.utils.torch_utils import de_parallel
+    from ultralytics.yolo.v8.detect import DetectionTrainer
+    LEGACY = True
+except ImportError:
+    from ultralytics.data import build
+    from ultralytics.data.dataset import YOLODataset
+    from ultralytics.models.yolo.detect import DetectionTrainer
+    from ultralytics.utils import RANK, colorstr
+    from ultralytics.utils.torch_utils import de_parallel
+    LEGACY = False
+
+
+class ShardDataset(YOLODataset):
+    """
+    A `YOLODataset` reading a split packed by `DatasetShards` instead of image and label files.
+
+    The labels come from the index of the shards, so no label file is opened nor cached,
+    and the images are decoded from the mapped shards. The augmentations are unchanged.
+    """
+
+    def get_img_files(self, img_path):
+        self.shards = DatasetShards(img_path)
+        # the image names are only used to identify the images in logs and plots
+        return [f'{img_path}/{name}' for name in self.shards.names.tolist()]
+
+    def get_labels(self):
+        labels = []
+        for i, im_file in enumerate(self.im_files):
+            classes, boxes = self.shards.labels(i)
+            labels.append({
+                'im_file': im_file,
+                'shape': (int(self.shards.heights[i]), int(self.shards.widths[i])),
+                'cls': classes.astype(np.float32).reshape(-1, 1),
+                'bboxes': boxes.astype(np.float32).reshape(-1, 4),
+                'segments': [],
+                'keypoints': None,
+                'normalized': True,
+                'bbox_format': 'xywh',
+            })
+        return labels
+
+    def load_image(self, i):
+        """
+        Same as `BaseDataset.load_image`, reading the image from the shards.
+        """
+
+        if self.ims[i] is not None:
+            return self.ims[i], self.im_hw0[i], self.im_hw[i]
+
+        im = self.shards.image(i)
+        if im is None:
+            raise FileNotFoundError(f'Image Not Found {self.im_files[i]}')
+        h0, w0 = im.shape[:2]
+        r = self.imgsz / max(h0, w0)
+        if r != 1:
+            interp = cv2.INTER_LINEAR if (self.augment or r > 1) else cv2.INTER_AREA
+            im = cv2.resize(im, (min(math.ceil(w0 * r), self.imgsz), min(math.ceil(h0 * r), self.imgsz)),
+                            interpolation=interp)
+
+        # keep the last images for the mosaic augmentation, as the base dataset does
+        if self.augment and hasattr(self, 'buffer'):
+            self.ims[i], self.im_hw0[i], self.im_hw[i] = im, (h0, w0), im.shape[:2]
+            self.buffer.append(i)
+            if len(self.buffer) >= self.max_buffer_length:
+                j = self.buffer.pop(0)
+                self.ims[j], self.im_hw0[j], self.im_hw[j] = None, None, None
+
+        return im, (h0, w0), im.shape[:2]
+
+
+class ShardTrainer(DetectionTrainer):
+    """
+    A `DetectionTrainer` reading the packed splits of a `data.yaml` written by `pack_dataset.py`.
+    Splits that are not packed are read from their files as usual.
+    """
+
+    def shard_dataset(self, img_path, mode='train', batch=None):
+        """
+        :return: dataset: a `ShardDataset` of a packed split, with the options of ultralytics' `YOLODataset`.
+        """
+
+        args = self.args
+        stride = max(int(de_parallel(self.model).stride.max() if self.model else 0), 32)
+        options = dict(img_path=str(img_path), imgsz=args.imgsz, batch_size=batch, augment=mode == 'train', hyp=args,
+                       rect=args.rect or mode == 'val', cache=args.cache or None, single_cls=args.single_cls or False,
+                       stride=stride, pad=0.0 if mode == 'train' else 0.5, prefix=colorstr(f'{mode}: '),
+                       classes=args.classes)
+        if LEGACY:
+            options.update(use_segments=False, use_keypoints=False, data=self.data)
+        else:
+            options.update(task=args.task, data=self.data, fraction=args.fraction if mode == 'train' else 1.0)
+        return ShardDataset(**options)
+
+    if LEGACY:
+        def get_dataloader(self, dataset_path, batch_size, mode='train', rank=0):
+            if not DatasetShards.is_packed(str(dataset_path)):
+                return super().get_dataloader(dataset_path, batch_size, mode, rank)
+
+            # the loader of `build.build_dataloader`, for a dataset built by `shard_dataset`
+            dataset = self.shard_dataset(dataset_path, mode, batch_size)
+            batch = min(batch_size, len(dataset))
+            shuffle = mode == 'train'
+            workers = self.args.workers if mode == 'train' else self.args.workers * 2
+            workers = min(os.cpu_count() // max(torch.cuda.device_count(), 1), batch if batch > 1 else 0, workers)
+            sampler = None if rank == -1 else distributed.DistributedSampler(dataset, shuffle=shuffle)
+            # the workers must be restarted when the mosaic is closed, an infinite loader keeps them
+            loader = DataLoader if self.args.image_weights or self.args.close_mosaic else build.InfiniteDataLoader
+            generator = torch.Generator()
+            generator.manual_seed(6148914691236517205 + RANK)
+            return loader(dataset=dataset, batch_size=batch, shuffle=shuffle and sampler is None, num_workers=workers,
+                          sampler=sampler, pin_memory=PIN_MEMORY,
+                          collate_fn=dataset.collate_fn, worker_init_fn=build.seed_worker, generator=generator)
+    else:
+        def build_dataset(self, img_path, mode='train', batch=None):
+            if not DatasetShards.is_packed(str(img_path)):
+                return super().build_dataset(img_path, mode, batch)
+            return self.shard_dataset(img_path, mode, batch)
@@ -0,0 +1,244 @@
+import json
+import math
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from Model import Model
+
+
+def sample(space, rng):
+    """
+    Draw one configuration from a search space.
+
+    :param space: a dictionary `{argument: values}`, where values is a list to choose from,
+                  `('uniform', low, high)` or `('log', low, high)`.
+    :param rng: a `random.Random`.
+    """
+
+    params = {}
+    for name, values in space.items():
+        if isinstance(values, tuple) and values and values[0] in ('uniform', 'log'):
+            kind, low, high = values
+            params[name] = rng.uniform(low, high) if kind == 'uniform' else \
+                math.exp(rng.uniform(math.log(low), math.log(high)))
+        else:
+            params[name] = rng.choice(list(values))
+    return params
+
+
+def should_stop(rungs, lock, epoch, score, reduction):
+    """
+    Asynchronous successive halving: record the score of a trial at a rung, and stop the trial
+    if it is not in the best `1 / reduction` of the scores recorded at this rung so far.
+    """
+
+    with lock:
+        recorded = rungs.get(epoch, []) + [score]
+        rungs[epoch] = recorded
+    if len(recorded) < reduction:
+        return False
+    return score < np.quantile(recorded, 1 - 1 / reduction)
+
+
+def run_trial(trial_id, params, settings, rungs, lock):
+    """
+    Train one configuration, in a worker process.
+
+    :return: trial: its parameters, per-epoch history, final metrics and status ('completed', 'pruned' or 'failed').
+    """
+
+    try:
+        import torch
+        torch.set_num_threads(settings['threads'])
+    except ImportError:
+        pass
+
+    trial = {'id': trial_id, 'params': params, 'history': [], 'status': 'completed', 'started': time.time()}
+    params = dict(params)
+    # `model` is searched with the other arguments, but is not an argument of `fit`
+    base = params.pop('model', settings['model'])
+    model = Model()
+    if settings.get('weights'):
+        model.load(settings['weights'])
+    else:
+        model.build(pretrained=True, model=base)
+
+    def on_fit_epoch_end(trainer):
+        epoch = trainer.epoch + 1
+        metrics = {
+            'epoch': epoch,
+            'mAP50': float(trainer.metrics.get('metrics/mAP50(B)', 0.0)),
+            'mAP50_95': float(trainer.metrics.get('metrics/mAP50-95(B)', 0.0)),
+            'inference_ms': float(trainer.validator.speed.get('inference', 0.0)) if trainer.validator else 0.0,
+            'epoch_time': float(getattr(trainer, 'epoch_time', 0.0) or 0.0),
+        }
+        metrics['score'] = metrics['mAP50_95'] - settings['cost_weight'] * metrics['inference_ms']
+        trial['history'].append(metrics)
+        if epoch in settings['rungs'] and should_stop(rungs, lock, epoch, metrics['score'], settings['reduction']):
+            trial['status'] = 'pruned'
+            # the trainer checks `stop` right after this callback
+            trainer.stop = True
+
+    model.model.add_callback('on_fit_epoch_end', on_fit_epoch_end)
+    try:
+        model.fit(data=settings['data'], epochs=settings['epochs'], patience=settings['epochs'], **params,
+                  device=settings['device'], project=settings['project'], name=f'trial_{trial_id}', exist_ok=True)
+    except Exception as e:
+        trial.update(status='failed', error=str(e))
+
+    trial['duration'] = time.time() - trial.pop('started')
+    trial['final'] = trial['history'][-1] if trial['history'] else None
+    return trial
+
+
+class Sweep:
+    """
+    Search the `Model.fit` arguments (lr0, lrf, batch_size, img_size, optimizer, dropout, ...) giving the best model.
+
+    Configurations are sampled at random from the search space, and trained in parallel by a pool
+    of processes. Unpromising trials are stopped early by asynchronous successive halving (ASHA):
+    at the rungs `grace_period * reduction ** k` epochs, a trial continues only if its score is among
+    the best `1 / reduction` recorded at that rung.
+
+    The score of an epoch is its validation mAP50-95, minus `cost_weight` times the inference time
+    in milliseconds per image, so that a positive `cost_weight` favors faster models.
+    Every finished trial is appended to `<output_dir>/trials.jsonl` and a sweep started again with
+    the same arguments skips the trials already recorded, except the failed ones (e.g. out of memory),
+    which are tried again. `<output_dir>/results.json` holds the best trial and the speed/accuracy Pareto front.
+    """
+
+    def __init__(self, data, space, trials=16, epochs=30, grace_period=3, reduction=3, workers=2, threads=None,
+                 cost_weight=0.0, model='yolov8n', weights=None, device='cpu', output_dir='sweeps/sweep',
+                 seed=0, on_trial_end=None):
+        """
+        Create a Sweep.
+
+        :param data: the path to the `data.yaml` file.
+        :param space: the search space, see `sample()`. A `model` key searches over the pre-trained models.
+        :param trials: number of configurations tried.
+        :param epochs: maximum number of epochs of a trial.
+        :param grace_period: number of epochs before a trial can be stopped.
+        :param reduction: 1 / reduction of the trials continue at each rung.
+        :param workers: number of trials trained at the same time.
+        :param threads: number of threads of each trial. The CPUs are shared between the workers by default.
+        :param cost_weight: mAP50-95 points traded for one millisecond of inference per image.
+        :param model: the pre-trained model the trials start from.
+        :param weights: or the weights the trials start from, e.g. 'runs/detect/train18/weights/best.pt'.
+        :param device: the device of the trials, e.g. 'cpu' or '0'.
+        :param output_dir: where the trials and results are recorded.
+        :param seed: the seed of the sampling.
+        :param on_trial_end: a function called with each finished trial, e.g. to forward it to a `Monitor`.
+        """
+
+        self.data = data
+        self.space = space
+        self.trials = trials
+        self.epochs = epochs
+        self.reduction = reduction
+        self.rungs = []
+        rung = grace_period
+        while rung < epochs:
+            self.rungs.append(rung)
+            rung *= reduction
+        self.workers = workers
+        self.threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        self.cost_weight = cost_weight
+        self.model = model
+        self.weights = weights
+        self.device = device
+        self.output_dir = output_dir
+        self.seed = seed
+        self.on_trial_end = on_trial_end
+
+    def configurations(self):
+        """
+        :return: configurations: the parameters of every trial, always the same for the same seed.
+        """
+
+        rng = random.Random(self.seed)
+        return [sample(self.space, rng) for _ in range(self.trials)]
+
+    def load_trials(self):
+        """
+        :return: trials: the trials recorded by a previous run, by id. The failed trials are left out, to run them again.
+        """
+
+        trials = {}
+        path = os.path.join(self.output_dir, 'trials.jsonl')
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        trial = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if trial['status'] == 'failed':
+                        trials.pop(trial['id'], None)
+                    else:
+                        trials[trial['id']] = trial
+        return trials
+
+    def run(self):
+        """
+        Run the sweep.
+
+        :return: results: the best trial, the Pareto front and all the trials.
+        """
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        settings = {'data': self.data, 'epochs': self.epochs, 'rungs': self.rungs, 'reduction': self.reduction,
+                    'threads': self.threads, 'cost_weight': self.cost_weight, 'model': self.model,
+                    'weights': self.weights, 'device': self.device,
+                    'project': os.path.abspath(os.path.join(self.output_dir, 'runs'))}
+
+        trials = self.load_trials()
+        todo = [(i, params) for i, params in enumerate(self.configurations()) if i not in trials]
+        if trials:
+            print(f"{len(trials)} trials already recorded in {self.output_dir}")
+
+        with multiprocessing.Manager() as manager:
+            rungs, lock = manager.dict(), manager.Lock()
+            # the rungs start with the scores of the recorded trials
+            for trial in trials.values():
+                for metrics in trial['history']:
+                    if metrics['epoch'] in self.rungs:
+                        rungs[metrics['epoch']] = rungs.get(metrics['epoch'], []) + [metrics['score']]
+
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(run_trial, i, params, settings, rungs, lock) for i, params in todo]
+                for future in as_completed(futures):
+                    trial = future.result()
+                    trials[trial['id']] = trial
+                    with open(os.path.join(self.output_dir, 'trials.jsonl'), 'a') as f:
+                        f.write(json.dumps(trial) + '\n')
+                    final = trial['final'] or {}
+                    print(f"Trial {trial['id']} {trial['status']} after {len(trial['history'])} epochs: "
+                          f"mAP50-95 {final.get('mAP50_95', 0):.3f}, {final.get('inference_ms', 0):.1f} ms {trial['params']}")
+                    if self.on_trial_end is not None:
+                        self.on_trial_end(trial)
+
+        results = self.summarize(list(trials.values()))
+        with open(os.path.join(self.output_dir, 'results.json'), 'w') as f:
+            json.dump(results, f, indent=2)
+        return results
+
+    @staticmethod
+    def summarize(trials):
+        """
+        :return: results: the best completed trial by score, and the completed trials for which no other
+                 trial is both more accurate and faster (the Pareto front).
+        """
+
+        completed = [t for t in trials if t['status'] == 'completed' and t['final']]
+        best = max(completed, key=lambda t: t['final']['score'], default=None)
+        front = [t for t in completed if not any(
+            o['final']['mAP50_95'] >= t['final']['mAP50_95'] and o['final']['inference_ms'] <= t['final']['inference_ms']
+            and (o['final']['mAP50_95'], o['final']['inference_ms']) != (t['final']['mAP50_95'], t['final']['inference_ms'])
+            for o in completed)]
+        front.sort(key=lambda t: t['final']['inference_ms'])
+        return {'best': best, 'pareto_front': front, 'trials': sorted(trials, key=lambda t: t['id'])}
@@ -0,0 +1,259 @@
+import csv
+import json
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+from Detections import Detections
+
+
+class VideoProcessor:
+    """
+    Run YOLOv8 inference on a video file without opening any window.
+
+    Frames are decoded, classified and encoded on three stages connected by
+    bounded queues, so decoding, inference and writing overlap:
+        * a decode thread reads the video and keeps one frame every `stride`.
+        * the calling thread runs batched inference on the decoded frames.
+        * an encode thread draws the boxes, writes the annotated video and
+          records every detection in a track file (JSON or CSV).
+    """
+
+    def __init__(self, model, batch_size=8, stride=1, conf=0.25, imgsz=640, queue_size=64, color=None,
+                 progress_interval=5.0):
+        """
+        Create a VideoProcessor.
+
+        :param model: a `Model` object with loaded weights.
+        :param batch_size: number of frames sent to the model at once.
+        :param stride: process one frame every `stride` frames. The other frames are skipped without being decoded.
+        :param conf: object confidence threshold for detection.
+        :param imgsz: inference image size.
+        :param queue_size: maximum number of frames waiting between two stages.
+        :param color: the color used to draw the predictions.
+        :param progress_interval: number of seconds between two progress reports. `None` to disable them.
+        """
+
+        if stride < 1:
+            raise ValueError('`stride` must be greater or equal to 1')
+        if batch_size < 1:
+            raise ValueError('`batch_size` must be greater or equal to 1')
+
+        self.model = model
+        self.batch_size = batch_size
+        self.stride = stride
+        self.conf = conf
+        self.imgsz = imgsz
+        self.queue_size = queue_size
+        self.color = color
+        self.progress_interval = progress_interval
+
+    def process(self, video_path, output_path=None, track_path=None, track=None):
+        """
+        Process the whole video.
+
+        :param video_path: the video to analyse.
+        :param output_path: where to write the annotated video (`.mp4` or `.avi`). `None` to skip it.
+        :param track_path: where to write the detections, `.json` or `.csv`. `None` to skip it.
+        :param track: an optional list to which the detections are appended, to use them without reading the track file.
+        :return: stats: a dictionary with the number of frames, detections, elapsed time and throughput.
+        """
+
+        cap = cv2.VideoCapture(video_path)
+        if not cap.isOpened():
+            raise IOError(f'Could not open video: {video_path}')
+
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+        writer = None
+        if output_path is not None:
+            fourcc = cv2.VideoWriter_fourcc(*('XVID' if output_path.lower().endswith('.avi') else 'mp4v'))
+            writer = cv2.VideoWriter(output_path, fourcc, fps / self.stride, (width, height))
+
+        decoded = queue.Queue(maxsize=self.queue_size)
+        predicted = queue.Queue(maxsize=self.queue_size)
+        errors = []
+        stop = threading.Event()
+        if track is None:
+            track = []
+        stats = {'frames_read': 0, 'frames_processed': 0, 'detections': 0}
+
+        decoder = threading.Thread(target=self._decode, args=(cap, decoded, stop, errors, stats), daemon=True)
+        encoder = threading.Thread(target=self._encode, args=(predicted, writer, fps, track, stop, errors, stats),
+                                   daemon=True)
+
+        start = time.perf_counter()
+        decoder.start()
+        encoder.start()
+
+        try:
+            self._infer(decoded, predicted, total_frames, fps, start, stop, stats)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            predicted.put(None)
+            encoder.join()
+            stop.set()
+            decoder.join()
+            cap.release()
+            if writer is not None:
+                writer.release()
+
+        if errors:
+            raise errors[0]
+
+        if track_path is not None:
+            self.save_track(track, track_path)
+
+        elapsed = time.perf_counter() - start
+        stats.update({
+            'elapsed_seconds': round(elapsed, 3),
+            'processing_fps': round(stats['frames_processed'] / elapsed, 2) if elapsed > 0 else 0.0,
+            'realtime_factor': round(stats['frames_read'] / fps / elapsed, 2) if elapsed > 0 else 0.0,
+        })
+
+        return stats
+
+    def _decode(self, cap, decoded, stop, errors, stats):
+        """
+        Read the video and put `(frame_index, frame)` in the `decoded` queue.
+        Frames that are skipped by the stride are grabbed but never decoded.
+        """
+
+        index = 0
+        try:
+            while not stop.is_set():
+                if index % self.stride == 0:
+                    success, frame = cap.read()
+                    if not success:
+                        break
+                    self._put(decoded, (index, frame), stop)
+                else:
+                    if not cap.grab():
+                        break
+                index += 1
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            stats['frames_read'] = index
+            self._put(decoded, None, stop)
+
+    def _infer(self, decoded, predicted, total_frames, fps, start, stop, stats):
+        """
+        Group the decoded frames in batches, run the model on them
+        and forward each frame with its `Detections` to the `predicted` queue.
+        Stops as soon as another stage failed.
+        """
+
+        last_report = start
+        done = False
+
+        while not done and not stop.is_set():
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    item = decoded.get(timeout=0.1)
+                except queue.Empty:
+                    if stop.is_set():
+                        return
+                    continue
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+
+            if not batch or stop.is_set():
+                break
+
+            results = self.model.model.predict(source=[frame for _, frame in batch], conf=self.conf, imgsz=self.imgsz,
+                                               verbose=False)
+            for (index, frame), detections in zip(batch, Detections.from_results(results)):
+                predicted.put((index, frame, detections))
+
+            stats['frames_processed'] += len(batch)
+
+            now = time.perf_counter()
+            if self.progress_interval is not None and now - last_report >= self.progress_interval:
+                last_report = now
+                self._report(batch[-1][0], total_frames, fps, now - start, stats)
+
+    def _encode(self, predicted, writer, fps, track, stop, errors, stats):
+        """
+        Draw the boxes on each frame, write it to the video and record the detections.
+        """
+
+        try:
+            while True:
+                item = predicted.get()
+                if item is None:
+                    break
+
+                index, frame, detections = item
+                time_s = round(index / fps, 3)
+                track.extend({'frame': index, 'time': time_s, **d} for d in detections.to_json())
+                stats['detections'] += len(detections)
+
+                if writer is not None:
+                    writer.write(detections.draw(frame, color=self.model.COLORS.get(self.color, (0, 0, 255))))
+        except Exception as e:
+            errors.append(e)
+            # stop decoding and inference, and keep draining so the inference stage never blocks on a full queue
+            stop.set()
+            while predicted.get() is not None:
+                pass
+
+    @staticmethod
+    def _put(q, item, stop):
+        """
+        Put `item` in the bounded queue `q`, giving up if `stop` is set.
+        """
+
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    @staticmethod
+    def _report(index, total_frames, fps, elapsed, stats):
+        """
+        Print the progress and the throughput.
+        """
+
+        processed = stats['frames_processed']
+        progress = f'{index + 1}/{total_frames}' if total_frames > 0 else f'{index + 1}'
+        print(f'Frame {progress} | {processed / elapsed:.1f} frames/s | '
+              f'{(index + 1) / fps / elapsed:.2f}x real time | {stats["detections"]} detections')
+
+    @staticmethod
+    def save_track(track, path):
+        """
+        Save the detections to `path`. The format is chosen from the extension: `.csv` or `.json`.
+
+        :param track: a list of detections, as built by `process()`.
+        :param path: the path to the track file.
+        """
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        if path.lower().endswith('.csv'):
+            fields = ['frame', 'time', 'class_id', 'class_name', 'confidence', 'x1', 'y1', 'x2', 'y2']
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(fields)
+                writer.writerows([d['frame'], d['time'], d['class_id'], d['class_name'], d['confidence'], *d['bbox']]
+                                 for d in track)
+        else:
+            with open(path, 'w') as f:
+                json.dump(track, f)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+dedupe_images.py
+Find the duplicate and near-duplicate images of a scraped dataset, e.g. the same picture
+downloaded from Google, Unsplash and Pixabay for several queries.
+
+The perceptual hash of every image is computed by a pool of processes and cached in
+`--index`, so later runs only hash the new images. Near-duplicates, whose hashes differ by at
+most `--threshold` bits, are found with a BK-tree. In each group of duplicates the largest
+image is kept.
+
+The decisions are written to `--manifest`, one JSON line per image:
+   {"path": ..., "action": "keep", "hash": "c3a1..."}
+   {"path": ..., "action": "drop", "hash": "c3a5...", "duplicate_of": ..., "distance": 3, "threshold": 6}
+Unreadable images are dropped with `"reason": "unreadable"`. Nothing is deleted: give the manifest to
+`yolov8env/prepare_yolo_dataset.py --dedupe_manifest` to leave the dropped images out of the dataset,
+so that near-identical images cannot end up in both train and val.
+
+Usage example:
+   python dedupe_images.py --src downloads --threshold 6 --workers 8
+"""
+import argparse
+import json
+import os
+
+from ImageHashIndex import ImageHashIndex
+
+
+def write_manifest(path, index, duplicates, unreadable, threshold):
+    """
+    Write the keep/drop decision of every image of the index, with its perceptual hash,
+    used to recognize the copies of the dropped images.
+    """
+
+    unreadable = set(unreadable)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        for row, image in enumerate(index.paths.tolist()):
+            record = {'path': image, 'action': 'keep'}
+            if row not in unreadable:
+                record['hash'] = f'{int(index.hashes[row]):016x}'
+            if row in duplicates:
+                kept, distance = duplicates[row]
+                record.update(action='drop', duplicate_of=str(index.paths[kept]), distance=distance,
+                              threshold=threshold)
+            elif row in unreadable:
+                record.update(action='drop', reason='unreadable')
+            f.write(json.dumps(record) + '\n')
+    os.replace(tmp, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--src', nargs='+', default=['downloads'], help='Folders of images, searched recursively')
+    parser.add_argument('--threshold', type=int, default=6, help='Maximum Hamming distance between duplicates (0-64)')
+    parser.add_argument('--index', default='image_hashes.npz', help='Cache of the perceptual hashes')
+    parser.add_argument('--manifest', default='dedupe.jsonl', help='Output keep/drop manifest')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes hashing images (default: CPUs)')
+    args = parser.parse_args(argv)
+
+    index = ImageHashIndex.build(args.src, args.index, workers=args.workers)
+    duplicates, unreadable = index.duplicates(args.threshold)
+    write_manifest(args.manifest, index, duplicates, unreadable, args.threshold)
+
+    print(f"{len(index)} images: {len(index) - len(duplicates) - len(unreadable)} kept, "
+          f"{len(duplicates)} duplicates and {len(unreadable)} unreadable images dropped")
+    print("Manifest:", os.path.abspath(args.manifest))
+
+
+if __name__ == '__main__':
+    main()
@@ -40,4 +40,5 @@ model.export(format='onnx')
 monitor = Monitor(project_name='Guns-Detecions-YOLOv8')
 monitor.log_hyper_parameters(model.hyper_parameters)
 monitor.log_performance_metrics(model.validation_results)
-monitor.upload_model(path='runs/detect/train18/weights/best.pt', name='guns_model')
+monitor.upload_model(path_to_model='runs/detect/train18/weights/best.pt', name='guns_model')
+monitor.end_experiment()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+pack_dataset.py
+Pack a YOLO dataset into a few large shard files per split, read through memory mapping
+during training (see `DatasetShards.py`). Use it when the data loader is slowed down by
+reading thousands of small images and label files, e.g. on network storage.
+
+The packed dataset has its own `data.yaml`, with the same classes, which `Model.fit`
+recognizes and reads with a `ShardTrainer`:
+   python pack_dataset.py --data datasets/gun_datasets/data.yaml --out datasets/gun_datasets_packed
+   model.fit(data='datasets/gun_datasets_packed/data.yaml')
+
+Images are stored as they are (not re-encoded). Packing again overwrites the previous shards.
+"""
+import argparse
+import os
+
+import yaml
+
+from DatasetShards import DatasetShards
+
+SPLITS = ('train', 'val', 'test')
+
+
+def split_dirs(data_yaml):
+    """
+    Resolve the image folder of each split of a `data.yaml`.
+
+    :return: data: the content of the `data.yaml`.
+    :return: dirs: a dictionary `{split: images folder}`.
+    :raises ValueError: if a split has several folders.
+    :raises FileNotFoundError: if the folder of a split does not exist.
+    """
+
+    with open(data_yaml) as f:
+        data = yaml.safe_load(f)
+
+    roots = [os.path.dirname(os.path.abspath(data_yaml))]
+    if data.get('path'):
+        # `path` is relative to the working directory, or to the folder of the yaml
+        roots = [data['path'], os.path.join(roots[0], data['path'])] + roots
+
+    dirs = {}
+    for split in SPLITS:
+        value = data.get(split)
+        if not value:
+            continue
+        if not isinstance(value, str):
+            raise ValueError(f"{split}: only a single images folder per split can be packed, got {value}")
+        # Roboflow exports use paths like `../train/images`, relative to the dataset folder
+        candidates = [os.path.join(root, v) for root in roots for v in (value, value.lstrip('./'))]
+        found = next((c for c in candidates if os.path.isdir(c)), None)
+        if found is None:
+            raise FileNotFoundError(f"{split}: images folder {value} not found")
+        dirs[split] = found
+    return data, dirs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', required=True, help='data.yaml of the dataset to pack')
+    parser.add_argument('--out', required=True, help='Destination folder of the packed dataset')
+    parser.add_argument('--shard_size', type=int, default=1024, help='Maximum size of a shard, in MB')
+    parser.add_argument('--workers', type=int, default=None, help='Number of threads reading the files')
+    args = parser.parse_args(argv)
+
+    try:
+        data, dirs = split_dirs(args.data)
+    except (ValueError, FileNotFoundError) as e:
+        raise SystemExit(e)
+    packed = {'path': os.path.abspath(args.out), 'packed': True, 'nc': data.get('nc'), 'names': data['names']}
+    for split, images_dir in dirs.items():
+        shards = DatasetShards.pack(images_dir, os.path.join(args.out, split), args.shard_size << 20, args.workers)
+        size = int(shards.lengths.sum())
+        print(f"{split}: {len(shards)} images, {len(shards.classes)} boxes, "
+              f"{int(shards.shard.max()) + 1 if len(shards) else 0} shards ({size / 2 ** 20:.1f} MB)")
+        packed[split] = split
+
+    # ultralytics requires a validation split
+    packed.setdefault('val', packed.get('test', 'train'))
+    with open(os.path.join(args.out, 'data.yaml'), 'w') as f:
+        yaml.safe_dump({k: v for k, v in packed.items() if v is not None}, f, sort_keys=False)
+    print("Done. Train with:", os.path.join(args.out, 'data.yaml'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+run_sweep.py
+Search the training arguments of `Model.fit` with a `Sweep` (see `Sweep.py`): random configurations
+trained in parallel on the CPUs, the unpromising ones being stopped early (ASHA) on their validation mAP.
+
+   python run_sweep.py --data datasets/gun_datasets/data.yaml --trials 16 --epochs 30 --workers 2
+   python run_sweep.py --data datasets/gun_datasets/data.yaml --space space.yaml --cost_weight 0.002
+
+The search space is a YAML file mapping each argument to a list of choices, or to a range:
+   lr0: {log: [0.0001, 0.01]}
+   dropout: {uniform: [0.0, 0.3]}
+   optimizer: [SGD, AdamW]
+   model: [yolov8n, yolov8s]
+
+Trials are recorded in `<out>/trials.jsonl`, so an interrupted sweep resumes with the same arguments,
+and the best trial and the speed/accuracy Pareto front in `<out>/results.json`.
+"""
+import argparse
+
+import yaml
+
+from Sweep import Sweep
+
+DEFAULT_SPACE = {
+    'lr0': ('log', 1e-4, 1e-2),
+    'lrf': ('log', 1e-3, 1e-1),
+    'batch_size': [8, 16, 32],
+    'img_size': [416, 512, 640],
+    'optimizer': ['SGD', 'Adam', 'AdamW'],
+    'dropout': ('uniform', 0.0, 0.3),
+}
+
+
+def load_space(path):
+    """
+    Read a search space from a YAML file, ranges being written `{log: [low, high]}` or `{uniform: [low, high]}`.
+    """
+
+    with open(path) as f:
+        space = yaml.safe_load(f)
+    for name, values in space.items():
+        if isinstance(values, dict):
+            (kind, (low, high)), = values.items()
+            space[name] = (kind, float(low), float(high))
+    return space
+
+
+def forward_to_monitor(project_name):
+    """
+    :return: on_trial_end: a function logging each trial as a Comet experiment.
+    """
+
+    from Monitor import Monitor
+
+    def on_trial_end(trial):
+        monitor = Monitor(project_name=project_name)
+        monitor.log_hyper_parameters(dict(trial['params'], trial=trial['id'], status=trial['status']))
+        for metrics in trial['history']:
+            monitor.log_metrics({k: v for k, v in metrics.items() if k != 'epoch'}, step=metrics['epoch'])
+        monitor.end_experiment()
+
+    return on_trial_end
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', required=True, help='data.yaml of the dataset')
+    parser.add_argument('--space', default=None, help='YAML file of the search space (default: lr0, lrf, '
+                                                     'batch_size, img_size, optimizer, dropout)')
+    parser.add_argument('--trials', type=int, default=16, help='Number of configurations')
+    parser.add_argument('--epochs', type=int, default=30, help='Maximum number of epochs of a trial')
+    parser.add_argument('--grace_period', type=int, default=3, help='Epochs before a trial can be stopped')
+    parser.add_argument('--reduction', type=int, default=3, help='1 / reduction of the trials continue at each rung')
+    parser.add_argument('--workers', type=int, default=2, help='Number of trials trained at the same time')
+    parser.add_argument('--threads', type=int, default=None, help='Number of threads of each trial')
+    parser.add_argument('--cost_weight', type=float, default=0.0,
+                        help='mAP50-95 traded for 1 ms of inference per image, 0 to only maximize the mAP')
+    parser.add_argument('--model', default='yolov8n', help='Pre-trained model the trials start from')
+    parser.add_argument('--weights', default=None, help='Or the weights the trials start from')
+    parser.add_argument('--device', default='cpu', help="Device of the trials, e.g. 'cpu' or '0'")
+    parser.add_argument('--out', default='sweeps/sweep', help='Folder of the results')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the sampling')
+    parser.add_argument('--monitor_project', default=None, help='Also log each trial to this Comet project')
+    args = parser.parse_args(argv)
+
+    sweep = Sweep(args.data, load_space(args.space) if args.space else DEFAULT_SPACE, trials=args.trials,
+                  epochs=args.epochs, grace_period=args.grace_period, reduction=args.reduction,
+                  workers=args.workers, threads=args.threads, cost_weight=args.cost_weight, model=args.model,
+                  weights=args.weights, device=args.device, output_dir=args.out, seed=args.seed,
+                  on_trial_end=forward_to_monitor(args.monitor_project) if args.monitor_project else None)
+    results = sweep.run()
+
+    best = results['best']
+    if best is None:
+        print("No trial completed.")
+        return
+    print(f"Best: trial {best['id']}, mAP50-95 {best['final']['mAP50_95']:.3f}, "
+          f"{best['final']['inference_ms']:.1f} ms, {best['params']}")
+    print("Pareto front (inference ms, mAP50-95):")
+    for trial in results['pareto_front']:
+        print(f"  trial {trial['id']}: {trial['final']['inference_ms']:.1f} ms, {trial['final']['mAP50_95']:.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+scan_archive.py
+Scan a directory tree of recorded footage and images for guns.
+
+Files are distributed across a pool of processes, each one loading the model once.
+Images are predicted in batches, videos are processed headless by a `VideoProcessor`.
+Only the positives are written to `--dest` (annotated images, detection tracks for videos),
+together with a compact `index.jsonl` (one line per positive file).
+
+Every finished file is recorded in a checkpoint manifest, so an interrupted scan
+can be started again with the same command and will skip the files already scanned.
+Files that failed (unreadable, corrupt, model error) are recorded with their error
+and scanned again by the next run, as are the files modified since they were scanned.
+
+Usage example:
+   python scan_archive.py --src "D:\\footage" --dest scans\\footage --weights runs/detect/train18/weights/best.pt --workers 4
+"""
+import argparse
+import json
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+
+from Detections import Detections
+from Model import Model
+from VideoProcessor import VideoProcessor
+
+IMG_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+VIDEO_EXTS = ('.mp4', '.avi', '.mov', '.mkv', '.m4v', '.wmv', '.mpg', '.mpeg')
+
+# the model of the worker process, loaded once by `init_worker`
+_model = None
+_settings = {}
+
+
+def init_worker(weights, settings, threads):
+    """
+    Load the model once per worker process.
+
+    :param weights: path to the model's weights.
+    :param settings: the scan settings shared by all tasks (conf, dest, stride, ...).
+    :param threads: number of threads each worker is allowed to use for inference.
+    """
+    global _model, _settings
+
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+    _model = Model()
+    _model.load(weights)
+    _settings = settings
+
+
+def walk(src):
+    """
+    List the images and videos under `src`.
+
+    :return: files: a list of `(path, size, mtime)` sorted by path.
+    """
+
+    files = []
+    for root, _, names in os.walk(src):
+        for name in names:
+            if name.lower().endswith(IMG_EXTS + VIDEO_EXTS):
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                files.append((path, st.st_size, int(st.st_mtime)))
+    files.sort()
+    return files
+
+
+def load_manifest(path):
+    """
+    Load the checkpoint manifest of a previous scan.
+
+    :return: done: a dictionary `{path: (size, mtime)}` of the files already scanned.
+    """
+
+    done = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line may be truncated if the scan was killed while writing it
+                    continue
+                if 'error' in entry:
+                    # failed files are scanned again
+                    done.pop(entry['path'], None)
+                else:
+                    done[entry['path']] = (entry['size'], entry['mtime'])
+    return done
+
+
+def drop_from_index(path, rescanned):
+    """
+    Remove from the index the previous results of the files scanned again, e.g. after they were modified.
+
+    :param rescanned: the set of paths scanned again.
+    """
+
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        lines = f.readlines()
+    kept = []
+    for line in lines:
+        try:
+            if json.loads(line)['path'] in rescanned:
+                continue
+        except json.JSONDecodeError:
+            continue
+        kept.append(line)
+    if len(kept) < len(lines):
+        with open(path + '.tmp', 'w') as f:
+            f.writelines(kept)
+        os.replace(path + '.tmp', path)
+
+
+def make_tasks(files, batch_size):
+    """
+    Group the images in batches. Each video is a task of its own.
+    """
+
+    tasks, images = [], []
+    for file in files:
+        if file[0].lower().endswith(VIDEO_EXTS):
+            tasks.append(('video', [file]))
+        else:
+            images.append(file)
+            if len(images) == batch_size:
+                tasks.append(('images', images))
+                images = []
+    if images:
+        tasks.append(('images', images))
+    return tasks
+
+
+def output_path(path, suffix=None):
+    """
+    Mirror `path` from the source tree into the destination tree.
+    """
+
+    relative = os.path.relpath(path, _settings['src'])
+    out = os.path.join(_settings['dest'], 'positives', relative)
+    if suffix is not None:
+        out = os.path.splitext(out)[0] + suffix
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    return out
+
+
+def scan_images(files):
+    """
+    Predict a batch of images and save the annotated positives.
+    """
+
+    frames = [cv2.imread(path) for path, _, _ in files]
+    records = [{'path': path, 'size': size, 'mtime': mtime, 'kind': 'image', 'detections': []}
+               for path, size, mtime in files]
+
+    readable = [i for i, frame in enumerate(frames) if frame is not None]
+    for i in set(range(len(files))) - set(readable):
+        records[i]['error'] = 'unreadable'
+
+    if readable:
+        predictions = _model.model.predict(source=[frames[i] for i in readable], conf=_settings['conf'],
+                                           imgsz=_settings['imgsz'], verbose=False)
+        for i, detections in zip(readable, Detections.from_results(predictions)):
+            if len(detections):
+                records[i]['detections'] = detections.to_json()
+                records[i]['output'] = output_path(records[i]['path'])
+                cv2.imwrite(records[i]['output'], detections.draw(frames[i], color=_model.COLORS['red']))
+
+    return records
+
+
+def scan_video(files):
+    """
+    Process a video headless and keep its track only if something was detected.
+    """
+
+    path, size, mtime = files[0]
+    record = {'path': path, 'size': size, 'mtime': mtime, 'kind': 'video', 'detections': []}
+
+    track = []
+    processor = VideoProcessor(_model, batch_size=_settings['batch'], stride=_settings['stride'],
+                               conf=_settings['conf'], imgsz=_settings['imgsz'], progress_interval=None)
+    stats = processor.process(path, track=track)
+
+    record['frames'] = stats['frames_read']
+    if track:
+        record['output'] = output_path(path, suffix='.track.json')
+        VideoProcessor.save_track(track, record['output'])
+        record['detections'] = [{'class_name': name,
+                                 'count': sum(1 for d in track if d['class_name'] == name),
+                                 'first_seen': min(d['time'] for d in track if d['class_name'] == name),
+                                 'confidence': max(d['confidence'] for d in track if d['class_name'] == name)}
+                                for name in sorted({d['class_name'] for d in track})]
+    return [record]
+
+
+def failed(task, error):
+    """
+    The records of the files of a task that failed.
+    """
+
+    kind, files = task
+    return [{'path': path, 'size': size, 'mtime': mtime, 'kind': kind.rstrip('s'), 'detections': [],
+             'error': error} for path, size, mtime in files]
+
+
+def scan(task):
+    kind, files = task
+    try:
+        return scan_images(files) if kind == 'images' else scan_video(files)
+    except Exception as e:
+        # a corrupt file or a model error only fails its own task
+        return failed(task, f'{type(e).__name__}: {e}')
+
+
+def main(args):
+    os.makedirs(args.dest, exist_ok=True)
+    manifest_path = os.path.join(args.dest, 'manifest.jsonl')
+    index_path = os.path.join(args.dest, 'index.jsonl')
+
+    files = walk(args.src)
+    done = load_manifest(manifest_path)
+    todo = [f for f in files if done.get(f[0]) != (f[1], f[2])]
+    print(f"Found {len(files)} files, {len(files) - len(todo)} already scanned, {len(todo)} to scan")
+    if not todo:
+        return
+
+    # the modified files are scanned again, their previous results are replaced
+    drop_from_index(index_path, {f[0] for f in todo if f[0] in done})
+
+    tasks = make_tasks(todo, args.batch)
+    settings = {'src': args.src, 'dest': args.dest, 'conf': args.conf, 'imgsz': args.imgsz,
+                'batch': args.batch, 'stride': args.stride}
+    threads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    scanned, positives, errors = 0, 0, 0
+    start = time.perf_counter()
+    with open(manifest_path, 'a') as manifest, open(index_path, 'a') as index, \
+            ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                initargs=(args.weights, settings, threads)) as pool:
+        futures = {pool.submit(scan, task): task for task in tasks}
+        for future in as_completed(futures):
+            try:
+                records = future.result()
+            except Exception as e:
+                # e.g. a worker process killed while decoding
+                records = failed(futures[future], f'{type(e).__name__}: {e}')
+            for record in records:
+                if record['detections']:
+                    index.write(json.dumps({k: record[k] for k in ('path', 'kind', 'output', 'detections')}) + '\n')
+                    positives += 1
+                entry = {k: record[k] for k in ('path', 'size', 'mtime', 'error') if k in record}
+                manifest.write(json.dumps(entry) + '\n')
+                errors += 'error' in record
+                scanned += 1
+            # flush after every task so that the checkpoint survives a crash
+            index.flush()
+            manifest.flush()
+            elapsed = time.perf_counter() - start
+            print(f"Scanned {scanned}/{len(todo)} files ({scanned / elapsed:.1f} files/s), {positives} positives, "
+                  f"{errors} errors")
+
+    print("Done. Index:", os.path.abspath(index_path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--src', required=True, help='Directory tree containing the images and videos to scan')
+    parser.add_argument('--dest', default='scans', help='Where to write the positives, the index and the manifest')
+    parser.add_argument('--weights', default='runs/detect/train18/weights/best.pt', help='Model weights')
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2), help='Number of processes')
+    parser.add_argument('--batch', type=int, default=16, help='Images (or video frames) per inference batch')
+    parser.add_argument('--conf', type=float, default=0.25, help='Object confidence threshold')
+    parser.add_argument('--imgsz', type=int, default=640, help='Inference image size')
+    parser.add_argument('--stride', type=int, default=5, help='Process one video frame every `stride` frames')
+    main(parser.parse_args())
@@ -0,0 +1,138 @@
+"""
+Tests of `DataFlow.predict_batch` with a stand-in for the Roboflow model, run with `python -m pytest test_dataflow.py`
+from `ml/`.
+"""
+import os
+import sys
+import threading
+import time
+import types
+
+# only the predictions are tested, roboflow and python-dotenv may be missing
+sys.modules.setdefault('roboflow', types.SimpleNamespace(Roboflow=None))
+sys.modules.setdefault('dotenv', types.SimpleNamespace(load_dotenv=lambda path: None))
+
+from DataFlow import DataFlow
+
+
+class FakePrediction:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return {'predictions': [{'class': 'gun', 'image': self.data}]}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write(self.data)
+
+
+class FakeModel:
+    """Stands in for a Roboflow model, counting its calls and the predictions running at the same time."""
+
+    def __init__(self, delay=0.01, release=None):
+        self.delay = delay
+        self.release = release
+        self.calls = []
+        self.running = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def predict(self, data, confidence=40, overlap=30):
+        with self.lock:
+            self.calls.append(data)
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        if self.release is not None:
+            self.release.wait(5.0)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        if data == 'bad.jpg':
+            raise ValueError('bad image')
+        return FakePrediction(data)
+
+
+def dataflow(model):
+    # no connection to Roboflow
+    flow = DataFlow.__new__(DataFlow)
+    flow.model = model
+    return flow
+
+
+def test_one_call_per_input(tmp_path):
+    model = FakeModel()
+    inputs = [f'img{i}.jpg' for i in range(20)]
+    results = list(dataflow(model).predict_batch(inputs, save_dir=str(tmp_path), workers=4))
+
+    # the JSON and the annotated image come from the same prediction
+    assert sorted(model.calls) == sorted(inputs)
+    assert sorted(index for index, _, _ in results) == list(range(20))
+    assert all(result['predictions'][0]['image'] == data for _, data, result in results)
+    assert len(os.listdir(tmp_path)) == 20
+
+
+def test_same_names(tmp_path):
+    inputs = ['a/img.jpg', 'b/img.jpg', 'https://example.com/img.jpg']
+    list(dataflow(FakeModel()).predict_batch(inputs, save_dir=str(tmp_path), workers=3))
+
+    # every input has its own annotated image
+    assert sorted(os.listdir(tmp_path)) == ['0_img_prediction.jpg', '1_img_prediction.jpg', '2_img_prediction.jpg']
+    assert (tmp_path / '1_img_prediction.jpg').read_text() == 'b/img.jpg'
+
+
+def test_concurrency_cap():
+    release = threading.Event()
+    model = FakeModel(release=release)
+    pulled = []
+
+    def inputs():
+        for i in range(50):
+            pulled.append(i)
+            yield f'img{i}.jpg'
+
+    results = dataflow(model).predict_batch(inputs(), workers=3)
+    consumer = threading.Thread(target=lambda: results.__next__())
+    consumer.start()
+    time.sleep(0.2)
+    # while the predictions are blocked, at most 2 * workers inputs are taken, and `workers` are running
+    assert len(pulled) == 6
+    assert model.running == 3
+    release.set()
+    consumer.join()
+
+    assert len(list(results)) == 49
+    assert model.peak == 3
+    assert len(model.calls) == 50
+
+
+def test_error():
+    model = FakeModel()
+    results = list(dataflow(model).predict_batch(['bad.jpg', 'good.jpg'], workers=2))
+
+    assert dict((data, result) for _, data, result in results)['bad.jpg'] == {'error': 'bad image'}
+    assert len(results) == 2
+
+
+def test_checkout_restores_damaged_files(tmp_path, monkeypatch):
+    download = tmp_path / 'download'
+    (download / 'train').mkdir(parents=True)
+    for i in range(3):
+        (download / 'train' / f'{i}.txt').write_text(f'0 0.5 0.5 0.{i} 0.{i}')
+    flow = DataFlow(dataset_dir=str(tmp_path / 'datasets'), offline=True)
+    ref = flow.add_to_cache(str(download), 'Guns')
+    location = str(tmp_path / 'datasets' / 'Guns-3')
+    assert flow.checkout(ref, location) == 3
+
+    hashed = []
+    digest = DataFlow.file_digest
+    monkeypatch.setattr(DataFlow, 'file_digest', staticmethod(lambda path: hashed.append(path) or digest(path)))
+    # the files did not change since they were verified
+    assert flow.checkout(ref, location) == 0 and not hashed
+
+    # a damaged file of the same size is replaced
+    damaged = tmp_path / 'datasets' / 'Guns-3' / 'train' / '1.txt'
+    damaged.unlink()
+    damaged.write_text('0 0.5 0.5 0.9 0.9')
+    assert flow.checkout(ref, location) == 1
+    assert damaged.read_text() == '0 0.5 0.5 0.1 0.1'
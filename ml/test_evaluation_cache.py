@@ -0,0 +1,156 @@
+"""
+Tests of `EvaluationCache.py`, run with `python -m pytest test_evaluation_cache.py` from `ml/`.
+The metrics are compared with ultralytics' validation when ultralytics is installed.
+"""
+import types
+
+import numpy as np
+import pytest
+
+from EvaluationCache import IOU_THRESHOLDS, EvaluationCache, detection_metrics, match, nms
+
+
+def fixture(seed=0, images=40, nc=3):
+    """
+    Raw predictions in the layout of `EvaluationCache.predictions`: jittered and duplicated copies of the labels,
+    some of the wrong class, and false positives, with random scores.
+    """
+
+    rng = np.random.default_rng(seed)
+    boxes, scores, classes, counts = [], [], [], []
+    label_boxes, label_classes, label_counts = [], [], []
+    for _ in range(images):
+        n = int(rng.integers(0, 6))
+        xy, wh = rng.uniform(0, 0.7, (n, 2)), rng.uniform(0.05, 0.3, (n, 2))
+        truth, truth_classes = np.concatenate([xy, xy + wh], 1), rng.integers(0, nc, n)
+        copies = np.repeat(np.arange(n), rng.integers(0, 4, n))
+        pred = truth[copies] + rng.normal(0, 0.02, (len(copies), 4))
+        pred_classes = np.where(rng.random(len(copies)) < 0.1, rng.integers(0, nc, len(copies)), truth_classes[copies])
+        m = int(rng.integers(0, 4))
+        xy, wh = rng.uniform(0, 0.7, (m, 2)), rng.uniform(0.05, 0.3, (m, 2))
+        pred = np.concatenate([pred, np.concatenate([xy, xy + wh], 1)])
+        pred_classes = np.concatenate([pred_classes, rng.integers(0, nc, m)])
+
+        boxes.append(pred.astype(np.float32))
+        scores.append(rng.uniform(0.001, 1.0, len(pred)).astype(np.float32))
+        classes.append(pred_classes.astype(np.int16))
+        counts.append(len(pred))
+        label_boxes.append(truth.astype(np.float32))
+        label_classes.append(truth_classes.astype(np.int16))
+        label_counts.append(n)
+
+    return {
+        'names': np.array([f'im{i}.jpg' for i in range(images)]),
+        'offsets': np.concatenate([[0], np.cumsum(counts)]),
+        'boxes': np.concatenate(boxes),
+        'scores': np.concatenate(scores),
+        'classes': np.concatenate(classes),
+        'label_offsets': np.concatenate([[0], np.cumsum(label_counts)]),
+        'label_classes': np.concatenate(label_classes),
+        'label_boxes': np.concatenate(label_boxes),
+        'speed': np.zeros(3),
+    }
+
+
+def ultralytics_metrics(predictions, conf, iou, max_det, nc=3):
+    """
+    The metrics of the same raw predictions, computed by ultralytics' NMS, matching and `ap_per_class`.
+    """
+
+    torch = pytest.importorskip('torch')
+    pytest.importorskip('ultralytics')
+    if not hasattr(np, 'trapz'):
+        pytest.skip("ultralytics 8.0.x needs numpy < 2")
+    try:
+        from ultralytics.yolo.utils.metrics import ap_per_class
+        from ultralytics.yolo.utils.ops import non_max_suppression, xyxy2xywh
+        from ultralytics.yolo.v8.detect import DetectionValidator
+    except ImportError:
+        from ultralytics.models.yolo.detect import DetectionValidator
+        from ultralytics.utils.metrics import ap_per_class
+        from ultralytics.utils.ops import non_max_suppression, xyxy2xywh
+
+    validator = DetectionValidator.__new__(DetectionValidator)
+    validator.iouv = torch.tensor(IOU_THRESHOLDS, dtype=torch.float32)
+    stats = []
+    offsets, label_offsets = predictions['offsets'], predictions['label_offsets']
+    for i in range(len(offsets) - 1):
+        start, end = offsets[i], offsets[i + 1]
+        # the output of the model: xywh boxes and a score per class
+        raw = torch.zeros((1, 4 + nc, end - start))
+        raw[0, :4] = xyxy2xywh(torch.from_numpy(predictions['boxes'][start:end] * 640)).T
+        raw[0, 4 + torch.from_numpy(predictions['classes'][start:end].astype(np.int64)),
+            torch.arange(end - start)] = torch.from_numpy(predictions['scores'][start:end])
+        detections = non_max_suppression(raw, conf_thres=conf, iou_thres=iou, max_det=max_det)[0]
+
+        lstart, lend = label_offsets[i], label_offsets[i + 1]
+        true_classes = torch.from_numpy(predictions['label_classes'][lstart:lend].astype(np.float32))
+        true_boxes = torch.from_numpy(predictions['label_boxes'][lstart:lend] * 640)
+        if hasattr(validator, 'match_predictions'):
+            correct = validator._process_batch(detections, true_boxes, true_classes)
+        else:
+            correct = validator._process_batch(detections, torch.cat([true_classes[:, None], true_boxes], 1))
+        stats.append((correct.numpy(), detections[:, 4].numpy(), detections[:, 5].numpy()))
+
+    tp, confs, pred_classes = (np.concatenate(x) for x in zip(*stats))
+    _, _, p, r, _, ap = ap_per_class(tp, confs, pred_classes, predictions['label_classes'], names={})[:6]
+    return {'precision': p.mean(), 'recall': r.mean(), 'mAP50': ap[:, 0].mean(), 'mAP50_95': ap.mean()}
+
+
+@pytest.mark.parametrize('conf, iou, max_det', [(0.001, 0.6, 300), (0.25, 0.45, 300), (0.1, 0.7, 2)])
+def test_metrics_match_ultralytics(conf, iou, max_det):
+    predictions = fixture()
+    metrics = EvaluationCache.evaluate(predictions, conf=conf, iou=iou, max_det=max_det)
+    expected = ultralytics_metrics(predictions, conf, iou, max_det)
+
+    for name, value in expected.items():
+        assert metrics[name] == pytest.approx(value, abs=1e-5), name
+
+
+def test_nms():
+    boxes = np.array([[0, 0, 1, 1], [0, 0, 1, 0.9], [0, 0, 1, 0.5], [0, 0, 1, 1]], np.float32)
+    scores = np.array([0.9, 0.8, 0.7, 0.6], np.float32)
+    classes = np.array([0, 0, 0, 1], np.int16)
+
+    # the second box overlaps the first, the last one is of another class
+    assert nms(boxes, scores, classes, iou=0.6, max_det=300).tolist() == [0, 2, 3]
+    assert nms(boxes, scores, classes, iou=0.6, max_det=2).tolist() == [0, 2]
+
+
+def test_duplicates_are_false_positives():
+    true_boxes = np.array([[0, 0, 1, 1]], np.float32)
+    pred_boxes = np.array([[0, 0, 1, 1], [0, 0, 1, 0.95]], np.float32)
+    correct = match(pred_boxes, np.array([0, 0]), true_boxes, np.array([0]))
+
+    # a label is matched once
+    assert correct[:, 0].tolist() == [True, False]
+    metrics = detection_metrics(correct, np.array([0.9, 0.8]), np.array([0, 0]), np.array([0]))
+    assert metrics['recall'] == pytest.approx(1.0)
+
+
+class FakeModel:
+    """Stands in for a `YOLO` model, predicting many duplicates of a confident object and one weaker object."""
+
+    def predict(self, sources, max_det=300, **kwargs):
+        tensor = lambda a: types.SimpleNamespace(cpu=lambda: types.SimpleNamespace(numpy=lambda: a))
+        for _ in sources:
+            boxes = np.array([[0.1, 0.1, 0.3, 0.3]] * 500 + [[0.6, 0.6, 0.9, 0.9]], np.float32)
+            scores = np.array([0.9 - k * 1e-4 for k in range(500)] + [0.01], np.float32)
+            # ultralytics keeps the `max_det` most confident boxes
+            boxes, scores = boxes[:max_det], scores[:max_det]
+            yield types.SimpleNamespace(boxes=types.SimpleNamespace(
+                xyxyn=tensor(boxes), conf=tensor(scores), cls=tensor(np.zeros(len(scores)))), speed={})
+
+
+def test_weak_objects_are_cached(tmp_path):
+    images, labels = tmp_path / 'images', tmp_path / 'labels'
+    images.mkdir()
+    labels.mkdir()
+    (images / 'im0.jpg').write_bytes(b'')
+    (labels / 'im0.txt').write_text('0 0.2 0.2 0.2 0.2\n0 0.75 0.75 0.3 0.3\n')
+    weights = tmp_path / 'best.pt'
+    weights.write_bytes(b'weights')
+
+    predictions = EvaluationCache(str(tmp_path / 'cache')).predictions(FakeModel(), str(weights), str(images))
+    metrics = EvaluationCache.evaluate(predictions, conf=0.001, iou=0.6)
+    assert metrics['recall'] == pytest.approx(1.0)
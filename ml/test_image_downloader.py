@@ -0,0 +1,137 @@
+"""
+Tests of `ImageDownloader.download_all` against a local HTTP server, run with
+`python -m pytest test_image_downloader.py` from `ml/`.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import types
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# only the downloads are tested, the search clients may be missing
+sys.modules.setdefault('pixabay', types.SimpleNamespace(image=None))
+sys.modules.setdefault('simple_image_download', types.SimpleNamespace(simple_image_download=None))
+
+from ImageDownloader import ImageDownloader
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Serves `/image/<id>` as `image <id>`, and answers the paths of `server.responses` with their
+    list of `(status, headers, body)`, one per request, the last one being repeated.
+    """
+
+    def do_GET(self):
+        self.server.requests[self.path] += 1
+        responses = self.server.responses.get(self.path)
+        if responses:
+            status, headers, body = responses.pop(0) if len(responses) > 1 else responses[0]
+        elif self.path.startswith('/image/'):
+            status, headers, body = 200, {}, f'image {self.path[7:]}'.encode()
+        else:
+            status, headers, body = 404, {}, b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if 'Content-Length' not in headers:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.requests, httpd.responses = Counter(), {}
+    httpd.url = f'http://127.0.0.1:{httpd.server_port}'
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def downloader(tmp_path):
+    downloader = ImageDownloader(query='guns', retries=2, timeout=5)
+    downloader.download_dir = str(tmp_path)
+    downloader.make_dirs()
+    return downloader
+
+
+def read_manifest(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_resume(server, downloader, tmp_path):
+    images = [(i, f'{server.url}/image/{i}') for i in range(5)] + [(5, f'{server.url}/missing/5')]
+    assert downloader.download_all('unsplash', 'guns', images) == 5
+    assert (tmp_path / 'guns' / '3.jpg').read_text() == 'image 3'
+    assert not (tmp_path / 'guns' / '5.jpg').exists()
+
+    # only the failed image is requested again
+    server.requests.clear()
+    assert downloader.download_all('unsplash', 'guns', images) == 0
+    assert server.requests == Counter({'/missing/5': 1})
+    # the same id from another provider is another image
+    assert downloader.download_all('pixabay', 'guns', images[:1]) == 1
+
+
+def test_truncated_manifest(server, downloader, tmp_path):
+    images = [(i, f'{server.url}/image/{i}') for i in range(3)]
+    downloader.download_all('unsplash', 'guns', images[:2])
+    manifest = tmp_path / 'guns' / 'manifest.jsonl'
+    # killed while writing the last entry
+    with open(manifest, 'a') as f:
+        f.write('{"provider": "unsplash", "i')
+
+    assert downloader.load_manifest('guns') == {('unsplash', '0'), ('unsplash', '1')}
+    assert downloader.download_all('unsplash', 'guns', images) == 1
+    # the entries written after the truncated line are read back
+    assert downloader.load_manifest('guns') == {('unsplash', '0'), ('unsplash', '1'), ('unsplash', '2')}
+
+
+def test_part_file(server, downloader, tmp_path):
+    # the connection is closed before the announced length
+    server.responses['/image/1'] = [(200, {'Content-Length': '1000'}, b'partial')]
+    images = [(0, f'{server.url}/image/0'), (1, f'{server.url}/image/1')]
+    assert downloader.download_all('unsplash', 'guns', images) == 1
+
+    files = sorted(os.listdir(tmp_path / 'guns'))
+    assert '0.jpg' in files and '0.jpg.part' not in files
+    # an incomplete image never has its final name, nor is recorded
+    assert '1.jpg' not in files
+    assert [entry['id'] for entry in read_manifest(tmp_path / 'guns' / 'manifest.jsonl')] == ['0']
+
+    del server.responses['/image/1']
+    assert downloader.download_all('unsplash', 'guns', images) == 1
+    assert (tmp_path / 'guns' / '1.jpg').read_text() == 'image 1'
+
+
+def test_retry_after(server, downloader, tmp_path):
+    server.responses['/image/0'] = [(429, {'Retry-After': '1'}, b''), (200, {}, b'image 0')]
+    start = time.monotonic()
+    assert downloader.download_all('unsplash', 'guns', [(0, f'{server.url}/image/0')]) == 1
+
+    # the request waited for the provider before trying again
+    assert time.monotonic() - start >= 1.0
+    assert server.requests['/image/0'] == 2
+    assert (tmp_path / 'guns' / '0.jpg').read_text() == 'image 0'
+
+
+def test_rate_limited(server, downloader, tmp_path):
+    server.responses['/image/0'] = [(429, {'Retry-After': '0'}, b'')]
+    assert downloader.download_all('unsplash', 'guns', [(0, f'{server.url}/image/0')]) == 0
+
+    # given up after the retries, and not recorded
+    assert server.requests['/image/0'] == 3
+    assert not (tmp_path / 'guns' / 'manifest.jsonl').exists()
@@ -0,0 +1,96 @@
+"""
+Tests of the near-duplicate search of `ImageHashIndex`, run with `python -m pytest test_image_hash_index.py` from `ml/`.
+"""
+import random
+
+import pytest
+
+from ImageHashIndex import BKTree, ImageHashIndex
+
+
+def flip(value, bits, rng):
+    """`value` with `bits` random bits flipped."""
+    for bit in rng.sample(range(64), bits):
+        value ^= 1 << bit
+    return value
+
+
+@pytest.mark.parametrize('radius', [0, 1, 4, 6, 12])
+def test_search_matches_brute_force(radius):
+    rng = random.Random(radius)
+    # random hashes, and clusters of near copies as the duplicates of a dataset are
+    hashes = [rng.getrandbits(64) for _ in range(300)]
+    hashes += [flip(hashes[i], rng.randint(0, 10), rng) for i in range(0, 300, 3) for _ in range(2)]
+    hashes += hashes[:20]
+    tree = BKTree()
+    for item, value in enumerate(hashes):
+        tree.add(value, item)
+
+    for query in hashes[::7] + [rng.getrandbits(64) for _ in range(20)]:
+        expected = sorted((bin(query ^ value).count('1'), item) for item, value in enumerate(hashes)
+                          if bin(query ^ value).count('1') <= radius)
+        assert sorted(tree.search(query, radius)) == expected
+
+
+def test_empty_tree():
+    assert BKTree().search(0, 64) == []
+
+
+def index_of(images):
+    """An index of `[(path, hash, size, width, height)]`."""
+    paths, hashes, sizes, widths, heights = zip(*images)
+    return ImageHashIndex(paths, sizes, [0] * len(paths), hashes, widths, heights)
+
+
+def test_best_image_is_kept():
+    rng = random.Random(0)
+    value = rng.getrandbits(64)
+    index = index_of([
+        ('/a/small.jpg', value, 90000, 320, 240),
+        ('/a/large.jpg', flip(value, 2, rng), 50000, 1280, 720),
+        # same resolution as the large image, a larger file wins
+        ('/a/large_hq.jpg', flip(value, 1, rng), 80000, 1280, 720),
+        ('/a/other.jpg', value ^ (2 ** 64 - 1), 10000, 640, 480),
+    ])
+    duplicates, unreadable = index.duplicates(threshold=6)
+
+    assert unreadable == []
+    assert {row: kept for row, (kept, _) in duplicates.items()} == {0: 2, 1: 2}
+    # the distances are to the kept image
+    assert duplicates[0][1] == 1 and duplicates[1][1] == 3
+
+
+def test_first_path_breaks_ties():
+    value = 0x0123456789abcdef
+    index = index_of([('/b/copy.jpg', value, 1000, 640, 480), ('/a/copy.jpg', value, 1000, 640, 480),
+                      ('/c/copy.jpg', value, 1000, 640, 480)])
+    duplicates, _ = index.duplicates()
+    assert duplicates == {0: (1, 0), 2: (1, 0)}
+
+
+def test_unreadable_images():
+    index = index_of([('/a/1.jpg', 0, 1000, 640, 480), ('/a/broken.jpg', 0, 10, 0, 0), ('/a/2.jpg', 1, 900, 640, 480)])
+    duplicates, unreadable = index.duplicates()
+
+    # the hash 0 of an unreadable image is not a duplicate of anything
+    assert unreadable == [1]
+    assert duplicates == {2: (0, 1)}
+
+
+def test_every_image_is_in_one_group():
+    rng = random.Random(1)
+    originals = [rng.getrandbits(64) for _ in range(50)]
+    images = [(f'/d/{i}_{j}.jpg', flip(value, rng.randint(0, 2), rng), rng.randint(1000, 9000), 640, 480)
+              for i, value in enumerate(originals) for j in range(3)]
+    index = index_of(images)
+    duplicates, _ = index.duplicates(threshold=4)
+
+    kept = set(range(len(index))) - set(duplicates)
+    # a kept image is never dropped, and every dropped image is within the threshold of a kept one
+    assert all(row in kept for row, _ in duplicates.values())
+    assert all(d == bin(int(index.hashes[row]) ^ int(index.hashes[k])).count('1') <= 4
+               for row, (k, d) in duplicates.items())
+    # and the kept images are not duplicates of one another
+    for a in kept:
+        for b in kept:
+            assert a == b or bin(int(index.hashes[a]) ^ int(index.hashes[b])).count('1') > 4
@@ -0,0 +1,120 @@
+"""
+Tests of `LabelIndex`: the incremental cache and the stratified split, run with `python -m pytest test_label_index.py`
+from `ml/`.
+"""
+import os
+
+import pytest
+
+from LabelIndex import LabelIndex
+
+
+def write_labels(folder, labels):
+    """Write `{name: [class ids]}` as YOLO label files, one box per class id."""
+    folder.mkdir(exist_ok=True)
+    for name, classes in labels.items():
+        (folder / f'{name}.txt').write_text(''.join(f'{c} 0.5 0.5 0.2 0.2\n' for c in classes))
+
+
+@pytest.fixture
+def parsed(monkeypatch):
+    """The label files parsed, in the order they are parsed."""
+    paths = []
+    parse = LabelIndex.parse
+
+    def recording_parse(path):
+        paths.append(os.path.basename(path))
+        return parse(path)
+
+    monkeypatch.setattr(LabelIndex, 'parse', staticmethod(recording_parse))
+    return paths
+
+
+def test_only_stale_files_are_parsed(tmp_path, parsed):
+    labels, cache = tmp_path / 'labels', str(tmp_path / 'cache')
+    write_labels(labels, {f'img{i}': [i % 3] for i in range(10)})
+    index = LabelIndex.load(labels, cache_dir=cache)
+    assert len(parsed) == 10 and len(index) == 10
+
+    # nothing changed: the cache is read back as it is
+    parsed.clear()
+    assert LabelIndex.load(labels, cache_dir=cache).names.tolist() == index.names.tolist()
+    assert parsed == []
+
+    # one file relabeled, one added, one removed
+    write_labels(labels, {'img3': [1, 2], 'img10': [0]})
+    os.remove(labels / 'img7.txt')
+    index = LabelIndex.load(labels, cache_dir=cache)
+    assert sorted(parsed) == ['img10.txt', 'img3.txt']
+    assert 'img7' not in index.rows()
+    boxes = {name: index.classes[index.offsets[row]:index.offsets[row + 1]].tolist() for name, row in index.rows().items()}
+    assert boxes['img3'] == [1, 2] and boxes['img10'] == [0] and boxes['img4'] == [1]
+    assert index.class_counts().tolist() == [4, 3, 4]
+
+
+def test_unreadable_cache(tmp_path, parsed):
+    labels, cache = tmp_path / 'labels', str(tmp_path / 'cache')
+    write_labels(labels, {'a': [0], 'b': []})
+    LabelIndex.load(labels, cache_dir=cache)
+    with open(LabelIndex.cache_path(labels, cache), 'wb') as f:
+        f.write(b'not an npz file')
+
+    # a damaged cache is parsed again from scratch
+    parsed.clear()
+    index = LabelIndex.load(labels, cache_dir=cache)
+    assert sorted(parsed) == ['a.txt', 'b.txt']
+    assert index.empty().tolist() == [False, True]
+
+
+def index_of(labels):
+    """An in-memory index of `{name: [class ids]}`."""
+    names = sorted(labels)
+    counts = [len(labels[name]) for name in names]
+    offsets = [0]
+    for count in counts:
+        offsets.append(offsets[-1] + count)
+    classes = [c for name in names for c in labels[name]]
+    return LabelIndex(names, [0] * len(names), [0] * len(names), offsets, classes, [[0.5, 0.5, 0.2, 0.2]] * len(classes))
+
+
+def test_largest_remainder_quotas():
+    # class 1 is the rarest, so the images having both classes are in its stratum
+    labels = {f'common{i}': [0] for i in range(10)}
+    labels.update({f'rare{i}': [0, 1] for i in range(7)})
+    index = index_of(labels)
+    background = [f'background{i}' for i in range(3)]
+    splits = index.stratified_split(list(labels) + background, {'train': 0.7, 'val': 0.2, 'test': 0.1})
+
+    def sizes(prefix):
+        return [sum(name.startswith(prefix) for name in splits[split]) for split in ('train', 'val', 'test')]
+
+    assert sizes('common') == [7, 2, 1]
+    # quotas 4.9, 1.4, 0.7: the two largest remainders get the two images left
+    assert sizes('rare') == [5, 1, 1]
+    # quotas 2.1, 0.6, 0.3
+    assert sizes('background') == [2, 1, 0]
+    # fractions are relative to their sum
+    assert index.stratified_split(list(labels), {'train': 7, 'val': 2, 'test': 1}) == \
+        {split: [name for name in names if not name.startswith('background')] for split, names in splits.items()}
+
+
+def test_split_is_stable():
+    labels = {f'img{i}': [i % 4] if i % 5 else [] for i in range(400)}
+    index = index_of(labels)
+    fractions = {'train': 0.7, 'val': 0.2, 'test': 0.1}
+    names = list(labels)
+    splits = index.stratified_split(names, fractions)
+    assert index.stratified_split(names[::-1], fractions) == splits
+    assert index.stratified_split(names, fractions, seed=1) != splits
+
+    def assignment(splits):
+        return {name: split for split, members in splits.items() for name in members}
+
+    # images added without label file or with new labels
+    added = {f'new{i}': [i % 4] for i in range(10)}
+    index = index_of({**labels, **added})
+    before = assignment(splits)
+    after = assignment(index.stratified_split(names + [f'extra{i}' for i in range(10)] + list(added), fractions))
+    moved = [name for name in before if after[name] != before[name]]
+    # every image added shifts each cut of its stratum by at most one image
+    assert len(moved) <= 2 * 20
@@ -0,0 +1,122 @@
+"""
+Tests of `Monitor.py` with a stand-in for Comet, run with `python -m pytest test_monitor.py` from `ml/`.
+"""
+import sys
+import time
+import types
+
+import pytest
+
+# only the Monitor is tested, comet_ml and python-dotenv may be missing
+sys.modules.setdefault('dotenv', types.SimpleNamespace(load_dotenv=lambda path: None))
+
+import Monitor as monitor_module
+from Monitor import LocalExperiment, Monitor
+
+
+class FakeComet:
+    """Stands in for `comet_ml.Experiment` and `ExistingExperiment`, reachable or not."""
+
+    def __init__(self):
+        self.up = True
+        self.alive = True
+        self.experiments = []
+
+    def __call__(self, api_key=None, previous_experiment=None, **kwargs):
+        if not self.up:
+            raise ConnectionError('Comet is down')
+        experiment = LocalExperiment()
+        experiment.alive = self.alive
+        experiment.key = previous_experiment or f'key{len(self.experiments)}'
+        experiment.get_key = lambda: experiment.key
+        self.experiments.append(experiment)
+        return experiment
+
+    def logged(self):
+        return [m for e in self.experiments if e.alive for m in e.metrics]
+
+
+@pytest.fixture
+def comet(monkeypatch):
+    fake = FakeComet()
+    monkeypatch.setenv('COMET_API_KEY', 'test')
+    monkeypatch.setattr(monitor_module, 'Experiment', fake)
+    monkeypatch.setattr(monitor_module, 'ExistingExperiment', fake)
+    return fake
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_offline(tmp_path):
+    monitor = Monitor(offline=True, spool_dir=str(tmp_path))
+    monitor.log_hyper_parameters({'lr0': 0.01})
+    monitor.log_metrics({'mAP50': 0.5}, step=1)
+    monitor.log_metrics({'mAP50_95': 0.3}, step=1)
+    monitor.upload_model('best.pt', name='guns_model')
+    monitor.end_experiment()
+
+    experiment = monitor.experiment
+    assert experiment.parameters == {'lr0': 0.01}
+    # the metrics of a same step are sent in one call
+    assert experiment.metrics == [({'mAP50': 0.5, 'mAP50_95': 0.3}, 1)]
+    assert experiment.models[0][0] == 'guns_model'
+    assert experiment.ended
+
+
+def test_replay(tmp_path, comet):
+    comet.up = False
+    monitor = Monitor(spool_dir=str(tmp_path))
+    monitor.log_metrics({'loss': 1.0}, step=0)
+    monitor.end_experiment()
+    assert monitor.sent == 0 and len(monitor.pending) == 2
+
+    comet.up = True
+    assert Monitor.replay(str(tmp_path)) == 2
+    assert comet.logged() == [({'loss': 1.0}, 0)]
+    assert comet.experiments[-1].ended
+    # the replayed events are not sent twice
+    assert Monitor.replay(str(tmp_path)) == 0
+
+
+def test_retry_when_idle(tmp_path, comet):
+    comet.up = False
+    monitor = Monitor(spool_dir=str(tmp_path), retry_interval=0.05)
+    monitor.log_metrics({'loss': 1.0}, step=0)
+    monitor.flush()
+    assert monitor.sent == 0
+
+    # sent without any other event
+    comet.up = True
+    assert wait_for(lambda: monitor.sent == 1)
+    assert comet.logged() == [({'loss': 1.0}, 0)]
+    monitor.end_experiment()
+
+
+def test_retry_at_end(tmp_path, comet):
+    comet.up = False
+    monitor = Monitor(spool_dir=str(tmp_path), retry_interval=3600)
+    monitor.log_metrics({'loss': 1.0}, step=0)
+    monitor.flush()
+
+    # Comet is back before the retry interval, ending the experiment still sends everything
+    comet.up = True
+    monitor.end_experiment()
+    assert monitor.sent == 2 and not monitor.pending
+    assert comet.experiments[-1].ended
+
+
+def test_experiment_not_alive(tmp_path, comet):
+    comet.alive = False
+    monitor = Monitor(spool_dir=str(tmp_path), retry_interval=3600)
+    monitor.log_metrics({'loss': 1.0}, step=0)
+    monitor.end_experiment()
+    # nothing is counted as sent to a disabled experiment, it stays in the spool
+    assert monitor.sent == 0 and len(monitor.pending) == 2
+
+    comet.alive = True
+    assert Monitor.replay(str(tmp_path)) == 2
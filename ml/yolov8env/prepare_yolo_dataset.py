@@ -8,99 +8,376 @@ Usage examples (Windows):
 2) If images and labels are in separate folders:
    python prepare_yolo_dataset.py --src_images "C:\images" --src_labels "C:\labels" --dest datasets\guns_dataset --val 0.2
 
-3) If your data is ALREADY split like src\train, src\val:
+3) Stratified 70/20/10 train/val/test split, keeping the proportion of every class in each split:
+   python prepare_yolo_dataset.py --src "C:\mydata" --dest datasets\guns_dataset --split stratified --val 0.2 --test 0.1
+
+4) If your data is ALREADY split like src\train, src\val:
    python prepare_yolo_dataset.py --src "C:\mydata" --already_split
+
+5) Leave out the duplicates found by ml/dedupe_images.py:
+   python prepare_yolo_dataset.py --src "C:\mydata" --dest datasets\guns_dataset --dedupe_manifest dedupe.jsonl
+
+6) Large datasets: link the files instead of copying them (same drive only), with 16 threads:
+   python prepare_yolo_dataset.py --src "C:\mydata" --dest datasets\guns_dataset --mode hardlink --workers 16
+
+Each source folder is listed once, and the files are placed by a pool of threads with --mode:
+   copy      full copies (default)
+   hardlink  no extra disk space, the source and destination must be on the same drive
+   symlink   links to the source files (on Windows, requires developer mode or admin rights)
+   reflink   copy-on-write clones on filesystems supporting them (Btrfs, XFS), copies elsewhere
+
+Runs are incremental: files already in place with the same size and modification time are
+skipped, and the files of a previous run that are no longer part of the dataset are removed.
+Every placed file is listed in <dest>/manifest.jsonl.
+
+The stratified split parses the label files once into a columnar cache (in ~/.cache/guns-detection,
+see ml/LabelIndex.py) that later runs only update for the modified label files.
 """
-import os, shutil, random, argparse, glob
+import os, sys, shutil, random, argparse, json, errno, threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ImageHashIndex import BKTree, phash
+from LabelIndex import LabelIndex
 
 IMG_EXTS = ('.jpg','.jpeg','.png','.bmp','.tif','.tiff')
+MODES = ('copy', 'hardlink', 'symlink', 'reflink')
+MANIFEST = 'manifest.jsonl'
+# Linux ioctl cloning a file into another (copy-on-write)
+FICLONE = 0x40049409
 
 def is_image(fn): return fn.lower().endswith(IMG_EXTS)
 
-def copy_pairs(pairs, dst_img_dir, dst_label_dir, create_empty=False):
+def scan_dir(path):
+    """
+    List a folder once.
+
+    :return: images: a list of the image `os.DirEntry`, sorted by name.
+    :return: labels: a dictionary `{name without extension: os.DirEntry}` of the .txt files.
+    """
+    images, labels = [], {}
+    if not os.path.isdir(path):
+        return images, labels
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            if is_image(entry.name):
+                images.append(entry)
+            elif entry.name.lower().endswith('.txt'):
+                labels[os.path.splitext(entry.name)[0]] = entry
+    images.sort(key=lambda entry: entry.name)
+    return images, labels
+
+def pair_labels(images, labels):
+    """
+    :return: pairs: a list of `(image entry, label entry or None)`.
+    """
+    return [(image, labels.get(os.path.splitext(image.name)[0])) for image in images]
+
+def load_dedupe_manifest(path):
+    """
+    Read the keep/drop manifest of dedupe_images.py.
+
+    :return: drop: a function telling if an image `os.DirEntry` is dropped.
+    """
+    dropped, dropped_hashes = set(), {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record['action'] != 'drop':
+                continue
+            dropped.add(os.path.normcase(record['path']))
+            if 'hash' in record:
+                dropped_hashes.setdefault(os.path.basename(record['path']), []).append(
+                    (int(record['hash'], 16), record.get('threshold', 0)))
+
+    def drop(entry):
+        if os.path.normcase(os.path.abspath(entry.path)) in dropped:
+            return True
+        # images annotated after the dedupe were usually copied elsewhere: a file with the name of
+        # a dropped image is only dropped if it is the same picture, by its perceptual hash
+        candidates = dropped_hashes.get(entry.name)
+        if not candidates:
+            return False
+        value, _, _ = phash(entry.path)
+        return value is not None and any(BKTree.distance(value, h) <= threshold for h, threshold in candidates)
+    return drop
+
+def reflink(src, dst):
+    """Clone `src` into `dst` without copying its data, raise OSError if the filesystem cannot."""
+    import fcntl  # not available on Windows, where reflinks fall back to copies
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    shutil.copystat(src, dst)
+
+def unsupported(e):
+    """True if a link or clone failed because the filesystem or the drive does not allow it."""
+    if isinstance(e, ImportError):
+        return True
+    return e.errno in (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EPERM) \
+        or getattr(e, 'winerror', None) is not None
+
+class Placer:
+    """
+    Place source files in the destination with the selected mode, thread-safe.
+
+    :param mode: one of MODES.
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.fallback = None
+        self.lock = threading.Lock()
+
+    def up_to_date(self, st, dst, src):
+        """True if `dst` already holds `src`, whose stat is `st`."""
+        try:
+            dst_st = os.lstat(dst)
+        except FileNotFoundError:
+            return False
+        if self.mode == 'symlink':
+            return os.path.islink(dst) and os.readlink(dst) == os.path.abspath(src)
+        if self.mode == 'hardlink' and not self.fallback:
+            return (dst_st.st_ino, dst_st.st_dev) == (st.st_ino, st.st_dev)
+        return dst_st.st_size == st.st_size and int(dst_st.st_mtime) == int(st.st_mtime)
+
+    def place(self, entry, dst):
+        """
+        Place the file of a `os.DirEntry` at `dst`.
+
+        :return: True if the file was placed, False if it was already up to date.
+        """
+        src = entry.path
+        if self.up_to_date(entry.stat(), dst, src):
+            return False
+        # never write through an existing file: it may be a link to a source file
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+        mode = self.fallback or self.mode
+        try:
+            if mode == 'hardlink':
+                os.link(src, dst)
+            elif mode == 'symlink':
+                os.symlink(os.path.abspath(src), dst)
+            elif mode == 'reflink':
+                reflink(src, dst)
+            else:
+                shutil.copy2(src, dst)
+        except (OSError, ImportError) as e:
+            if mode == 'copy' or not unsupported(e):
+                raise
+            with self.lock:
+                if self.fallback is None:
+                    print(f"Warning - {mode} is not supported here ({e}), copying the files instead")
+                    self.fallback = 'copy'
+            if os.path.lexists(dst):
+                os.remove(dst)
+            shutil.copy2(src, dst)
+        return True
+
+def place_split(pairs, split, dest, placer, create_empty=False, workers=None):
+    """
+    Place the image/label pairs of one split in `dest`/images/`split` and `dest`/labels/`split`.
+
+    :return: records: the manifest records of the split.
+    :return: missing_labels: the label names of the images without label.
+    :return: placed: the number of files placed, the others were up to date.
+    """
+    dst_img_dir = os.path.join(dest, 'images', split)
+    dst_label_dir = os.path.join(dest, 'labels', split)
     os.makedirs(dst_img_dir, exist_ok=True)
     os.makedirs(dst_label_dir, exist_ok=True)
-    missing_labels = []
-    for img_path in pairs:
-        base = os.path.basename(img_path)
-        name = os.path.splitext(base)[0]
-        label_name = name + '.txt'
-        # copy image
-        shutil.copy2(img_path, os.path.join(dst_img_dir, base))
-        # copy label if exists
-        if os.path.exists(os.path.join(args.src_labels or args.src, label_name)):
-            shutil.copy2(os.path.join(args.src_labels or args.src, label_name), os.path.join(dst_label_dir, label_name))
+
+    def place_pair(pair):
+        image, label = pair
+        name = os.path.splitext(image.name)[0]
+        record = {'split': split,
+                  'image': os.path.join('images', split, image.name),
+                  'label': os.path.join('labels', split, name + '.txt'),
+                  'size': image.stat().st_size,
+                  'mtime': int(image.stat().st_mtime)}
+        placed = placer.place(image, os.path.join(dest, record['image']))
+        if label is not None:
+            placed += placer.place(label, os.path.join(dest, record['label']))
+        elif create_empty:
+            empty = os.path.join(dest, record['label'])
+            if os.path.islink(empty) or not os.path.isfile(empty) or os.path.getsize(empty):
+                if os.path.lexists(empty):
+                    os.remove(empty)
+                open(empty, 'w').close()
+                placed += 1
+            record['empty'] = True
         else:
-            if create_empty:
-                open(os.path.join(dst_label_dir, label_name), 'w').close()
-            else:
-                missing_labels.append(label_name)
+            record['label'] = None
+        return record, placed
+
+    records, missing_labels, placed = [], [], 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for record, n in executor.map(place_pair, pairs):
+            records.append(record)
+            placed += n
+            if record['label'] is None:
+                missing_labels.append(os.path.splitext(os.path.basename(record['image']))[0] + '.txt')
+    return records, missing_labels, placed
+
+def load_manifest(dest):
+    """The records of the previous run in `dest`, if any."""
+    records = []
+    path = os.path.join(dest, MANIFEST)
+    if os.path.exists(path):
+        with open(path) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    return records
+
+def save_manifest(dest, records):
+    path = os.path.join(dest, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    os.replace(path + '.tmp', path)
+
+def remove_stale(dest, previous, records):
+    """Remove the files of the previous run that are not part of the new dataset, e.g. moved to another split."""
+    current = {path for record in records for path in (record['image'], record['label']) if path}
+    removed = 0
+    for record in previous:
+        for path in (record['image'], record['label']):
+            if path and path not in current and os.path.lexists(os.path.join(dest, path)):
+                os.remove(os.path.join(dest, path))
+                removed += 1
+    return removed
+
+def prepare(splits, dest, mode='copy', create_empty=False, workers=None):
+    """
+    Place the image/label pairs of each split in the YOLO layout of `dest`, and write the manifest.
+
+    :param splits: a dictionary `{split: [(image entry, label entry or None)]}`.
+    :return: missing_labels: the label names of the images without label.
+    """
+    placer = Placer(mode)
+    previous = load_manifest(dest)
+    records, missing_labels, placed = [], [], 0
+    for split, pairs in splits.items():
+        split_records, split_missing, split_placed = place_split(pairs, split, dest, placer, create_empty, workers)
+        records += split_records
+        missing_labels += split_missing
+        placed += split_placed
+        print(f"{split}: {len(pairs)} images, {split_placed} files placed")
+
+    removed = remove_stale(dest, previous, records)
+    save_manifest(dest, records)
+    print(f"{placed} files placed ({placer.fallback or mode}), {removed} stale files removed, "
+          f"manifest: {os.path.join(dest, MANIFEST)}")
     return missing_labels
 
-if __name__ == "__main__":
+def split_pairs(pairs, fractions, seed, index=None):
+    """
+    Split the image/label pairs, at random or stratified by class if a `LabelIndex` is given.
+
+    :param fractions: a dictionary `{split: fraction}`, the splits with a fraction of 0 are left out.
+    :return: splits: a dictionary `{split: [pairs]}`.
+    """
+    fractions = {split: f for split, f in fractions.items() if f > 0}
+    if index is not None:
+        by_name = {os.path.splitext(image.name)[0]: (image, label) for image, label in pairs}
+        names = index.stratified_split(list(by_name), fractions, seed)
+        return {split: [by_name[name] for name in names[split]] for split in fractions}
+
+    # images are listed sorted, so the same seed gives the same split and re-runs stay incremental
+    pairs = list(pairs)
+    random.Random(seed).shuffle(pairs)
+    splits, start = {}, 0
+    for split, f in fractions.items():
+        if split != 'train':
+            n = max(1, int(len(pairs) * f))
+            splits[split] = pairs[start:start + n]
+            start += n
+    splits['train'] = pairs[start:]
+    return {split: splits[split] for split in fractions}
+
+def print_stats(index, splits):
+    """Print the boxes and images of each class in each split."""
+    rows = index.rows()
+    for split, pairs in splits.items():
+        summary = index.summary(rows=[rows[os.path.splitext(image.name)[0]] for image, label in pairs
+                                      if os.path.splitext(image.name)[0] in rows])
+        classes = ', '.join(f"{name}: {c['boxes']} boxes in {c['images']} images" for name, c in summary['classes'].items())
+        print(f"{split}: {len(pairs)} images, {summary['empty']} empty labels - {classes}")
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--src', help='Source folder (images and labels together OR contains train/val if --already_split)', default=None)
     parser.add_argument('--src_images', help='Source images folder (optional)', default=None)
     parser.add_argument('--src_labels', help='Source labels folder (optional)', default=None)
     parser.add_argument('--dest', help='Destination dataset root', default='datasets/guns_dataset')
     parser.add_argument('--val', type=float, help='Validation split ratio (0-1)', default=0.2)
+    parser.add_argument('--test', type=float, help='Test split ratio (0-1)', default=0.0)
+    parser.add_argument('--split', choices=('random', 'stratified'), default='random',
+                        help='random, or stratified to keep the proportion of every class in each split')
     parser.add_argument('--seed', type=int, default=42)
     parser.add_argument('--create_empty_labels', action='store_true', help='Create empty .txt files for images with no label')
     parser.add_argument('--already_split', action='store_true', help='If src has train/val subfolders already')
-    args = parser.parse_args()
+    parser.add_argument('--dedupe_manifest', default=None, help='Manifest of dedupe_images.py, its dropped images are left out')
+    parser.add_argument('--mode', choices=MODES, default='copy', help='How files are placed in the destination')
+    parser.add_argument('--workers', type=int, default=None, help='Number of threads placing files (default: CPUs + 4, max 32)')
+    args = parser.parse_args(argv)
 
-    random.seed(args.seed)
-    # dirs:
-    dest_img_train = os.path.join(args.dest, 'images', 'train')
-    dest_img_val   = os.path.join(args.dest, 'images', 'val')
-    dest_lbl_train = os.path.join(args.dest, 'labels', 'train')
-    dest_lbl_val   = os.path.join(args.dest, 'labels', 'val')
+    drop = load_dedupe_manifest(args.dedupe_manifest) if args.dedupe_manifest else None
 
     # Case A: already split inside src into train/val
     if args.already_split:
         if not args.src:
             raise SystemExit("When using --already_split provide --src path containing train/ and val/")
+        splits = {}
         for split in ('train','val'):
             s_img = os.path.join(args.src, 'images', split)
-            s_lbl = os.path.join(args.src, 'labels', split)
-            d_img = os.path.join(args.dest, 'images', split)
-            d_lbl = os.path.join(args.dest, 'labels', split)
-            os.makedirs(d_img, exist_ok=True); os.makedirs(d_lbl, exist_ok=True)
-            if os.path.isdir(s_img):
-                imgs = [os.path.join(s_img,f) for f in os.listdir(s_img) if is_image(f)]
-                for imgp in imgs:
-                    shutil.copy2(imgp, d_img)
-                    name = os.path.splitext(os.path.basename(imgp))[0]
-                    lbl = os.path.join(s_lbl, name + '.txt')
-                    if os.path.exists(lbl):
-                        shutil.copy2(lbl, d_lbl)
-                    elif args.create_empty_labels:
-                        open(os.path.join(d_lbl, name + '.txt'), 'w').close()
-                print(f"Copied {len(imgs)} images for {split}")
-            else:
+            if not os.path.isdir(s_img):
                 print(f"Missing directory: {s_img}")
+                continue
+            images, _ = scan_dir(s_img)
+            if drop is not None:
+                images = [image for image in images if not drop(image)]
+            _, labels = scan_dir(os.path.join(args.src, 'labels', split))
+            splits[split] = pair_labels(images, labels)
+        prepare(splits, args.dest, args.mode, args.create_empty_labels, args.workers)
         print("Done (already_split).")
-        raise SystemExit(0)
+        return
 
     # Case B: single images folder (labels maybe same folder or separate)
     src_images = args.src_images or args.src
     if not src_images:
         raise SystemExit("Provide --src_images or --src (single-folder mode)")
 
-    all_imgs = [os.path.join(src_images,f) for f in os.listdir(src_images) if is_image(f)]
-    if len(all_imgs) == 0:
+    src_labels = src_images
+    images, labels = scan_dir(src_images)
+    if args.src_labels and os.path.abspath(args.src_labels) != os.path.abspath(src_images):
+        src_labels = args.src_labels
+        _, labels = scan_dir(src_labels)
+    if len(images) == 0:
         raise SystemExit("No images found in " + src_images)
+    if drop is not None:
+        kept = [image for image in images if not drop(image)]
+        print(f"{len(images) - len(kept)} duplicate images left out ({args.dedupe_manifest})")
+        images = kept
 
-    random.shuffle(all_imgs)
-    n_val = max(1, int(len(all_imgs) * args.val))
-    val_imgs = all_imgs[:n_val]
-    train_imgs = all_imgs[n_val:]
+    all_pairs = pair_labels(images, labels)
+    index = LabelIndex.load(src_labels, labels, args.workers) if args.split == 'stratified' else None
+    splits = split_pairs(all_pairs, {'train': 1 - args.val - args.test, 'val': args.val, 'test': args.test},
+                         args.seed, index)
 
-    missing_train = copy_pairs(train_imgs, dest_img_train, dest_lbl_train, create_empty=args.create_empty_labels)
-    missing_val   = copy_pairs(val_imgs,   dest_img_val,   dest_lbl_val,   create_empty=args.create_empty_labels)
+    missing = prepare(splits, args.dest, args.mode, args.create_empty_labels, args.workers)
 
-    print(f"Total images: {len(all_imgs)} (train: {len(train_imgs)}, val: {len(val_imgs)})")
-    if missing_train or missing_val:
+    print(f"Total images: {len(all_pairs)} (" + ', '.join(f"{split}: {len(pairs)}" for split, pairs in splits.items()) + ")")
+    if index is not None:
+        print_stats(index, splits)
+    if missing:
         print("Warning - missing labels for some images. Use --create_empty_labels to create empty .txt files if those images have no objects.")
-        print("Missing examples (showing first 10):", (missing_train + missing_val)[:10])
+        print("Missing examples (showing first 10):", missing[:10])
     print("Done. Destination:", os.path.abspath(args.dest))
+
+if __name__ == "__main__":
+    main()